@@ -59,6 +59,7 @@ from freenasUI.jails.forms import JailCreateForm, JailsEditForm
 from freenasUI.middleware import zfs
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.notifier import notifier
+from freenasUI.middleware.replication import REMOTE_SNAPSHOTS
 from freenasUI.network.forms import AliasForm
 from freenasUI.network.models import Alias, Interfaces
 from freenasUI.plugins import availablePlugins, Plugin
@@ -130,7 +131,7 @@ class AlertResource(DojoResource):
         resource_name = 'system/alert'
 
     def get_list(self, request, **kwargs):
-        results = alertPlugins.run()
+        results = alertPlugins.get_alerts()
         paginator = self._meta.paginator_class(
             request,
             results,
@@ -738,12 +739,15 @@ class VolumeResourceMixin(NestedMixin):
         return bundle
 
     def dispatch_list(self, request, **kwargs):
-        # Only for webclient to do not break API
-        if self.is_webclient(request):
-            self.__zfsopts = notifier().zfs_get_options(
-                recursive=True,
-                props=['compression', 'compressratio'],
-            )
+        # Walk every pool once for datasets, zvols and properties
+        # compression props only for webclient to do not break API
+        request._zfsinventory = zfs.ZFSInventory(
+            types=('filesystem', 'volume'),
+            props=(
+                ('compression', 'compressratio')
+                if self.is_webclient(request) else None
+            ),
+        )
         return super(VolumeResourceMixin, self).dispatch_list(
             request, **kwargs
         )
@@ -757,15 +761,15 @@ class VolumeResourceMixin(NestedMixin):
                 del bundle.data[key]
 
         bundle.data['name'] = bundle.obj.vol_name
+        inventory = getattr(bundle.request, '_zfsinventory', None)
         if self.is_webclient(bundle.request):
-            bundle.data['compression'] = self.__zfsopts.get(
-                bundle.obj.vol_name,
-                {},
-            ).get('compression', '-')
-            bundle.data['compressratio'] = self.__zfsopts.get(
-                bundle.obj.vol_name,
-                {},
-            ).get('compressratio', '-')
+            zfsopts = {}
+            if inventory is not None:
+                record = inventory.get(bundle.obj.vol_name)
+                if record is not None and record.props:
+                    zfsopts = record.props
+            bundle.data['compression'] = zfsopts.get('compression', '-')
+            bundle.data['compressratio'] = zfsopts.get('compressratio', '-')
 
         is_decrypted = bundle.obj.is_decrypted()
         if bundle.obj.vol_fstype == 'ZFS':
@@ -870,11 +874,14 @@ class VolumeResourceMixin(NestedMixin):
             children = self._get_datasets(
                 bundle,
                 bundle.obj,
-                bundle.obj.get_datasets(hierarchical=True),
+                bundle.obj.get_datasets(
+                    hierarchical=True,
+                    inventory=inventory,
+                ),
                 uid=uid,
             )
 
-            zvols = bundle.obj.get_zvols() or {}
+            zvols = bundle.obj.get_zvols(inventory=inventory) or {}
             for name, zvol in zvols.items():
                 total_si = '%s %siB' % (
                     zvol['volsize'][:-1],
@@ -1688,6 +1695,31 @@ class JailTemplateResourceMixin(object):
         return bundle
 
 
+class SnapshotWindow(object):
+    """
+    Page of snapshots already cut by zfs.list_snapshots_window
+    presented to the paginator as if it was the whole list
+    """
+
+    def __init__(self, total, offset, snapshots):
+        self.total = total
+        self.offset = offset
+        self.snapshots = snapshots
+
+    def __len__(self):
+        return self.total
+
+    def count(self):
+        return self.total
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self.snapshots[item - self.offset]
+        start = max((item.start or 0) - self.offset, 0)
+        stop = item.stop - self.offset if item.stop is not None else None
+        return self.snapshots[start:stop]
+
+
 class SnapshotResource(DojoResource):
 
     id = fields.CharField(attribute='filesystem')
@@ -1708,41 +1740,69 @@ class SnapshotResource(DojoResource):
     def get_list(self, request, **kwargs):
 
         # Get a list of snapshots in remote sides to show whether it has been
-        # transfered already or not
-        repli = {}
-        for repl in Replication.objects.all():
-            repli[repl] = notifier().repl_remote_snapshots(repl)
-
-        snapshots = notifier().zfs_snapshot_list(replications=repli)
-
-        results = []
-        for snaps in snapshots.values():
-            results.extend(snaps)
-        FIELD_MAP = {
-            'used': 'used_bytes',
-            'refer': 'refer_bytes',
-            'extra': 'mostrecent',
-        }
+        # transfered already or not, refreshed in background
+        repli = REMOTE_SNAPSHOTS.get(
+            Replication.objects.all(),
+            notifier().repl_remote_snapshots,
+        )
 
-        for sfield in self._apply_sorting(request.GET):
-            if sfield.startswith('-'):
-                field = sfield[1:]
-                reverse = True
-            else:
-                field = sfield
-                reverse = False
-            field = FIELD_MAP.get(field, field)
-            results.sort(
-                key=lambda item: getattr(item, field),
-                reverse=reverse)
         paginator = self._meta.paginator_class(
             request,
-            results,
+            [],
             resource_uri=self.get_resource_uri(),
             limit=self._meta.limit,
             max_limit=self._meta.max_limit,
             collection_name=self._meta.collection_name,
         )
+        sorting = self._apply_sorting(request.GET)
+        prefix = request.GET.get('prefix')
+        try:
+            # Let zfs list sort and only keep the requested page
+            offset = paginator.get_offset()
+            total, results = zfs.list_snapshots_window(
+                offset=offset,
+                limit=paginator.get_limit() or None,
+                sort=sorting,
+                prefix=prefix,
+            )
+            notifier().zfs_snapshot_replication(results, repli)
+            results = SnapshotWindow(total, offset, results)
+        except MiddlewareError, e:
+            raise ImmediateHttpResponse(
+                response=self.error_response(request, {
+                    'prefix': [e.value],
+                })
+            )
+        except ValueError:
+            # Field zfs list cannot sort on, fallback to sort in memory
+            snapshots = notifier().zfs_snapshot_list(replications=repli)
+
+            results = []
+            for snaps in snapshots.values():
+                results.extend(snaps)
+            if prefix:
+                results = filter(
+                    lambda item: item.fullname.startswith(prefix),
+                    results,
+                )
+            FIELD_MAP = {
+                'used': 'used_bytes',
+                'refer': 'refer_bytes',
+                'extra': 'mostrecent',
+            }
+
+            for sfield in sorting:
+                if sfield.startswith('-'):
+                    field = sfield[1:]
+                    reverse = True
+                else:
+                    field = sfield
+                    reverse = False
+                field = FIELD_MAP.get(field, field)
+                results.sort(
+                    key=lambda item: getattr(item, field),
+                    reverse=reverse)
+        paginator.objects = results
         to_be_serialized = paginator.page()
         # Dehydrate the bundles in preparation for serialization.
         bundles = []
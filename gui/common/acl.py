@@ -34,6 +34,9 @@ import stat
 from pipes import quote
 from subprocess import Popen, PIPE
 
+from freenasUI.common.acltree import (ACL_Tree, ACL_Template_Cache,
+    ACL_TREE_WORKERS, resolve_owner)
+
 log = logging.getLogger('common.acl')
 
 GETFACL_PATH = "/bin/getfacl"
@@ -395,32 +398,67 @@ class Base_ACL(object):
 
 class Base_ACL_Hierarchy(Base_ACL):
 
+    #
+    # acl_type_t of the ACLs handled by new_ACL(), recursive operations
+    # set the resulting ACL directly on files sharing the same ACL
+    #
+    acl_type_np = None
+
+    #
+    # Operations whose result only depends on the ACL they are applied to
+    #
+    _templated = ('__set_defaults', '__reset', '__clear', '__add',
+        '__update', '__remove', '__chmod')
+
+    #
+    # Operations depending on whether a parent directory holds the
+    # ACL_WINDOWS_FILE marker, given to them as the windows keyword
+    #
+    _windowed = ('__set_defaults', )
+
     def __init__(self, path, acl = None):
         super(Base_ACL_Hierarchy, self).__init__(path, acl)
         
         self.__jobs = []
+        self.workers = ACL_TREE_WORKERS
+        self.progress = None
 
     def _recurse(self, path, callback, *args, **kwargs):
-        callback(path, *args, **kwargs)
-
-        files = os.listdir(path)
-        decoded = path.decode('utf-8')
-        for f in files:
-            file = os.path.join(decoded, f.decode('utf-8')).encode('utf-8')
-            st = os.lstat(file)
+        cache = None
+        if self.acl_type_np is not None and callback.__name__ in self._templated:
+            cache = ACL_Template_Cache(self.acl_type_np)
+        op = (callback.__name__, repr(args), repr(sorted(kwargs.items())))
+
+        windowed = callback.__name__ in self._windowed
+
+        def apply(file, isdir, windows):
+            # windows belongs to the branch being walked, workers must
+            # not share it through self.windows
+            key = None
+            if cache is not None:
+                key = cache.key(file, op, isdir, windows)
+                if cache.apply(file, key):
+                    return
+
+            if windowed:
+                callback(file, *args, **dict(kwargs, windows=windows))
+            else:
+                callback(file, *args, **kwargs)
 
-            # Do not follow symbolic links (default for chmod)
-            if stat.S_ISLNK(st.st_mode):
-                continue
+            if cache is not None:
+                cache.learn(file, key)
 
-            if stat.S_ISDIR(st.st_mode):
-                if self.get_acl_ostype(path) == ACL_FLAGS_OS_WINDOWS:
-                    self.windows = True
-                self._recurse(file, callback, *args, **kwargs)
+        tree = ACL_Tree(path,
+            workers=self.workers,
+            progress=self.progress,
+            skip=(ACL_WINDOWS_FILE, ),
+            windows_file=ACL_WINDOWS_FILE)
+        tree.run(apply, windows=self.windows)
 
-            else:
-                if f != ACL_WINDOWS_FILE:
-                    callback(file, *args, **kwargs)
+        if cache is not None:
+            log.debug("Base_ACL_Hierarchy._recurse: %d templated, %d computed",
+                cache.hits,
+                cache.misses)
 
     def new_ACL(self, path):
         return Base_ACL(path)
@@ -434,19 +472,19 @@ class Base_ACL_Hierarchy(Base_ACL):
     def _set_unix_directory_defaults(self, acl):
         pass
 
-    def __set_file_defaults(self, acl):
+    def __set_file_defaults(self, acl, windows):
         log.debug("Base_ACL_Hierarchy.__set_file_defaults: enter")
         log.debug("Base_ACL_Hierarchy.__set_file_defaults: acl = %s", acl)
 
-        if self.windows:
+        if windows:
             self._set_windows_file_defaults(acl)
         else:
             self._set_unix_file_defaults(acl)
 
         log.debug("Base_ACL_Hierarchy.__set_file_defaults: leave")
 
-    def __set_directory_defaults(self, acl):
-        if self.windows:
+    def __set_directory_defaults(self, acl, windows):
+        if windows:
             self._set_windows_directory_defaults(acl)
         else:
             self._set_unix_directory_defaults(acl)
@@ -455,14 +493,15 @@ class Base_ACL_Hierarchy(Base_ACL):
         log.debug("Base_ACL_Hierarchy.__set_defaults: enter")
         log.debug("Base_ACL_Hierarchy.__set_defaults: path = %s", path)
 
+        windows = kwargs.get('windows', self.windows)
         acl = self.new_ACL(path)
 
         if stat.S_ISREG(acl.mode):
-            self.__set_file_defaults(acl)
+            self.__set_file_defaults(acl, windows)
         elif stat.S_ISDIR(acl.mode):
-            self.__set_directory_defaults(acl)
+            self.__set_directory_defaults(acl, windows)
         else:
-            self.__set_file_defaults(acl)
+            self.__set_file_defaults(acl, windows)
 
         acl.save()
         log.debug("Base_ACL_Hierarchy.__set_defaults: leave")
@@ -593,7 +632,17 @@ class Base_ACL_Hierarchy(Base_ACL):
         log.debug("Base_ACL_Hierarchy.chown: who = %s", who)
 
         if recursive:
-            self._recurse(self.path, self.__chown, who)
+            #
+            # Ownership is not part of the ACL, chown(2) every entry
+            #
+            parts = who.split(':')
+            uid, gid = resolve_owner(parts[0],
+                parts[1] if len(parts) > 1 else None)
+            tree = ACL_Tree(self.path,
+                workers=self.workers,
+                progress=self.progress,
+                skip=(ACL_WINDOWS_FILE, ))
+            tree.run(lambda file, isdir, windows: os.chown(file, uid, gid))
         else:
             self.__chown(self.path, who)
 
@@ -0,0 +1,386 @@
+#+
+# Copyright 2013 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+import ctypes
+import grp
+import logging
+import os
+import pwd
+import Queue
+import re
+import stat
+import threading
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+log = logging.getLogger('common.acltree')
+
+#
+# Tree walking
+#
+ACL_TREE_WORKERS     = 4
+ACL_TREE_PROGRESS    = 1000
+
+#
+# acl_type_t, sys/acl.h
+#
+ACL_TYPE_ACCESS      = 0x00000002
+ACL_TYPE_DEFAULT     = 0x00000003
+ACL_TYPE_NFS4        = 0x00000004
+
+
+class _libc_acl(object):
+    """
+    acl(3) routines of libc, so ACLs are read and set without running
+    getfacl/setfacl. Unavailable (e.g. not FreeBSD) when ``libc`` is None.
+    """
+
+    def __init__(self):
+        self.libc = None
+        try:
+            libc = ctypes.CDLL("libc.so.7", use_errno=True)
+            libc.acl_get_link_np.restype = ctypes.c_void_p
+            libc.acl_get_link_np.argtypes = [ctypes.c_char_p, ctypes.c_int]
+            libc.acl_set_link_np.restype = ctypes.c_int
+            libc.acl_set_link_np.argtypes = [
+                ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p
+            ]
+            libc.acl_to_text_np.restype = ctypes.c_void_p
+            libc.acl_to_text_np.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int
+            ]
+            libc.acl_free.argtypes = [ctypes.c_void_p]
+            self.libc = libc
+        except (OSError, AttributeError), e:
+            log.debug("acl(3) not available: %s", e)
+
+    def get(self, path, acltype):
+        acl = self.libc.acl_get_link_np(path, acltype)
+        if not acl:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return ACL_Handle(self, acl)
+
+    def set(self, path, acltype, handle):
+        if self.libc.acl_set_link_np(path, acltype, handle.acl) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+
+    def text(self, handle):
+        text = self.libc.acl_to_text_np(handle.acl, None, 0)
+        if not text:
+            return None
+        try:
+            return ctypes.string_at(text)
+        finally:
+            self.libc.acl_free(text)
+
+    def free(self, acl):
+        self.libc.acl_free(acl)
+
+
+class ACL_Handle(object):
+    """
+    An acl_t, freed along with the object
+    """
+
+    def __init__(self, libacl, acl):
+        self.libacl = libacl
+        self.acl = acl
+
+    def __str__(self):
+        return self.libacl.text(self)
+
+    def __del__(self):
+        if self.acl:
+            self.libacl.free(self.acl)
+            self.acl = None
+
+
+_libacl = None
+_libacl_lock = threading.Lock()
+
+
+def libacl():
+    global _libacl
+    with _libacl_lock:
+        if _libacl is None:
+            _libacl = _libc_acl()
+    return _libacl if _libacl.libc is not None else None
+
+
+class ACL_Template_Cache(object):
+    """
+    ACL resulting of an operation, keyed on the ACL it was applied to
+
+    Files of a tree usually share a handful of distinct ACLs. The first
+    file with a given (operation, file type, ACL) goes through the regular
+    getfacl/setfacl path, the ACL it ends up with is then read back once
+    and set directly on every other file with the same key.
+    """
+
+    def __init__(self, acltype):
+        self.acltype = acltype
+        self.libacl = libacl()
+        self._lock = threading.Lock()
+        self._templates = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, path, *extra):
+        if self.libacl is None:
+            return None
+        try:
+            text = str(self.libacl.get(path, self.acltype))
+        except OSError:
+            return None
+        return extra + (text, )
+
+    def apply(self, path, key):
+        """
+        Set the cached ACL of ``key`` on ``path``, False on a miss
+        """
+        if key is None:
+            return False
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+        self.libacl.set(path, self.acltype, template)
+        return True
+
+    def learn(self, path, key):
+        if key is None:
+            return
+        try:
+            template = self.libacl.get(path, self.acltype)
+        except OSError, e:
+            log.debug("Failed to read back ACL of %s: %s", path, e)
+            return
+        with self._lock:
+            self._templates.setdefault(key, template)
+
+
+def _listdir(path):
+    """
+    (name, isdir, islink) of every entry of ``path``
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            yield (
+                entry.name,
+                entry.is_dir(follow_symlinks=False),
+                entry.is_symlink(),
+            )
+    else:
+        for name in os.listdir(path):
+            st = os.lstat(os.path.join(path, name))
+            yield (
+                name,
+                stat.S_ISDIR(st.st_mode),
+                stat.S_ISLNK(st.st_mode),
+            )
+
+
+class ACL_Tree(object):
+    """
+    Walk a directory tree calling ``callback(path, isdir, windows)``
+    for the top directory and everything below it.
+
+    Directories are listed by a pool of ``workers`` threads sharing a
+    queue, so large subtrees are processed concurrently. A directory is
+    always visited before its content. Symbolic links are not followed
+    nor visited, like chmod -R, and neither are the names in ``skip``.
+
+    ``windows`` tells whether a parent directory holds the
+    ACL_WINDOWS_FILE marker given as ``windows_file``.
+
+    Errors on a single entry are logged and counted, the walk goes on.
+    ``progress(count, path)`` is called every ``every`` entries and once
+    the walk is over.
+    """
+
+    def __init__(self, path, workers=ACL_TREE_WORKERS, progress=None,
+                 every=ACL_TREE_PROGRESS, exclude=None, skip=None,
+                 windows_file=None):
+        self.path = path
+        self.workers = workers
+        self.progress = progress
+        self.every = every
+        self.exclude = set([e.rstrip('/') for e in (exclude or [])])
+        self.skip = set(skip or [])
+        self.windows_file = windows_file
+        self.count = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _visit(self, callback, path, isdir, windows):
+        try:
+            callback(path, isdir, windows)
+        except Exception, e:
+            log.warn("Failed to process %s: %s", path, e)
+            with self._lock:
+                self.errors += 1
+
+        with self._lock:
+            self.count += 1
+            report = self.progress and self.count % self.every == 0
+            count = self.count
+        if report:
+            try:
+                self.progress(count, path)
+            except Exception, e:
+                log.warn("Progress report failed at %s: %s", path, e)
+
+    def _directory(self, callback, queue, path, windows):
+        try:
+            entries = list(_listdir(path))
+        except OSError, e:
+            log.warn("Failed to list %s: %s", path, e)
+            with self._lock:
+                self.errors += 1
+            return
+
+        if self.windows_file and not windows:
+            windows = any([name == self.windows_file for name, d, l in entries])
+
+        for name, isdir, islink in entries:
+            if islink or name in self.skip:
+                continue
+            fpath = os.path.join(path, name)
+            if fpath in self.exclude:
+                continue
+            self._visit(callback, fpath, isdir, windows)
+            if isdir:
+                queue.put((fpath, windows))
+
+    def _safe_directory(self, callback, queue, path, windows):
+        # Anything unexpected costs that directory, not the worker thread,
+        # run() would wait on the queue forever once every worker died
+        try:
+            self._directory(callback, queue, path, windows)
+        except Exception, e:
+            log.error("Failed to process directory %s: %s", path, e)
+            with self._lock:
+                self.errors += 1
+
+    def _worker(self, callback, queue):
+        while True:
+            item = queue.get()
+            try:
+                if item is None:
+                    return
+                self._safe_directory(callback, queue, *item)
+            finally:
+                queue.task_done()
+
+    def run(self, callback, windows=False):
+        """
+        Returns:
+            number of entries visited
+        """
+        self._visit(callback, self.path, True, windows)
+
+        queue = Queue.Queue()
+        queue.put((self.path, windows))
+        if self.workers <= 1:
+            while not queue.empty():
+                self._safe_directory(callback, queue, *queue.get())
+        else:
+            threads = []
+            for i in xrange(self.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(callback, queue),
+                )
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            queue.join()
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if self.progress:
+            self.progress(self.count, self.path)
+        return self.count
+
+
+def resolve_owner(user=None, group=None):
+    """
+    uid and gid (-1 when not given) of a user and group name or id
+    """
+    uid = gid = -1
+    if user and re.match('^\d+$', str(user)):
+        uid = int(user)
+    elif user:
+        uid = pwd.getpwnam(user).pw_uid
+
+    if group and re.match('^\d+$', str(group)):
+        gid = int(group)
+    elif group:
+        gid = grp.getgrnam(group).gr_gid
+    return uid, gid
+
+
+def change_permission(path, user=None, group=None, mode=None,
+                      recursive=False, exclude=None,
+                      workers=ACL_TREE_WORKERS, progress=None):
+    """
+    In process chown -R/chmod -R, owner and mode are applied to every
+    entry with chown(2)/chmod(2)
+
+    Returns:
+        number of entries that could not be changed
+    """
+    uid, gid = resolve_owner(user, group)
+    if mode is not None and not isinstance(mode, (int, long)):
+        mode = int(mode, 8)
+
+    def apply(fpath, isdir, windows):
+        if uid != -1 or gid != -1:
+            os.chown(fpath, uid, gid)
+        if mode is not None:
+            os.chmod(fpath, mode)
+
+    if not recursive:
+        apply(path, True, False)
+        return 0
+
+    tree = ACL_Tree(
+        path,
+        workers=workers,
+        progress=progress,
+        exclude=exclude,
+    )
+    tree.run(apply)
+    return tree.errors
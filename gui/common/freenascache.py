@@ -27,9 +27,14 @@
 
 import os
 import cPickle as pickle
+import grp
 import logging
+import pwd
+import sqlite3
+import struct
+import threading
+import time
 
-from bsddb3 import db
 from freenasUI.common.system import (
     get_freenas_var,
     ldap_enabled,
@@ -42,7 +47,13 @@ from freenasUI.common.system import (
 log = logging.getLogger('common.frenascache')
 
 FREENAS_CACHEDIR = get_freenas_var("FREENAS_CACHEDIR", "/var/tmp/.cache")
-FREENAS_CACHEEXPIRE = int(get_freenas_var("FREENAS_CACHEEXPIRE", 60))
+# Minutes a cached entry is valid for
+FREENAS_CACHEEXPIRE = int(get_freenas_var("FREENAS_CACHEEXPIRE", 1440))
+
+# Every cache lives in this single database, one scope per cache directory
+FREENAS_CACHEDB = os.path.join(FREENAS_CACHEDIR, ".identity.db")
+# Bytes of the database each process maps in memory
+FREENAS_CACHEMMAP = 256 * 1024 * 1024
 
 FREENAS_USERCACHE = os.path.join(FREENAS_CACHEDIR, ".users")
 FREENAS_GROUPCACHE = os.path.join(FREENAS_CACHEDIR, ".groups")
@@ -91,109 +102,430 @@ FLAGS_CACHE_READ_GROUP   = 0x00000004
 FLAGS_CACHE_WRITE_GROUP  = 0x00000008
 FLAGS_CACHE_READ_QUERY   = 0x00000010
 FLAGS_CACHE_WRITE_QUERY  = 0x00000020
+FLAGS_CACHE_REFRESH      = 0x00000040
+
+CACHE_KIND_OBJECT = 0
+CACHE_KIND_PASSWD = 1
+CACHE_KIND_GROUP = 2
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    kind INTEGER NOT NULL,
+    name TEXT,
+    passwd TEXT,
+    id INTEGER,
+    gid INTEGER,
+    gecos TEXT,
+    home TEXT,
+    shell TEXT,
+    members TEXT,
+    sid TEXT,
+    data BLOB,
+    expires REAL NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+CREATE INDEX IF NOT EXISTS entries_name ON entries (scope, name);
+CREATE INDEX IF NOT EXISTS entries_id ON entries (scope, id);
+CREATE INDEX IF NOT EXISTS entries_sid ON entries (sid);
+CREATE TABLE IF NOT EXISTS scopes (
+    scope TEXT NOT NULL PRIMARY KEY,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    scope TEXT NOT NULL,
+    server TEXT NOT NULL,
+    mark TEXT NOT NULL,
+    PRIMARY KEY (scope, server)
+);
+"""
+
+CACHE_COLUMNS = "kind, name, passwd, id, gid, gecos, home, shell, members, sid, data"
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def sid_to_str(sid):
+    """
+    Binary objectSid to its S-R-I-S-S... string form
+    """
+    try:
+        count = ord(sid[1])
+        auth = struct.unpack('>Q', '\x00\x00' + sid[2:8])[0]
+        subauths = struct.unpack('<%dI' % count, sid[8:8 + 4 * count])
+    except (IndexError, TypeError, struct.error):
+        return None
+    return 'S-%d-%d%s' % (
+        ord(sid[0]),
+        auth,
+        ''.join('-%d' % s for s in subauths),
+    )
+
+
+def _attr(attrs, *keys):
+    for key in keys:
+        value = attrs.get(key)
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if value:
+            return value
+    return None
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _encode(value):
+    """
+    Row columns of a cached value
+
+    passwd and group structs are laid out in the fixed columns, anything
+    else (directory entries, query results) is pickled but still gets
+    its name, uid/gid and SID extracted for the secondary indexes.
+    """
+    if isinstance(value, pwd.struct_passwd):
+        return (
+            CACHE_KIND_PASSWD, value.pw_name, value.pw_passwd, value.pw_uid,
+            value.pw_gid, value.pw_gecos, value.pw_dir, value.pw_shell,
+            None, None, None,
+        )
+
+    if isinstance(value, grp.struct_group):
+        return (
+            CACHE_KIND_GROUP, value.gr_name, value.gr_passwd, value.gr_gid,
+            value.gr_gid, None, None, None, ','.join(value.gr_mem),
+            None, None,
+        )
+
+    attrs = None
+    if isinstance(value, dict):
+        attrs = value
+    elif isinstance(value, tuple) and len(value) == 2 and \
+            isinstance(value[1], dict):
+        attrs = value[1]
+
+    name = uid = gid = sid = None
+    if attrs is not None:
+        name = _text(_attr(attrs, 'sAMAccountName', 'uid', 'group', 'cn',
+            'name'))
+        gid = _int(_attr(attrs, 'gidNumber'))
+        uid = _int(_attr(attrs, 'uidNumber'))
+        if uid is None:
+            uid = gid
+        sid = _attr(attrs, 'objectSid')
+        if sid and not sid.startswith('S-'):
+            sid = sid_to_str(sid)
+
+    return (
+        CACHE_KIND_OBJECT, name, None, uid, gid, None, None, None, None, sid,
+        sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+    )
+
+
+def _decode(row):
+    kind = row[0]
+    if kind == CACHE_KIND_PASSWD:
+        return pwd.struct_passwd(row[1:8])
+    if kind == CACHE_KIND_GROUP:
+        return grp.struct_group((
+            row[1], row[2], row[3], row[8].split(',') if row[8] else [],
+        ))
+    return pickle.loads(str(row[10]))
+
+
+class FreeNAS_IdentityStore(object):
+    """
+    Users, groups and directory entries of every cache
+
+    One sqlite database holds all of them, each cache directory of the
+    former layout being a scope. passwd and group structs are stored in
+    fixed columns and rebuilt straight from the row, with name, uid/gid
+    and SID indexes. The database is mapped in memory so lookups read
+    the pages in place.
+
+    Each entry carries its own expiration time, expired entries are
+    ignored by reads and dropped by purge().
+    """
+
+    def __init__(self, path=FREENAS_CACHEDB):
+        self.path = path
+        self.__local = threading.local()
+
+    def connection(self):
+        # Neither shared among threads nor inherited across fork()
+        if getattr(self.__local, 'pid', None) != os.getpid():
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            conn = sqlite3.connect(self.path, timeout=30,
+                isolation_level=None)
+            conn.text_factory = str
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("PRAGMA mmap_size=%d" % FREENAS_CACHEMMAP)
+            conn.executescript(CACHE_SCHEMA)
+
+            self.__local.conn = conn
+            self.__local.pid = os.getpid()
+
+        return self.__local.conn
+
+    def execute(self, sql, args=()):
+        return self.connection().execute(sql, args)
 
-class FreeNAS_BaseCache(object):
-    def __init__(self, cachedir=FREENAS_CACHEDIR):
-        log.debug("FreeNAS_BaseCache._init__: enter")
+    def expire(self):
+        """
+        Drop everything, for every scope
+        """
+        self.execute("DELETE FROM entries")
+        self.execute("DELETE FROM scopes")
+        self.execute("DELETE FROM watermarks")
+
+    def purge(self):
+        """
+        Drop expired entries, for every scope
+        """
+        now = time.time()
+        self.execute("DELETE FROM entries WHERE expires <= ?", (now, ))
+        self.execute("DELETE FROM scopes WHERE expires <= ?", (now, ))
+
+    def scopes(self):
+        return [row[0] for row in self.execute(
+            "SELECT DISTINCT scope FROM entries ORDER BY scope"
+        )]
+
+    def lookup(self, column, value):
+        """
+        (scope, key, value) of the live entries of every scope whose
+        indexed ``column`` (name, id or sid) matches ``value``
+        """
+        if column not in ('name', 'id', 'sid'):
+            raise ValueError("Not an indexed column: %s" % column)
+
+        if column == 'id':
+            value = int(value)
+        else:
+            value = _text(value)
 
-        self.cachedir = cachedir
-        self.__cachefile = os.path.join(self.cachedir, ".cache.db")
+        return [
+            (row[0], row[1], _decode(row[2:]))
+            for row in self.execute(
+                "SELECT scope, key, %s FROM entries "
+                "WHERE %s = ? AND expires > ?" % (CACHE_COLUMNS, column),
+                (value, time.time())
+            )
+        ]
 
-        if not self.__dir_exists(self.cachedir):
-            os.makedirs(self.cachedir)
 
-        self.__dbenv = db.DBEnv()
-        self.__dbenv.open(self.cachedir,
-            db.DB_INIT_CDB | db.DB_INIT_MPOOL | db.DB_CREATE, 0700)
+FREENAS_IDENTITY_STORE = FreeNAS_IdentityStore()
 
-        self.__cache = db.DB(self.__dbenv)
-        self.__cache.open(self.__cachefile, None, db.DB_HASH, db.DB_CREATE)
 
-        log.debug("FreeNAS_BaseCache._init__: cachedir = %s", self.cachedir)
-        log.debug("FreeNAS_BaseCache._init__: cachefile = %s",
-            self.__cachefile)
-        log.debug("FreeNAS_BaseCache._init__: leave")
+class FreeNAS_BaseCache(object):
+    def __init__(self, cachedir=FREENAS_CACHEDIR, ttl=None):
+        log.debug("FreeNAS_BaseCache._init__: enter")
 
-    def __dir_exists(self, path):
-        path_exists = False
-        try:
-            os.stat(path)
-            path_exists = True
+        self.cachedir = cachedir
+        self.ttl = ttl if ttl is not None else FREENAS_CACHEEXPIRE * 60
+        self.__store = FREENAS_IDENTITY_STORE
+        self.__scope = _text(cachedir.rstrip('/'))
 
-        except OSError:
-            path_exists = False
+        log.debug("FreeNAS_BaseCache._init__: cachedir = %s", self.cachedir)
+        log.debug("FreeNAS_BaseCache._init__: leave")
 
-        return path_exists
+    def __select(self, where='', args=(), columns=CACHE_COLUMNS):
+        sql = "SELECT %s FROM entries WHERE scope = ? AND expires > ?%s" % (
+            columns,
+            where,
+        )
+        return self.__store.execute(
+            sql, (self.__scope, time.time()) + tuple(args)
+        )
 
     def __len__(self):
-        return len(self.__cache)
+        return self.__select(columns="COUNT(*)").fetchone()[0]
 
     def __iter__(self):
-        for key in sorted(self.__cache.keys()):
-            obj = pickle.loads(self.__cache[key])
-            yield obj
+        for row in self.__select(" ORDER BY key"):
+            yield _decode(row)
 
     def __getitem__(self, key):
-        return pickle.loads(self.__cache.get(key))
+        row = self.__select(" AND key = ?", (_text(key), )).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return _decode(row)
 
     def __setitem__(self, key, value, overwrite=False):
-        haskey = self.__cache.has_key(key)
-        if (haskey and overwrite) or (not haskey):
-            self.__cache[key] = pickle.dumps(value)
+        self.write(key, value, overwrite)
 
     def has_key(self, key):
-        return self.__cache.has_key(key)
+        return self.__select(
+            " AND key = ?", (_text(key), ), columns="1"
+        ).fetchone() is not None
 
     def keys(self):
-        return self.__cache.keys()
+        return [row[0] for row in self.__select(columns="key")]
 
     def values(self):
-        cache_values = []
-        for key in self.__cache.keys():
-            cache_values.append(pickle.loads(self.__cache[key]))
-        return cache_values
+        return [_decode(row) for row in self.__select()]
 
     def items(self):
-        cache_items = []
-        for key in self.__cache.keys():
-            cache_items.append((key, pickle.loads(self.__cache[key])))
-        return cache_items
+        return [
+            (row[0], _decode(row[1:]))
+            for row in self.__select(columns="key, " + CACHE_COLUMNS)
+        ]
 
     def empty(self):
-        return (len(self.__cache) == 0)
+        return (len(self) == 0)
 
     def expire(self):
-        for key in self.__cache.keys():
-            self.__cache.delete(key)
-        self.__cache.close()
-        os.unlink(self.__cachefile)
+        self.__store.execute(
+            "DELETE FROM entries WHERE scope = ?", (self.__scope, )
+        )
+        self.__store.execute(
+            "DELETE FROM scopes WHERE scope IN (?, ?)",
+            (self.__marker(False), self.__marker(True))
+        )
+        self.__store.execute(
+            "DELETE FROM watermarks WHERE scope = ?", (self.__scope, )
+        )
+
+    def purge(self):
+        self.__store.execute(
+            "DELETE FROM entries WHERE scope = ? AND expires <= ?",
+            (self.__scope, time.time())
+        )
 
     def read(self, key):
         if not key:
             return None
 
-        pobj = pickle.loads(self.__cache[key])
-        return pobj
+        try:
+            return self[key]
+        except KeyError:
+            return None
 
-    def write(self, key, entry, overwrite=False):
+    def write(self, key, entry, overwrite=False, ttl=None):
         if not key:
             return False
 
-        haskey = self.__cache.has_key(key)
-        if (haskey and overwrite) or (not haskey):
-            self.__cache[key] = pickle.dumps(entry)
+        if not overwrite and self.has_key(key):
+            return True
+
+        if ttl is None:
+            ttl = self.ttl
 
+        self.__store.execute(
+            "INSERT OR REPLACE INTO entries (scope, key, %s, expires) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % (
+                CACHE_COLUMNS,
+            ),
+            (self.__scope, _text(key)) + _encode(entry) + (time.time() + ttl, )
+        )
         return True
 
     def delete(self, key):
         if not key:
             return False
 
-        self.__cache.delete(key)
+        self.__store.execute(
+            "DELETE FROM entries WHERE scope = ? AND key = ?",
+            (self.__scope, _text(key))
+        )
         return True
 
     def close(self):
-        self.__cache.close()
+        pass
+
+    def by_name(self, name):
+        row = self.__select(" AND name = ?", (_text(name), )).fetchone()
+        return _decode(row) if row else None
+
+    def by_id(self, id):
+        row = self.__select(" AND id = ?", (int(id), )).fetchone()
+        return _decode(row) if row else None
+
+    def by_sid(self, sid):
+        row = self.__select(" AND sid = ?", (_text(sid), )).fetchone()
+        return _decode(row) if row else None
+
+    def forget(self, name=None, sid=None):
+        """
+        Drop every entry of the given name or SID, e.g. a directory
+        object that was renamed, moved or deleted
+        """
+        if sid is not None:
+            self.__store.execute(
+                "DELETE FROM entries WHERE scope = ? AND sid = ?",
+                (self.__scope, _text(sid))
+            )
+        if name is not None:
+            self.__store.execute(
+                "DELETE FROM entries WHERE scope = ? AND name = ?",
+                (self.__scope, _text(name))
+            )
+
+    def watermark(self, server):
+        """
+        Change tracking high-water mark (AD uSNChanged, LDAP
+        modifyTimestamp) this cache is up to date with for ``server``
+        """
+        row = self.__store.execute(
+            "SELECT mark FROM watermarks WHERE scope = ? AND server = ?",
+            (self.__scope, _text(server))
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, server, mark):
+        self.__store.execute(
+            "INSERT OR REPLACE INTO watermarks (scope, server, mark) "
+            "VALUES (?, ?, ?)",
+            (self.__scope, _text(server), str(mark))
+        )
+
+    def __marker(self, subtree):
+        return self.__scope + '/*' if subtree else self.__scope
+
+    def loaded(self, subtree=False):
+        """
+        Whether the whole listing of this cache (and of the caches below
+        it for ``subtree``) was written and has not expired yet
+        """
+        return self.__store.execute(
+            "SELECT 1 FROM scopes WHERE scope = ? AND expires > ?",
+            (self.__marker(subtree), time.time())
+        ).fetchone() is not None
+
+    def mark_loaded(self, subtree=False):
+        self.__store.execute(
+            "INSERT OR REPLACE INTO scopes (scope, expires) VALUES (?, ?)",
+            (self.__marker(subtree), time.time() + self.ttl)
+        )
+        if not subtree:
+            self.purge()
+        return True
+
+    def walk(self):
+        """
+        Live values of this cache and of every cache below it
+        """
+        # '0' is the character right after '/'
+        for row in self.__store.execute(
+            "SELECT %s FROM entries WHERE "
+            "(scope = ? OR (scope >= ? AND scope < ?)) AND expires > ? "
+            "ORDER BY scope, key" % (CACHE_COLUMNS, ),
+            (self.__scope, self.__scope + '/', self.__scope + '0', time.time())
+        ):
+            yield _decode(row)
 
 
 class FreeNAS_LDAP_UserCache(FreeNAS_BaseCache):
@@ -30,10 +30,11 @@ import ldap
 import logging
 import os
 import pwd
+import time
 import types
 
 from dns import resolver
-from ldap.controls import SimplePagedResultsControl
+from ldap.controls import LDAPControl, SimplePagedResultsControl
 
 from freenasUI.common.system import (
     get_freenas_var,
@@ -42,6 +43,7 @@ from freenasUI.common.system import (
     activedirectory_objects,
 )
 from freenasUI.common.freenascache import *
+from freenasUI.common.identity import PasswdResolver, GroupResolver
 
 log = logging.getLogger('common.freenasldap')
 
@@ -65,6 +67,13 @@ FREENAS_LDAP_CACERTFILE = get_freenas_var("CERT_FILE")
 
 FREENAS_LDAP_PAGESIZE = get_freenas_var("FREENAS_LDAP_PAGESIZE", 1024)
 
+# Seconds subtracted from the local clock when recording a LDAP
+# modifyTimestamp watermark, covers clock skew with the server
+FREENAS_LDAP_REFRESH_SKEW = int(get_freenas_var("FREENAS_LDAP_REFRESH_SKEW", 300))
+
+# Return deleted objects (tombstones) as well
+LDAP_SERVER_SHOW_DELETED_OID = "1.2.840.113556.1.4.417"
+
 ldap.protocol_version = FREENAS_LDAP_VERSION
 ldap.set_option(ldap.OPT_REFERRALS, FREENAS_LDAP_REFERRALS)
 
@@ -84,6 +93,64 @@ def _e(val):
         val = val.encode('utf-8')
     return val
 
+
+def _merge_changes(cache, dcache, changed, deleted, dkey, key, resolve):
+    """
+    Merge directory objects changed/deleted since the last refresh
+    into a directory cache (``dcache``) and the matching pwd/grp cache
+
+    ``dkey(entry)`` and ``key(entry)`` give the keys an entry is cached
+    under, ``resolve(key, attrs)`` its pwd/grp record. Objects are matched by
+    SID when the directory has one, so renamed and moved objects do not
+    leave their former entries behind.
+
+    Returns the number of objects merged.
+    """
+    count = 0
+
+    def _drop(entry):
+        attrs = entry[1]
+        sid = _sid(attrs)
+        old = dcache.by_sid(sid) if sid else dcache.read(dkey(entry))
+        if old:
+            dcache.delete(dkey(old))
+            cache.delete(key(old))
+        if sid:
+            dcache.forget(sid=sid)
+        cache.delete(key(entry))
+
+    for entry in deleted:
+        if not entry[0] or not entry[1]:
+            continue
+        _drop(entry)
+        count += 1
+
+    for entry in changed:
+        if not entry[0] or not entry[1]:
+            continue
+        _drop(entry)
+        dcache.write(dkey(entry), entry, overwrite=True)
+        name = key(entry)
+        record = resolve(name, entry[1])
+        if record is not None:
+            cache.write(name, record, overwrite=True)
+        count += 1
+
+    return count
+
+
+def _sid(attrs):
+    sid = attrs.get('objectSid')
+    if not sid:
+        return None
+    return sid_to_str(sid[0]) if isinstance(sid, list) else sid
+
+
+def _ldap_timestamp(t):
+    return time.strftime('%Y%m%d%H%M%SZ',
+        time.gmtime(t - FREENAS_LDAP_REFRESH_SKEW))
+
+
 class FreeNAS_LDAP_Directory(object):
     def __init__(self, **kwargs):
         log.debug("FreeNAS_LDAP_Directory.__init__: enter")
@@ -268,51 +335,40 @@ class FreeNAS_LDAP_Directory(object):
             self._isopen = False
             log.debug("FreeNAS_LDAP_Directory.close: connection closed")
 
-    def _search(self, basedn="", scope=ldap.SCOPE_SUBTREE, filter=None, attributes=None,
-        attrsonly=0, serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
-        log.debug("FreeNAS_LDAP_Directory._search: enter")
-        log.debug("FreeNAS_LDAP_Directory._search: basedn = '%s', filter = '%s'", basedn, filter)
-        if not self._isopen:
-            return None
-
-        #
-        # XXX
-        # For some reason passing attributes causes paged search results to hang/fail
-        # after a a certain numbe of pages. I can't figure out why. This is a workaround.
-        # XXX
-        #
-        attributes = None
-
+    def _search_key(self, basedn, scope, filter):
         m = hashlib.sha256()
-        m.update(filter + self.host + str(self.port) + (basedn if basedn else ''))
-        key = m.hexdigest()
-        m = None
-
-        if filter is not None and self._cache.has_key(key):
-            log.debug("FreeNAS_LDAP_Directory._search: query in cache")
-            return self._cache[key]
-
-        result = []
-        results = []
-        paged = SimplePagedResultsControl(
-            True,
-            size=self.pagesize,
-            cookie=''
-        )
-
-        paged_ctrls = {
-            SimplePagedResultsControl.controlType: SimplePagedResultsControl,
-        }
-
+        m.update(filter + self.host + str(self.port) +
+            (basedn if basedn else '') + str(scope))
+        return m.hexdigest()
+
+    def _search_ldap(self, basedn, scope, filter, attributes, attrsonly,
+        serverctrls, clientctrls, timeout, sizelimit):
+        """
+        Run the search, yielding lists of (dn, attrs) as they come in,
+        one list per result page when paging, otherwise at most
+        FREENAS_LDAP_PAGESIZE entries per list.
+        """
         if self.pagesize > 0:
             log.debug("FreeNAS_LDAP_Directory._search: pagesize = %d",
                 self.pagesize)
 
+            paged = SimplePagedResultsControl(
+                True,
+                size=self.pagesize,
+                cookie=''
+            )
+
+            paged_ctrls = {
+                SimplePagedResultsControl.controlType: SimplePagedResultsControl,
+            }
+
+            extra = list(serverctrls or [])
+
             page = 0
             while True:
                 log.debug("FreeNAS_LDAP_Directory._search: getting page %d",
                     page)
-                serverctrls = [paged]
+                serverctrls = [paged] + extra
 
                 id = self._handle.search_ext(
                    basedn,
@@ -330,7 +386,7 @@ class FreeNAS_LDAP_Directory(object):
                     id, resp_ctrl_classes=paged_ctrls
                 )
 
-                result.extend(rdata)
+                yield rdata
 
                 paged.size = 0
                 paged.cookie = cookie = None
@@ -362,6 +418,7 @@ class FreeNAS_LDAP_Directory(object):
                 sizelimit=sizelimit
             )
 
+            result = []
             type = ldap.RES_SEARCH_ENTRY
             while type != ldap.RES_SEARCH_RESULT:
                 try:
@@ -371,17 +428,82 @@ class FreeNAS_LDAP_Directory(object):
                     self._logex(e)
                     break
 
-                results.append(data)
+                result.extend(data)
+                if len(result) >= FREENAS_LDAP_PAGESIZE:
+                    yield result
+                    result = []
+
+            if result:
+                yield result
+
+    def _search_pages(self, basedn="", scope=ldap.SCOPE_SUBTREE, filter=None, attributes=None,
+        attrsonly=0, serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0,
+        cache=True):
+        """
+        Generator of result pages, lists of (dn, attrs).
+
+        Pages are kept in the query cache, paged or not. The cache entry
+        of the query holds the number of pages and each page is stored
+        on its own, the count is only written once the last page is in
+        so an interrupted search is never served from the cache.
+
+        ``cache=False`` always asks the server (change tracking queries).
+        """
+        log.debug("FreeNAS_LDAP_Directory._search_pages: enter")
+        log.debug("FreeNAS_LDAP_Directory._search_pages: basedn = '%s', filter = '%s'", basedn, filter)
+        if not self._isopen:
+            return
 
-            for i in range(len(results)):
-                for entry in results[i]:
-                    result.append(entry)
+        #
+        # XXX
+        # For some reason passing attributes causes paged search results to hang/fail
+        # after a a certain numbe of pages. I can't figure out why. This is a workaround.
+        # XXX
+        #
+        attributes = None
 
-            self._cache[key] = result
+        key = self._search_key(basedn, scope, filter)
+        if cache and filter is not None and self._cache.has_key(key):
+            log.debug("FreeNAS_LDAP_Directory._search_pages: query in cache")
+            pages = self._cache[key]
+            if isinstance(pages, list):
+                yield pages
+            else:
+                for n in xrange(pages):
+                    yield self._cache["%s.%d" % (key, n)]
+            return
 
-        log.debug("FreeNAS_LDAP_Directory._search: %d results", len(result))
-        log.debug("FreeNAS_LDAP_Directory._search: leave")
-        return result
+        n = count = 0
+        start = time.time()
+        for page in self._search_ldap(basedn, scope, filter, attributes,
+            attrsonly, serverctrls, clientctrls, timeout, sizelimit):
+            if cache:
+                self._cache.write("%s.%d" % (key, n), page, overwrite=True)
+            n += 1
+            count += len(page)
+            yield page
+
+        # Expire no later than the first page
+        if cache:
+            self._cache.write(key, n, overwrite=True,
+                ttl=self._cache.ttl - (time.time() - start))
+
+        log.debug("FreeNAS_LDAP_Directory._search_pages: %d results in %d pages",
+            count, n)
+        log.debug("FreeNAS_LDAP_Directory._search_pages: leave")
+
+    def _search_iter(self, *args, **kwargs):
+        """
+        Generator of search results, (dn, attrs), page by page
+        """
+        for page in self._search_pages(*args, **kwargs):
+            for entry in page:
+                yield entry
+
+    def _search(self, *args, **kwargs):
+        if not self._isopen:
+            return None
+        return list(self._search_iter(*args, **kwargs))
 
     def search(self):
         log.debug("FreeNAS_LDAP_Directory.search: enter")
@@ -561,31 +683,39 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_LDAP_Base.get_user: leave")
         return ldap_user
 
-    def get_users(self):
-        log.debug("FreeNAS_LDAP_Base.get_users: enter")
+    def iter_users(self, changed=None):
+        """
+        Users, only those modified since the ``changed`` modifyTimestamp
+        when given
+        """
+        log.debug("FreeNAS_LDAP_Base.iter_users: enter")
         isopen = self._isopen
         self.open()
 
-        users = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(|(objectclass=person)(objectclass=account))(uid=*))'
+        if changed:
+            filter = '(&%s(modifyTimestamp>=%s))' % (filter, changed)
 
         if self.usersuffix:
             basedn = "%s,%s" % (self.usersuffix, self.basedn)
         else:
             basedn = "%s" % self.basedn
 	
-        results = self._search(_e(basedn), scope, _e(filter), self.attributes)
-        if results:
-            for r in results:
+        try:
+            for r in self._search_iter(_e(basedn), scope, _e(filter),
+                self.attributes, cache=not changed):
                 if r[0]:
-                    users.append(r)
+                    yield r
 
-        if not isopen:
-            self.close()
+        finally:
+            if not isopen:
+                self.close()
 
-        log.debug("FreeNAS_LDAP_Base.get_users: leave")
-        return users
+        log.debug("FreeNAS_LDAP_Base.iter_users: leave")
+
+    def get_users(self):
+        return list(self.iter_users())
 
     def get_group(self, group):
         log.debug("FreeNAS_LDAP_Base.get_group: enter")
@@ -625,31 +755,39 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_LDAP_Base.get_group: leave")
         return ldap_group
 
-    def get_groups(self):
-        log.debug("FreeNAS_LDAP_Base.get_groups: enter")
+    def iter_groups(self, changed=None):
+        """
+        Groups, only those modified since the ``changed`` modifyTimestamp
+        when given
+        """
+        log.debug("FreeNAS_LDAP_Base.iter_groups: enter")
         isopen = self._isopen
         self.open()
 
-        groups = []
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(objectclass=posixgroup)(gidnumber=*))'
+        if changed:
+            filter = '(&%s(modifyTimestamp>=%s))' % (filter, changed)
 
         if self.groupsuffix:
             basedn = "%s,%s" % (self.groupsuffix, self.basedn)
         else:
             basedn = "%s" % self.basedn
 	
-        results = self._search(_e(basedn), scope, _e(filter), self.attributes)
-        if results:
-            for r in results:
+        try:
+            for r in self._search_iter(_e(basedn), scope, _e(filter),
+                self.attributes, cache=not changed):
                 if r[0]:
-                    groups.append(r)
+                    yield r
 
-        if not isopen:
-            self.close()
+        finally:
+            if not isopen:
+                self.close()
 
-        log.debug("FreeNAS_LDAP_Base.get_groups: leave")
-        return groups
+        log.debug("FreeNAS_LDAP_Base.iter_groups: leave")
+
+    def get_groups(self):
+        return list(self.iter_groups())
 
 
 class FreeNAS_LDAP(FreeNAS_LDAP_Base):
@@ -1276,31 +1414,90 @@ class FreeNAS_ActiveDirectory_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_ActiveDirectory_Base.get_user: leave")
         return ad_user
 
-    def get_users(self):
-        log.debug("FreeNAS_ActiveDirectory_Base.get_users: enter")
+    def get_highest_usn(self):
+        """
+        highestCommittedUSN of the domain controller we are bound to,
+        USNs are local to each DC
+        """
+        log.debug("FreeNAS_ActiveDirectory_Base.get_highest_usn: enter")
+        isopen = self._isopen
+        self.open()
+
+        results = self._search('', ldap.SCOPE_BASE, "(objectclass=*)",
+            cache=False)
+        try:
+            results = long(results[0][1]['highestCommittedUSN'][0])
+
+        except:
+            results = None
+
+        if not isopen:
+            self.close()
+
+        log.debug("FreeNAS_ActiveDirectory_Base.get_highest_usn: leave")
+        return results
+
+    def iter_deleted(self, objectclass, changed):
+        """
+        Tombstones of ``objectclass`` objects deleted since the
+        ``changed`` USN, they keep their sAMAccountName and objectSid
+        """
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_deleted: enter")
         isopen = self._isopen
         self.open()
 
-        users = []
+        scope = ldap.SCOPE_SUBTREE
+        filter = '(&(isDeleted=TRUE)(objectclass=%s)(uSNChanged>=%d))' % (
+            objectclass, changed)
+        ctrls = [LDAPControl(LDAP_SERVER_SHOW_DELETED_OID, True, None)]
+
+        try:
+            for r in self._search_iter(_e(self.basedn), scope, _e(filter),
+                self.attributes, serverctrls=ctrls, cache=False):
+                if r[0] and r[1]:
+                    yield r
+
+        finally:
+            if not isopen:
+                self.close()
+
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_deleted: leave")
+
+    def iter_users(self, changed=None):
+        """
+        Users, only those changed since the ``changed`` USN when given
+        """
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_users: enter")
+        isopen = self._isopen
+        self.open()
+
+        count = 0
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(|(objectclass=user)(objectclass=person))(sAMAccountName=*))'
+        if changed:
+            filter = '(&%s(uSNChanged>=%d))' % (filter, changed)
         if self.attributes and 'sAMAccountType' not in self.attributes:
             self.attributes.append('sAMAccountType')
 
-        results = self._search(_e(self.basedn), scope, _e(filter), self.attributes)
-        if results:
-            for r in results:
+        try:
+            for r in self._search_iter(_e(self.basedn), scope, _e(filter),
+                self.attributes, cache=not changed):
                 if r[0] and r[1] and r[1].has_key('sAMAccountType'):
                     type = int(r[1]['sAMAccountType'][0])
                     if not (type & 0x1):
-                        users.append(r)
+                        count += 1
+                        yield r
 
-        if not isopen:
-            self.close()
+        finally:
+            if not isopen:
+                self.close()
+
+        if not changed:
+            self.ucount = count
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_users: leave")
 
-        self.ucount = len(users)
-        log.debug("FreeNAS_ActiveDirectory_Base.get_users: leave")
-        return users
+    def get_users(self):
+        return list(self.iter_users())
 
     def get_groupDN(self, group):
         log.debug("FreeNAS_ActiveDirectory_Base.get_groupDN: enter")
@@ -1357,31 +1554,41 @@ class FreeNAS_ActiveDirectory_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_ActiveDirectory_Base.get_group: leave")
         return ad_group
 
-    def get_groups(self):
-        log.debug("FreeNAS_ActiveDirectory_Base.get_groups: enter")
+    def iter_groups(self, changed=None):
+        """
+        Groups, only those changed since the ``changed`` USN when given
+        """
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_groups: enter")
         isopen = self._isopen
         self.open()
 
-        groups = []
+        count = 0
         scope = ldap.SCOPE_SUBTREE
         filter = '(&(objectclass=group)(sAMAccountName=*))'
+        if changed:
+            filter = '(&%s(uSNChanged>=%d))' % (filter, changed)
         if self.attributes and 'groupType' not in self.attributes:
             self.attributes.append('groupType')
 
-        results = self._search(_e(self.basedn), scope, _e(filter), self.attributes)
-        if results:
-            for r in results:
+        try:
+            for r in self._search_iter(_e(self.basedn), scope, _e(filter),
+                self.attributes, cache=not changed):
                 if r[0]:
                     type = int(r[1]['groupType'][0])
                     if not (type & 0x1):
-                        groups.append(r)
+                        count += 1
+                        yield r
 
-        if not isopen:
-            self.close()
+        finally:
+            if not isopen:
+                self.close()
 
-        self.ucount = len(groups)
-        log.debug("FreeNAS_ActiveDirectory_Base.get_groups: leave")
-        return groups
+        if not changed:
+            self.gcount = count
+        log.debug("FreeNAS_ActiveDirectory_Base.iter_groups: leave")
+
+    def get_groups(self):
+        return list(self.iter_groups())
 
     def get_user_count(self):
         count = 0
@@ -1393,7 +1600,8 @@ class FreeNAS_ActiveDirectory_Base(FreeNAS_LDAP_Directory):
             pagesize = self.pagesize
             self.pagesize = 32768
 
-            self.get_users()
+            for u in self.iter_users():
+                pass
 
             self.pagesize = pagesize
             count = self.ucount
@@ -1410,7 +1618,8 @@ class FreeNAS_ActiveDirectory_Base(FreeNAS_LDAP_Directory):
             pagesize = self.pagesize
             self.pagesize = 32768
 
-            self.get_groups()
+            for g in self.iter_groups():
+                pass
 
             self.pagesize = pagesize
             count = self.gcount
@@ -1438,42 +1647,28 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
             self.__ucache = FreeNAS_UserCache()
             self.__ducache = FreeNAS_Directory_UserCache()
 
+        # Whether the cache was only merged with the changes since the
+        # last refresh rather than listed in full
+        self.refreshed = False
         self.__users = []
         self.__get_users()
 
         log.debug("FreeNAS_LDAP_Users.__init__: leave")
 
     def __loaded(self, index, write=False):
-        ret = False
-
-        ucachedir = self.__ucache.cachedir
-        ducachedir = self.__ducache.cachedir
-
-        paths = {}
-        paths['u'] = os.path.join(ucachedir, ".ul")
-        paths['du'] = os.path.join(ducachedir, ".dul")
-
-        file = None
-        try:
-            file = paths[index]
-
-        except:
-            pass
-
-        if file and write:
-            try:
-                with open(file, 'w+') as f:
-                    f.close()
-                ret = True
+        caches = {
+            'u': self.__ucache,
+            'du': self.__ducache,
+        }
 
-            except:
-                ret = False
+        cache = caches.get(index)
+        if cache is None:
+            return False
 
-        elif file:
-            if os.access(file, os.F_OK):
-                ret = True
+        if write:
+            return cache.mark_loaded()
 
-        return ret
+        return cache.loaded()
 
     def __len__(self):
         return len(self.__users)
@@ -1482,9 +1677,46 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
         for user in self.__users:
             yield user
 
+    def __refresh(self):
+        """
+        Merge the users modified since the last refresh into the cache,
+        False if there is no complete cache to merge into
+        """
+        if not (self.flags & FLAGS_CACHE_WRITE_USER):
+            return False
+
+        mark = self.__ducache.watermark(self.host)
+        if mark is None or not self.__loaded('u') or not self.__loaded('du'):
+            return False
+
+        now = time.time()
+        self.attributes = ['uid']
+        self.pagesize = FREENAS_LDAP_PAGESIZE
+
+        count = _merge_changes(
+            self.__ucache,
+            self.__ducache,
+            self.iter_users(changed=mark),
+            [],
+            lambda u: str(u[0]),
+            lambda u: str(u[1]['uid'][0]),
+            PasswdResolver(sweep=False).resolve
+        )
+        self.__ducache.set_watermark(self.host, _ldap_timestamp(now))
+
+        log.debug("FreeNAS_LDAP_Users.__refresh: %d users merged", count)
+        return True
+
     def __get_users(self):
         log.debug("FreeNAS_LDAP_Users.__get_users: enter")
 
+        if (self.flags & FLAGS_CACHE_REFRESH) and self.__refresh():
+            log.debug("FreeNAS_LDAP_Users.__get_users: users refreshed")
+            log.debug("FreeNAS_LDAP_Users.__get_users: leave")
+            self.refreshed = True
+            self.__users = self.__ucache
+            return
+
         if (self.flags & FLAGS_CACHE_READ_USER) and self.__loaded('u'):
             log.debug("FreeNAS_LDAP_Users.__get_users: users in cache")
             log.debug("FreeNAS_LDAP_Users.__get_users: leave")
@@ -1500,8 +1732,12 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
 
         else:
             log.debug("FreeNAS_LDAP_Users.__get_users: LDAP users not in cache")
-            ldap_users = self.get_users()
+            ldap_users = self.iter_users()
+            if self.flags & FLAGS_CACHE_WRITE_USER:
+                self.__ducache.set_watermark(self.host,
+                    _ldap_timestamp(time.time()))
 
+        pwresolver = PasswdResolver()
         for u in ldap_users:
             CN = str(u[0])
             if self.flags & FLAGS_CACHE_WRITE_USER:
@@ -1509,10 +1745,8 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
 
             u = u[1]
             uid = str(u['uid'][0])
-            try:
-                pw = pwd.getpwnam(uid)
-
-            except:
+            pw = pwresolver.resolve(uid, u)
+            if pw is None:
                 continue
 
             self.__users.append(pw)
@@ -1534,6 +1768,9 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
 
         super(FreeNAS_ActiveDirectory_Users, self).__init__(**kwargs)
 
+        # Whether the cache of every domain was only merged with the
+        # changes since the last refresh rather than listed in full
+        self.refreshed = False
         self.__users = {}
         self.__ucache = {}
         self.__ducache = {}
@@ -1555,36 +1792,19 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
         log.debug("FreeNAS_ActiveDirectory_Users.__init__: leave")
 
     def __loaded(self, index, netbiosname, write=False):
-        ret = False
-
-        paths = {}
-        ucachedir = self.__ucache[netbiosname].cachedir
-        paths['u'] = os.path.join(ucachedir, ".ul")
-
-        ducachedir = self.__ducache[netbiosname].cachedir 
-        paths['du'] = os.path.join(ducachedir, ".dul")
-   
-        file = None
-        try:
-            file = paths[index]
-
-        except:
-            file = None
+        caches = {
+            'u': self.__ucache[netbiosname],
+            'du': self.__ducache[netbiosname],
+        }
 
-        if file and write:
-            try:
-                with open(file, 'w+') as f:
-                    f.close()
-                ret = True 
+        cache = caches.get(index)
+        if cache is None:
+            return False
 
-            except:
-                ret = False
+        if write:
+            return cache.mark_loaded()
 
-        elif file:
-            if os.access(file, os.F_OK):
-                ret = True
-
-        return ret
+        return cache.loaded()
 
     def __len__(self):
         length = 0
@@ -1597,10 +1817,52 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
             for user in self.__users[d['nETBIOSName']]:
                 yield user
 
+    def __name(self, netbiosname, sAMAccountName):
+        if self.default or self.unix:
+            return sAMAccountName
+        return str("%s%s%s" % (netbiosname, FREENAS_AD_SEPARATOR, sAMAccountName))
+
+    def __refresh(self, netbiosname):
+        """
+        Merge the users changed on the domain controller we are bound
+        to since the last refresh into the cache, False if there is no
+        complete cache to merge into
+        """
+        if not (self.flags & FLAGS_CACHE_WRITE_USER):
+            return False
+
+        ucache = self.__ucache[netbiosname]
+        ducache = self.__ducache[netbiosname]
+        mark = ducache.watermark(self.host)
+        if mark is None or not ucache.loaded() or not ducache.loaded():
+            return False
+
+        highest = self.get_highest_usn()
+        if highest is None:
+            return False
+
+        changed = long(mark) + 1
+        pwresolver = PasswdResolver(sweep=False)
+        count = _merge_changes(
+            ucache,
+            ducache,
+            self.iter_users(changed=changed),
+            self.iter_deleted('user', changed),
+            lambda u: str(u[0]),
+            lambda u: self.__name(netbiosname, u[1]['sAMAccountName'][0]),
+            lambda name, attrs: pwresolver.resolve(name)
+        )
+        ducache.set_watermark(self.host, highest)
+
+        log.debug("FreeNAS_ActiveDirectory_Users.__refresh: "
+            "AD [%s] %d users merged", netbiosname, count)
+        return True
+
     def __get_users(self):
         log.debug("FreeNAS_ActiveDirectory_Users.__get_users: enter")
 
-        if (self.flags & FLAGS_CACHE_READ_USER):
+        if (self.flags & FLAGS_CACHE_READ_USER) and \
+            not (self.flags & FLAGS_CACHE_REFRESH):
             dcount = len(self.__domains)
             count = 0
 
@@ -1616,6 +1878,8 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                 return
 
         self._save()
+        pwresolver = PasswdResolver()
+        refreshed = 0
         for d in self.__domains:
             n = d['nETBIOSName']
             self.__users[n] = []
@@ -1630,6 +1894,13 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
             self.close()
             self.open()
 
+            if (self.flags & FLAGS_CACHE_REFRESH) and self.__refresh(n):
+                log.debug("FreeNAS_ActiveDirectory_Users.__get_users: "
+                    "AD [%s] users refreshed", n)
+                self.__users[n] = self.__ucache[n]
+                refreshed += 1
+                continue
+
             if (self.flags & FLAGS_CACHE_READ_USER) and self.__loaded('du', n):
                 log.debug("FreeNAS_ActiveDirectory_Users.__get_users: "
                     "AD [%s] users in cache" % n)
@@ -1638,7 +1909,11 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
             else:
                 log.debug("FreeNAS_ActiveDirectory_Users.__get_users: "
                     "AD [%s] users not in cache" % n)
-                ad_users = self.get_users()
+                if self.flags & FLAGS_CACHE_WRITE_USER:
+                    highest = self.get_highest_usn()
+                    if highest is not None:
+                        self.__ducache[n].set_watermark(self.host, highest)
+                ad_users = self.iter_users()
 
             for u in ad_users:
                 CN = str(u[0])
@@ -1647,15 +1922,9 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                     self.__ducache[n][CN] = u
 
                 u = u[1]
-                if self.default or self.unix:
-                    sAMAccountName = u['sAMAccountName'][0]
-                else:
-                    sAMAccountName = str("%s%s%s" % (n, FREENAS_AD_SEPARATOR, u['sAMAccountName'][0]))
-                try:
-                    pw = pwd.getpwnam(sAMAccountName)
-
-                except Exception, e:
-                    log.debug("Error on getpwnam: %s", e)
+                sAMAccountName = self.__name(n, u['sAMAccountName'][0])
+                pw = pwresolver.resolve(sAMAccountName)
+                if pw is None:
                     continue
 
                 self.__users[n].append(pw)
@@ -1668,6 +1937,7 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                 self.__loaded('u', n, True)
                 self.__loaded('du', n, True)
 
+        self.refreshed = refreshed > 0 and refreshed == len(self.__domains)
         self._restore()
         log.debug("FreeNAS_ActiveDirectory_Users.__get_users: leave")
 
@@ -1702,42 +1972,28 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
             self.__gcache = FreeNAS_GroupCache()
             self.__dgcache = FreeNAS_Directory_GroupCache()
 
+        # Whether the cache was only merged with the changes since the
+        # last refresh rather than listed in full
+        self.refreshed = False
         self.__groups = []
         self.__get_groups()
 
         log.debug("FreeNAS_LDAP_Groups.__init__: leave")
 
     def __loaded(self, index, write=False):
-        ret = False
-
-        gcachedir = self.__gcache.cachedir
-        dgcachedir = self.__dgcache.cachedir
-
-        paths = {}
-        paths['g'] = os.path.join(gcachedir, ".gl")
-        paths['dg'] = os.path.join(dgcachedir, ".dgl")
-
-        file = None
-        try:
-            file = paths[index]
-
-        except:
-            pass
-
-        if file and write:
-            try:
-                with open(file, 'w+') as f:
-                    f.close()
-                ret = True
+        caches = {
+            'g': self.__gcache,
+            'dg': self.__dgcache,
+        }
 
-            except:
-                ret = False
+        cache = caches.get(index)
+        if cache is None:
+            return False
 
-        elif file:
-            if os.access(file, os.F_OK):
-                ret = True
+        if write:
+            return cache.mark_loaded()
 
-        return ret
+        return cache.loaded()
 
     def __len__(self):
         return len(self.__groups)
@@ -1746,9 +2002,45 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
         for group in self.__groups:
             yield group
 
+    def __refresh(self):
+        """
+        Merge the groups modified since the last refresh into the cache,
+        False if there is no complete cache to merge into
+        """
+        if not (self.flags & FLAGS_CACHE_WRITE_GROUP):
+            return False
+
+        mark = self.__dgcache.watermark(self.host)
+        if mark is None or not self.__loaded('g') or not self.__loaded('dg'):
+            return False
+
+        now = time.time()
+        self.attributes = ['cn']
+
+        count = _merge_changes(
+            self.__gcache,
+            self.__dgcache,
+            self.iter_groups(changed=mark),
+            [],
+            lambda g: str(g[0]),
+            lambda g: str(g[1]['cn'][0]),
+            GroupResolver(sweep=False).resolve
+        )
+        self.__dgcache.set_watermark(self.host, _ldap_timestamp(now))
+
+        log.debug("FreeNAS_LDAP_Groups.__refresh: %d groups merged", count)
+        return True
+
     def __get_groups(self):
         log.debug("FreeNAS_LDAP_Groups.__get_groups: enter")
 
+        if (self.flags & FLAGS_CACHE_REFRESH) and self.__refresh():
+            log.debug("FreeNAS_LDAP_Groups.__get_groups: groups refreshed")
+            log.debug("FreeNAS_LDAP_Groups.__get_groups: leave")
+            self.refreshed = True
+            self.__groups = self.__gcache
+            return
+
         if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('g'):
             log.debug("FreeNAS_LDAP_Groups.__get_groups: groups in cache")
             log.debug("FreeNAS_LDAP_Groups.__get_groups: leave")
@@ -1764,8 +2056,12 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
 
         else:
             log.debug("FreeNAS_LDAP_Groups.__get_groups: LDAP groups not in cache")
-            ldap_groups = self.get_groups()
+            ldap_groups = self.iter_groups()
+            if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                self.__dgcache.set_watermark(self.host,
+                    _ldap_timestamp(time.time()))
 
+        grresolver = GroupResolver()
         for g in ldap_groups:
             CN = str(g[0])
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
@@ -1773,10 +2069,8 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
 
             g = g[1]
             cn = str(g['cn'][0])
-            try:
-                gr = grp.getgrnam(cn)
-
-            except:
+            gr = grresolver.resolve(cn, g)
+            if gr is None:
                 continue
 
             self.__groups.append(gr)
@@ -1799,6 +2093,9 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
 
         super(FreeNAS_ActiveDirectory_Groups, self).__init__(**kwargs)
 
+        # Whether the cache of every domain was only merged with the
+        # changes since the last refresh rather than listed in full
+        self.refreshed = False
         self.__groups = {}
         self.__gcache = {}
         self.__dgcache = {}
@@ -1820,36 +2117,19 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
         log.debug("FreeNAS_ActiveDirectory_Groups.__init__: leave")
 
     def __loaded(self, index, netbiosname=None, write=False):
-        ret = False
-
-        paths = {}
-        gcachedir = self.__gcache[netbiosname].cachedir
-        paths['g'] = os.path.join(gcachedir, ".gl")
-
-        dgcachedir = self.__dgcache[netbiosname].cachedir 
-        paths['dg'] = os.path.join(dgcachedir, ".dgl")
-   
-        file = None
-        try:
-            file = paths[index]
-
-        except:
-            file = None
-
-        if file and write:
-            try:
-                with open(file, 'w+') as f:
-                    f.close()
-                ret = True 
+        caches = {
+            'g': self.__gcache[netbiosname],
+            'dg': self.__dgcache[netbiosname],
+        }
 
-            except:
-                ret = False
+        cache = caches.get(index)
+        if cache is None:
+            return False
 
-        elif file:
-            if os.access(file, os.F_OK):
-                ret = True
+        if write:
+            return cache.mark_loaded()
 
-        return ret
+        return cache.loaded()
 
     def __len__(self):
         length = 0
@@ -1862,16 +2142,60 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
             for group in self.__groups[d['nETBIOSName']]:
                 yield group
 
+    def __name(self, netbiosname, sAMAccountName):
+        if self.default or self.unix:
+            return sAMAccountName
+        return str("%s%s%s" % (netbiosname, FREENAS_AD_SEPARATOR, sAMAccountName))
+
+    def __refresh(self, netbiosname):
+        """
+        Merge the groups changed on the domain controller we are bound
+        to since the last refresh into the cache, False if there is no
+        complete cache to merge into
+        """
+        if not (self.flags & FLAGS_CACHE_WRITE_GROUP):
+            return False
+
+        gcache = self.__gcache[netbiosname]
+        dgcache = self.__dgcache[netbiosname]
+        mark = dgcache.watermark(self.host)
+        if mark is None or not gcache.loaded() or not dgcache.loaded():
+            return False
+
+        highest = self.get_highest_usn()
+        if highest is None:
+            return False
+
+        changed = long(mark) + 1
+        grresolver = GroupResolver(sweep=False)
+        key = lambda g: self.__name(netbiosname,
+            g[1]['sAMAccountName'][0]).upper()
+        count = _merge_changes(
+            gcache,
+            dgcache,
+            self.iter_groups(changed=changed),
+            self.iter_deleted('group', changed),
+            key,
+            key,
+            lambda name, attrs: grresolver.resolve(name)
+        )
+        dgcache.set_watermark(self.host, highest)
+
+        log.debug("FreeNAS_ActiveDirectory_Groups.__refresh: "
+            "AD [%s] %d groups merged", netbiosname, count)
+        return True
+
     def __get_groups(self):
         log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: enter")
 
-        if (self.flags & FLAGS_CACHE_READ_GROUP):
+        if (self.flags & FLAGS_CACHE_READ_GROUP) and \
+            not (self.flags & FLAGS_CACHE_REFRESH):
             dcount = len(self.__domains)
             count = 0
 
             for d in self.__domains:
                 n = d['nETBIOSName']
-                if self.__loaded('u', n):
+                if self.__loaded('g', n):
                     self.__groups[n] = self.__gcache[n]
                     count += 1
 
@@ -1881,6 +2205,8 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                 return
 
         self._save()
+        grresolver = GroupResolver()
+        refreshed = 0
         for d in self.__domains:
             n = d['nETBIOSName']
             self.__groups[n] = []
@@ -1895,6 +2221,13 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
             self.close()
             self.open()
 
+            if (self.flags & FLAGS_CACHE_REFRESH) and self.__refresh(n):
+                log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: "
+                    "AD [%s] groups refreshed", n)
+                self.__groups[n] = self.__gcache[n]
+                refreshed += 1
+                continue
+
             if (self.flags & FLAGS_CACHE_READ_GROUP) and self.__loaded('dg', n):
                 log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: "
                     "AD [%s] groups in cache", n)
@@ -1903,24 +2236,20 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
             else:
                 log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: "
                     "AD [%s] groups not in cache", n)
-                ad_groups = self.get_groups()
+                if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                    highest = self.get_highest_usn()
+                    if highest is not None:
+                        self.__dgcache[n].set_watermark(self.host, highest)
+                ad_groups = self.iter_groups()
 
             for g in ad_groups:
-
-                if self.default or self.unix:
-                    sAMAccountName = g[1]['sAMAccountName'][0]
-                else:
-                    sAMAccountName = str("%s%s%s" % (n, FREENAS_AD_SEPARATOR, g[1][
-'sAMAccountName'][0]))
+                sAMAccountName = self.__name(n, g[1]['sAMAccountName'][0])
 
                 if self.flags & FLAGS_CACHE_WRITE_GROUP:
                     self.__dgcache[n][sAMAccountName.upper()] = g
 
-                try:
-                    gr = grp.getgrnam(sAMAccountName)
-
-                except Exception as e:
-                    log.debug("Error on getgrnam: %s", e)
+                gr = grresolver.resolve(sAMAccountName)
+                if gr is None:
                     continue
 
                 self.__groups[n].append(gr)
@@ -1933,6 +2262,7 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                 self.__loaded('g', n, True)
                 self.__loaded('dg', n, True)
 
+        self.refreshed = refreshed > 0 and refreshed == len(self.__domains)
         self._restore()
         log.debug("FreeNAS_ActiveDirectory_Groups.__get_groups: leave")
 
@@ -27,6 +27,7 @@
 import logging
 
 from freenasUI.common.acl import *
+from freenasUI.common.acltree import ACL_TYPE_NFS4
 
 log = logging.getLogger('common.freenasnfsv4')
 
@@ -537,6 +538,8 @@ class NFSv4_ACL(Base_ACL):
 
 class NFSv4_ACL_Hierarchy(Base_ACL_Hierarchy):
 
+    acl_type_np = ACL_TYPE_NFS4
+
     def _set_windows_file_defaults(self, acl):
         log.debug("NFSv4_ACL_Hierarchy._set_windows_file_defaults: enter")
         log.debug("NFSv4_ACL_Hierarchy._set_windows_file_defaults: acl = %s",
@@ -30,6 +30,7 @@ import os
 import pwd
 
 from freenasUI.common.freenascache import *
+from freenasUI.common.identity import PasswdResolver, GroupResolver
 from freenasUI.common.cmd import cmd_pipe
 
 log = logging.getLogger('common.freenasnis')
@@ -205,36 +206,19 @@ class FreeNAS_NIS_Users(FreeNAS_NIS):
         log.debug("FreeNAS_NIS_Users.__init__: leave")
 
     def __loaded(self, index, domain, write=False):
-        ret = False
+        caches = {
+            'u': self.__ucache[domain],
+            'du': self.__ducache[domain],
+        }
 
-        paths = {}
-        ucachedir = self.__ucache[domain].cachedir
-        paths['u'] = os.path.join(ucachedir, ".ul")
+        cache = caches.get(index)
+        if cache is None:
+            return False
 
-        ducachedir = self.__ducache[domain].cachedir
-        paths['du'] = os.path.join(ducachedir, ".dul")
+        if write:
+            return cache.mark_loaded()
 
-        file = None
-        try:
-            file = paths[index]
-
-        except:
-            file = None
-
-        if file and write:
-            try:
-                with open(file, 'w+') as f:
-                    f.close()
-                ret = True
-
-            except:
-                ret = False
-
-        elif file:
-            if os.access(file, os.F_OK):
-                ret = True
-
-        return ret
+        return cache.loaded()
 
     def __get_users(self):
         log.debug("FreeNAS_NIS_Users.__get_users: enter")
@@ -254,6 +238,7 @@ class FreeNAS_NIS_Users(FreeNAS_NIS):
                 return
 
         self._save()
+        pwresolver = PasswdResolver()
         for d in self.__domains:
             self.__users[d] = []
 
@@ -273,11 +258,8 @@ class FreeNAS_NIS_Users(FreeNAS_NIS):
                 if self.flags & FLAGS_CACHE_WRITE_USER:
                     self.__ducache[d][uid] = u
 
-                try:
-                    pw = pwd.getpwnam(uid)
-
-                except Exception, e:
-                    log.debug("Error on getpwname: %s",  e)
+                pw = pwresolver.resolve(uid, u)
+                if pw is None:
                     continue
 
                 self.__users[d].append(pw)
@@ -332,36 +314,19 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
         log.debug("FreeNAS_NIS_Groups.__init__: leave")
 
     def __loaded(self, index, domain=None, write=False):
-        ret = False
+        caches = {
+            'g': self.__gcache[domain],
+            'dg': self.__dgcache[domain],
+        }
 
-        paths = {}
-        gcachedir = self.__gcache[domain].cachedir
-        paths['g'] = os.path.join(gcachedir, ".gl")
+        cache = caches.get(index)
+        if cache is None:
+            return False
 
-        dgcachedir = self.__dgcache[domain].cachedir
-        paths['dg'] = os.path.join(dgcachedir, ".dgl")
+        if write:
+            return cache.mark_loaded()
 
-        file = None
-        try:
-            file = paths[index]
-
-        except:
-            file = None
-
-        if file and write:
-            try:
-                with open(file, 'w+') as f:
-                    f.close()
-                ret = True
-
-            except:
-                ret = False
-
-        elif file:
-            if os.access(file, os.F_OK):
-                ret = True
-
-        return ret
+        return cache.loaded()
 
     def __get_groups(self):
         log.debug("FreeNAS_NIS_Groups.__get_groups: enter")
@@ -381,6 +346,7 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
                 return
 
         self._save()
+        grresolver = GroupResolver()
         for d in self.__domains:
             self.__groups[d] = []
 
@@ -400,10 +366,8 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
                 if self.flags & FLAGS_CACHE_WRITE_GROUP:
                     self.__dgcache[d][group.upper()] = g
 
-                try:
-                    gr = grp.getgrnam(group)
-
-                except:
+                gr = grresolver.resolve(group, g)
+                if gr is None:
                     continue
 
                 self.__groups[d].append(gr)
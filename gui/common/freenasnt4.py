@@ -30,6 +30,7 @@ import os
 import pwd
 
 from freenasUI.common.freenascache import *
+from freenasUI.common.identity import PasswdResolver, GroupResolver
 from freenasUI.common.cmd import cmd_pipe
 
 log = logging.getLogger('common.freenasnt4')
@@ -244,36 +245,19 @@ class FreeNAS_NT4_Users(FreeNAS_NT4):
         log.debug("FreeNAS_NT4_Users.__init__: leave")
 
     def __loaded(self, index, domain, write=False):
-        ret = False
+        caches = {
+            'u': self.__ucache[domain],
+            'du': self.__ducache[domain],
+        }
 
-        paths = {}
-        ucachedir = self.__ucache[domain].cachedir
-        paths['u'] = os.path.join(ucachedir, ".ul")
+        cache = caches.get(index)
+        if cache is None:
+            return False
 
-        ducachedir = self.__ducache[domain].cachedir
-        paths['du'] = os.path.join(ducachedir, ".dul")
+        if write:
+            return cache.mark_loaded()
 
-        file = None
-        try:
-            file = paths[index]
-
-        except: 
-            file = None
-
-        if file and write:
-            try:
-                with open(file, 'w+') as f:
-                    f.close()
-                ret = True
-
-            except:
-                ret = False
-
-        elif file:
-            if os.access(file, os.F_OK):
-                ret = True
-
-        return ret
+        return cache.loaded()
 
     def __get_users(self):
         log.debug("FreeNAS_NT4_Users.__get_users: enter")
@@ -293,6 +277,7 @@ class FreeNAS_NT4_Users(FreeNAS_NT4):
                 return 
 
         self._save()
+        pwresolver = PasswdResolver()
         for d in self.__domains:
             self.__users[d] = []
 
@@ -313,11 +298,8 @@ class FreeNAS_NT4_Users(FreeNAS_NT4):
                     self.__ducache[d][uid] = u
 
                 sAMAccountName = u['sAMAccountName']
-                try:
-                    pw = pwd.getpwnam(sAMAccountName)
-
-                except Exception, e:
-                    log.debug("Error on getpwname: %s",  e)
+                pw = pwresolver.resolve(sAMAccountName)
+                if pw is None:
                     continue
 
                 self.__users[d].append(pw) 
@@ -371,36 +353,19 @@ class FreeNAS_NT4_Groups(FreeNAS_NT4):
         log.debug("FreeNAS_NT4_Groups.__init__: leave")
 
     def __loaded(self, index, domain=None, write=False):
-        ret = False
+        caches = {
+            'g': self.__gcache[domain],
+            'dg': self.__dgcache[domain],
+        }
 
-        paths = {}
-        gcachedir = self.__gcache[domain].cachedir
-        paths['g'] = os.path.join(gcachedir, ".gl")
+        cache = caches.get(index)
+        if cache is None:
+            return False
 
-        dgcachedir = self.__dgcache[domain].cachedir
-        paths['dg'] = os.path.join(dgcachedir, ".dgl")
+        if write:
+            return cache.mark_loaded()
 
-        file = None
-        try:
-            file = paths[index]
-
-        except:
-            file = None
-
-        if file and write:
-            try:
-                with open(file, 'w+') as f:
-                    f.close()
-                ret = True
-
-            except:
-                ret = False
-
-        elif file:
-            if os.access(file, os.F_OK):
-                ret = True
-
-        return ret
+        return cache.loaded()
 
     def __len__(self):
         length = 0
@@ -431,6 +396,7 @@ class FreeNAS_NT4_Groups(FreeNAS_NT4):
                 return
 
         self._save()
+        grresolver = GroupResolver()
         for d in self.__domains:
             self.__groups[d] = []
 
@@ -450,10 +416,8 @@ class FreeNAS_NT4_Groups(FreeNAS_NT4):
                 if self.flags & FLAGS_CACHE_WRITE_GROUP:
                     self.__dgcache[d][sAMAccountName.upper()] = g
 
-                try:
-                    gr = grp.getgrnam(sAMAccountName)
-
-                except:
+                gr = grresolver.resolve(sAMAccountName)
+                if gr is None:
                     continue
 
                 self.__groups[d].append(gr)
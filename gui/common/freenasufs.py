@@ -29,6 +29,7 @@ import logging
 from freenasUI.common.acl import (Base_ACL_Exception, Base_ACL_pipe,
     Base_ACL_getfacl, Base_ACL_setfacl, Base_ACL_Hierarchy, Base_ACL_Entry,
     Base_ACL)
+from freenasUI.common.acltree import ACL_TYPE_ACCESS
 
 log = logging.getLogger('commnon.freenasufs')
 
@@ -339,6 +340,8 @@ class POSIX_ACL(Base_ACL):
 
 class POSIX_ACL_Hierarchy(Base_ACL_Hierarchy):
 
+    acl_type_np = ACL_TYPE_ACCESS
+
     def _set_windows_file_defaults(self, acl):
         pass
 
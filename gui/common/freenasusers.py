@@ -30,6 +30,15 @@ import pwd
 import sqlite3
 import types
 
+from freenasUI.common.freenascache import (
+    FLAGS_CACHE_READ_USER,
+    FLAGS_CACHE_WRITE_USER,
+    FLAGS_CACHE_READ_GROUP,
+    FLAGS_CACHE_WRITE_GROUP,
+    FLAGS_CACHE_REFRESH,
+    FreeNAS_UserCache,
+    FreeNAS_GroupCache
+)
 from freenasUI.common.system import (
     activedirectory_enabled,
     domaincontroller_enabled,
@@ -98,6 +107,24 @@ def _get_dflags():
     return dflags
 
 
+def _unique(entries, attr):
+    """
+    Cached passwd/group entries, first one of each name wins as the
+    same entry may be cached both per domain and for the whole backend
+    """
+    seen = set()
+    unique = []
+    for entry in entries:
+        if not hasattr(entry, attr):
+            continue
+        name = getattr(entry, attr)
+        if name in seen:
+            continue
+        seen.add(name)
+        unique.append(entry)
+    return unique
+
+
 def bsdUsers_objects(**kwargs):
     h = sqlite3.connect(FREENAS_DATABASE)
     h.row_factory = sqlite3.Row
@@ -294,7 +321,18 @@ class FreeNAS_Groups(object):
         elif dflags & U_DC_ENABLED:
             dir = FreeNAS_DomainController_Groups
 
-        if dir is not None:
+        flags = kwargs.get('flags', 0)
+        gcache = None
+        if dir is not None and \
+            flags & (FLAGS_CACHE_READ_GROUP | FLAGS_CACHE_WRITE_GROUP):
+            gcache = FreeNAS_GroupCache()
+
+        if gcache is not None and (flags & FLAGS_CACHE_READ_GROUP) and \
+            not (flags & FLAGS_CACHE_REFRESH) and gcache.loaded(subtree=True):
+            log.debug("FreeNAS_Groups.__init__: directory groups in cache")
+            self.__groups = _unique(gcache.walk(), 'gr_name')
+
+        elif dir is not None:
             try:
                 self.__groups = dir(**kwargs)
 
@@ -302,6 +340,14 @@ class FreeNAS_Groups(object):
                 log.error("Directory Groups could not be retrieved: %s", str(e))
                 self.__groups = None
 
+            # A refresh that only merged changes leaves the listing as
+            # old as the last full fill, one that fell back to a full
+            # fill (no complete cache or watermark yet) does not
+            if gcache is not None and self.__groups is not None and \
+                (flags & FLAGS_CACHE_WRITE_GROUP) and \
+                not getattr(self.__groups, 'refreshed', False):
+                gcache.mark_loaded(subtree=True)
+
         if self.__groups is None:
             self.__groups = []
 
@@ -433,7 +479,18 @@ class FreeNAS_Users(object):
         elif dflags & U_DC_ENABLED:
             dir = FreeNAS_DomainController_Users
 
-        if dir is not None:
+        flags = kwargs.get('flags', 0)
+        ucache = None
+        if dir is not None and \
+            flags & (FLAGS_CACHE_READ_USER | FLAGS_CACHE_WRITE_USER):
+            ucache = FreeNAS_UserCache()
+
+        if ucache is not None and (flags & FLAGS_CACHE_READ_USER) and \
+            not (flags & FLAGS_CACHE_REFRESH) and ucache.loaded(subtree=True):
+            log.debug("FreeNAS_Users.__init__: directory users in cache")
+            self.__users = _unique(ucache.walk(), 'pw_name')
+
+        elif dir is not None:
             try:
                 self.__users = dir(**kwargs)
 
@@ -441,6 +498,14 @@ class FreeNAS_Users(object):
                 log.error("Directory Users could not be retrieved: %s", str(e))
                 self.__users = None
 
+            # A refresh that only merged changes leaves the listing as
+            # old as the last full fill, one that fell back to a full
+            # fill (no complete cache or watermark yet) does not
+            if ucache is not None and self.__users is not None and \
+                (flags & FLAGS_CACHE_WRITE_USER) and \
+                not getattr(self.__users, 'refreshed', False):
+                ucache.mark_loaded(subtree=True)
+
         if self.__users is None:
             self.__users = []
 
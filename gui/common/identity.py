@@ -0,0 +1,177 @@
+#+
+# Copyright 2013 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# $FreeBSD$
+#####################################################################
+import grp
+import logging
+import pwd
+
+log = logging.getLogger('common.identity')
+
+
+def _attr(attrs, key):
+    """
+    Value of a directory attribute, LDAP returns lists of values
+    """
+    value = attrs.get(key)
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    return value
+
+
+class IdentityResolver(object):
+    """
+    Resolve many names to pwd/grp records at once
+
+    Directory enumerations used to call getpwnam/getgrnam for every
+    entry, each call being a round trip through nsswitch (winbind,
+    nslcd...). Instead records are:
+
+        - built from the attributes the directory already returned,
+          when they are complete (NIS maps, posixAccount entries);
+        - taken from a single getpwall/getgrall sweep;
+        - looked up one by one only for names the sweep missed
+          (e.g. winbind with enumeration disabled).
+    """
+
+    _getall = None
+    _getnam = None
+
+    def __init__(self, sweep=True):
+        self.sweep = sweep
+        self.__records = None
+        self.__folded = None
+        self.built = 0
+        self.swept = 0
+        self.missed = 0
+
+    def _sweep(self):
+        self.__records = {}
+        self.__folded = {}
+        try:
+            records = self._getall()
+        except Exception, e:
+            log.debug("IdentityResolver._sweep: %s", e)
+            records = []
+
+        for record in records:
+            self.__records.setdefault(record[0], record)
+            self.__folded.setdefault(record[0].lower(), record)
+
+        log.debug("IdentityResolver._sweep: %d records", len(self.__records))
+
+    def _build(self, name, attrs):
+        return None
+
+    def resolve(self, name, attrs=None):
+        """
+        Record of ``name``, None if it does not exist
+        """
+        if attrs:
+            record = self._build(name, attrs)
+            if record is not None:
+                self.built += 1
+                return record
+
+        if self.__records is None:
+            if self.sweep:
+                self._sweep()
+            else:
+                # A handful of names, not worth enumerating everything
+                self.__records = {}
+                self.__folded = {}
+
+        record = self.__records.get(name)
+        if record is None:
+            record = self.__folded.get(name.lower())
+        if record is not None:
+            self.swept += 1
+            return record
+
+        self.missed += 1
+        try:
+            record = self._getnam(name)
+        except KeyError:
+            return None
+
+        self.__records[name] = record
+        return record
+
+    def stats(self):
+        return "%d built, %d swept, %d missed" % (
+            self.built, self.swept, self.missed
+        )
+
+
+class PasswdResolver(IdentityResolver):
+
+    _getall = staticmethod(pwd.getpwall)
+    _getnam = staticmethod(pwd.getpwnam)
+
+    def _build(self, name, attrs):
+        uid = _attr(attrs, 'uidNumber')
+        gid = _attr(attrs, 'gidNumber')
+        home = _attr(attrs, 'homeDirectory')
+        if uid is None or gid is None or home is None:
+            return None
+
+        try:
+            return pwd.struct_passwd((
+                name,
+                '*',
+                int(uid),
+                int(gid),
+                _attr(attrs, 'gecos') or '',
+                home,
+                _attr(attrs, 'loginShell') or '',
+            ))
+        except ValueError:
+            return None
+
+
+class GroupResolver(IdentityResolver):
+
+    _getall = staticmethod(grp.getgrall)
+    _getnam = staticmethod(grp.getgrnam)
+
+    def _build(self, name, attrs):
+        gid = _attr(attrs, 'gidNumber')
+        if gid is None:
+            return None
+
+        members = attrs.get('members', attrs.get('memberUid', []))
+        if isinstance(members, basestring):
+            members = [m for m in members.split(',') if m]
+
+        try:
+            return grp.struct_group((
+                name,
+                '*',
+                int(gid),
+                list(members),
+            ))
+        except ValueError:
+            return None
@@ -83,3 +83,18 @@ class MountLock:
 
 # Quick and dirty backwards compatibility.
 mntlock = MountLock
+
+
+class FileLock(MountLock):
+    """A mutex backed by a lock file, for serializing tasks working on
+       the same resource (e.g. a dataset) without holding up the others."""
+    def __init__(self, path, blocking=True):
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        # Don't spread lock file descriptors to child processes.
+        flags = fcntl.FD_CLOEXEC | fcntl.fcntl(self._fd, fcntl.F_GETFD)
+        fcntl.fcntl(self._fd, fcntl.F_SETFD, flags)
+        if blocking:
+            self.__enter__ = self.lock
+        else:
+            self.__enter__ = self.lock_try
@@ -0,0 +1,138 @@
+#+
+# Copyright 2013 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# $FreeBSD$
+#####################################################################
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+import time
+
+log = logging.getLogger('common.probe')
+
+# Maximum number of addresses probed at the same time
+PROBE_WORKERS = 16
+# Seconds an address found in use is not probed again
+PROBE_INUSE_TTL = 30
+
+
+def probe_host(candidate):
+    """
+    Host part of a candidate address (sipcalc type or address/mask string)
+    """
+    return str(candidate).split('/')[0]
+
+
+class AddressProbe(object):
+    """
+    Find the first free address out of a list of candidates
+
+    Candidates are probed concurrently, at most ``workers`` at a time,
+    through a pluggable ``backend(host, ping6)`` callable returning
+    whether the host answered (e.g. ping_host). Results are still
+    considered in the order of the candidates, so the address returned
+    is the same a sequential scan would have found.
+
+    Addresses found in use are remembered for ``ttl`` seconds and are
+    skipped without being probed again.
+    """
+
+    def __init__(self, backend, workers=PROBE_WORKERS, ttl=PROBE_INUSE_TTL):
+        self.backend = backend
+        self.workers = workers
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # host -> time it was found in use
+        self._inuse = {}
+
+    def in_use(self, host):
+        with self._lock:
+            found = self._inuse.get(host)
+            if found is None:
+                return False
+            if time.time() - found < self.ttl:
+                return True
+            del self._inuse[host]
+            return False
+
+    def forget(self, host=None):
+        with self._lock:
+            if host is None:
+                self._inuse.clear()
+            else:
+                self._inuse.pop(host, None)
+
+    def alive(self, host, ping6=False):
+        if self.in_use(host):
+            return True
+        try:
+            alive = self.backend(host, ping6)
+        except Exception, e:
+            # Never hand out an address we could not check
+            log.warn("Failed to probe %s: %s", host, e)
+            alive = True
+        if alive:
+            with self._lock:
+                self._inuse[host] = time.time()
+        return alive
+
+    def first_free(self, candidates, ping6=False, host=probe_host):
+        """
+        First candidate whose address did not answer, None if all of
+        them are in use.
+
+        ``host(candidate)`` returns the address to probe.
+        """
+        # Known in use addresses do not take a probe slot
+        pending = (
+            (c, host(c)) for c in candidates if not self.in_use(host(c))
+        )
+
+        pool = None
+        try:
+            while True:
+                window = list(islice(pending, self.workers))
+                if not window:
+                    return None
+
+                hosts = [h for c, h in window]
+                if len(window) == 1:
+                    results = [self.alive(hosts[0], ping6)]
+                else:
+                    if pool is None:
+                        pool = ThreadPool(self.workers)
+                    results = pool.map(
+                        lambda h: self.alive(h, ping6),
+                        hosts,
+                    )
+
+                for (candidate, h), alive in zip(window, results):
+                    if not alive:
+                        return candidate
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
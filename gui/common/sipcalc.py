@@ -25,56 +25,197 @@
 #
 # $FreeBSD$
 #####################################################################
-import string
+import binascii
+import re
+import socket
 
 from freenasUI.common.pipesubr import pipeopen
 
-SIPCALC_PATH = "/usr/local/bin/sipcalc"
+IFCONFIG_PATH = "/sbin/ifconfig"
+
+IPV4_MAX = (1 << 32) - 1
+IPV6_MAX = (1 << 128) - 1
+
+
+def _ipv4_to_decimal(addr):
+    octets = addr.split('.')
+    if len(octets) != 4:
+        return None
+
+    num = 0
+    for octet in octets:
+        if not octet.isdigit() or int(octet) > 255:
+            return None
+        num = (num << 8) | int(octet)
+
+    return num
+
+
+def _decimal_to_ipv4(num):
+    return "%d.%d.%d.%d" % (
+        (num >> 24) & 0xff,
+        (num >> 16) & 0xff,
+        (num >> 8) & 0xff,
+        (num >> 0) & 0xff,
+    )
+
+
+def _ipv4_mask_bits(mask):
+    """
+    Number of bits of a netmask given as bits, dotted quad or hex
+    """
+    if mask.isdigit():
+        bits = int(mask)
+        return bits if bits <= 32 else None
+
+    if mask.lower().startswith('0x'):
+        try:
+            num = int(mask, 16)
+        except ValueError:
+            return None
+    else:
+        num = _ipv4_to_decimal(mask)
+
+    if num is None or num > IPV4_MAX:
+        return None
+
+    bits = bin(num)[2:].zfill(32).rstrip('0')
+    if '0' in bits:
+        # Not a contiguous mask
+        return None
+
+    return len(bits)
+
+
+def _ipv6_to_decimal(addr):
+    addr = addr.split('%')[0]
+    try:
+        return int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, addr)), 16)
+    except (socket.error, ValueError):
+        return None
+
+
+def _decimal_to_ipv6(num, expanded=True):
+    groups = [(num >> shift) & 0xffff for shift in xrange(112, -16, -16)]
+    if expanded:
+        return ':'.join(["%04x" % group for group in groups])
+    return ':'.join(["%x" % group for group in groups])
+
+
+def _ipv6_address_type(num):
+    if num == 0:
+        return "Unspecified Address"
+    elif num == 1:
+        return "Loopback Address"
+    elif num >> 32 == 0xffff:
+        return "IPv4-mapped IPv6 Address"
+    elif num >> 125 == 0x1:
+        return "Aggregatable Global Unicast Addresses"
+    elif num >> 118 == 0x3fa:
+        return "Link-Local Unicast Addresses"
+    elif num >> 118 == 0x3fb:
+        return "Site-Local Unicast Addresses"
+    elif num >> 121 == 0x7e:
+        return "Unique Local Unicast Addresses"
+    elif num >> 120 == 0xff:
+        return "Multicast Addresses"
+    return "Reserved"
+
+
+def _iface_address(iface):
+    """
+    First IPv4 address of an interface as address/netmask
+    """
+    p1 = pipeopen(
+        "%s %s" % (IFCONFIG_PATH, iface),
+        allowfork=True,
+        important=False,
+    )
+    out = p1.communicate()[0]
+    if p1.returncode != 0 or not out:
+        return None
+
+    reg = re.search(r'^\s+inet (\S+) netmask (\S+)', out, re.M)
+    if not reg:
+        return None
+
+    return "%s/%s" % (reg.group(1), reg.group(2))
+
+
+def _parse(args):
+    """
+    Parse sipcalc style arguments, an address with an optional netmask
+    either as address/mask or as a second argument.
+
+    Returns:
+        tuple(version, decimal address, mask bits) or None if invalid
+    """
+    if not args:
+        return None
+
+    addr = args[0].strip()
+    mask = args[1].strip() if len(args) > 1 else None
+    if '/' in addr:
+        addr, mask = addr.split('/', 1)
+
+    if ':' in addr:
+        num = _ipv6_to_decimal(addr)
+        if num is None:
+            return None
+        if not mask:
+            bits = 128
+        elif mask.isdigit() and int(mask) <= 128:
+            bits = int(mask)
+        else:
+            return None
+        return (6, num, bits)
+
+    num = _ipv4_to_decimal(addr)
+    if num is None:
+        return None
+    bits = _ipv4_mask_bits(mask) if mask else 32
+    if bits is None:
+        return None
+    return (4, num, bits)
+
+
+def _to_sipcalc(addr):
+    if isinstance(addr, sipcalc_base_type):
+        return addr
+    return sipcalc_type(addr)
 
 
 class sipcalc_base_type(object):
     def __init__(self, *args, **kwargs):
-        self.sipcalc = SIPCALC_PATH
         self.args = args
         self.iface = None
 
-        self.sipcalc_args = [self.sipcalc]
-        for arg in args:
-            self.sipcalc_args.append(str(arg))
+        sipcalc_args = [str(arg) for arg in args]
 
         network = kwargs.get('network', None)
         if network:
-            self.sipcalc_args.append(str(network))
+            sipcalc_args.append(str(network))
 
         iface = kwargs.get('iface', None)
         if iface:
-            self.sipcalc_args.append(str(iface))
             self.iface = iface
-
-        p1 = pipeopen(
-            string.join(self.sipcalc_args, ' '),
-            allowfork=True,
-            important=False,
-        )
-        self.sipcalc_out = p1.communicate()
-        if self.sipcalc_out:
-            self.sipcalc_out = self.sipcalc_out[0]
-            if self.sipcalc_out:
-                self.sipcalc_out = self.sipcalc_out.split('\n')
+            address = _iface_address(iface)
+            if address:
+                sipcalc_args = [address]
+            else:
+                sipcalc_args = []
+
+        parsed = _parse(' '.join(sipcalc_args).split())
+        if parsed:
+            self.version, self._num, self._bits = parsed
+        else:
+            self.version, self._num, self._bits = None, None, None
 
     def is_ipv4(self):
-        res = False
-        if self.sipcalc_out[0].startswith("-[ipv4") or (
-            self.iface != None and self.sipcalc_out[0].startswith("-[int-ipv4")):
-            res = True
-        return res
+        return self.version == 4
 
     def is_ipv6(self):
-        res = False
-        if self.sipcalc_out[0].startswith("-[ipv6") or (
-            self.iface != None and self.sipcalc_out[0].startswith("-[int-ipv6")):
-            res = True
-        return res
+        return self.version == 6
 
     def __str__(self):
         self_str = None 
@@ -99,6 +240,9 @@ class sipcalc_base_type(object):
     def __ne__(self, other):
         return self.to_decimal() != other
 
+    def __hash__(self):
+        return hash(self.to_decimal())
+
     def __gt__(self, other):
         return self.to_decimal() > other
 
@@ -316,55 +460,39 @@ class sipcalc_base_type(object):
 class sipcalc_ipv4_type(sipcalc_base_type):
     def __init__(self, *args, **kwargs):
         super(sipcalc_ipv4_type, self).__init__(*args, **kwargs)
-
-        for line in self.sipcalc_out:
-            parts = line.split("-") 
-
-            i = 0
-            plen = len(parts)
-            while i < plen:
-                parts[i] = parts[i].strip()
-                i += 1
-
-            if parts[0] == "Host address":
-                self.host_address = parts[1]
-
-            elif parts[0] == "Host address (decimal)":
-                self.host_address_dec = int(parts[1])
-
-            elif parts[0] == "Host address (hex)":
-                self.host_address_hex = parts[1]
-
-            elif parts[0] == "Network address":
-                self.network_address  = parts[1]
-
-            elif parts[0] == "Network mask":
-                self.network_mask = parts[1]
-
-            elif parts[0] == "Network mask (bits)":
-                self.network_mask_bits = int(parts[1])
-
-            elif parts[0] == "Network mask (hex)":
-                self.network_mask_hex = parts[1]
-
-            elif parts[0] == "Broadcast address":
-                self.broadcast_address = parts[1]
-
-            elif parts[0] == "Cisco wildcard":
-                self.cisco_wildcard = parts[1]
-
-            elif parts[0] == "Addresses in network":
-                self.network_addresses = int(parts[1])
-
-            elif parts[0] == "Network range":
-                self.network_range = parts[1:]
-
-            elif parts[0] == "Usable range":
-                self.usable_range = parts[1:]
+        self._calculate()
+
+    def _calculate(self):
+        num, bits = self._num, self._bits
+        mask = (IPV4_MAX << (32 - bits)) & IPV4_MAX
+        network = num & mask
+        broadcast = network | (~mask & IPV4_MAX)
+
+        self.host_address = _decimal_to_ipv4(num)
+        self.host_address_dec = num
+        self.host_address_hex = "%08X" % num
+        self.network_address = _decimal_to_ipv4(network)
+        self.network_mask = _decimal_to_ipv4(mask)
+        self.network_mask_bits = bits
+        self.network_mask_hex = "%08X" % mask
+        self.broadcast_address = _decimal_to_ipv4(broadcast)
+        self.cisco_wildcard = _decimal_to_ipv4(~mask & IPV4_MAX)
+        self.network_addresses = 1 << (32 - bits)
+        self.network_range = [
+            _decimal_to_ipv4(network),
+            _decimal_to_ipv4(broadcast),
+        ]
+        if bits >= 31:
+            self.usable_range = list(self.network_range)
+        else:
+            self.usable_range = [
+                _decimal_to_ipv4(network + 1),
+                _decimal_to_ipv4(broadcast - 1),
+            ]
 
     def to_decimal(self, addr=None):
         if addr is not None:
-            num = sipcalc_type(addr).host_address_dec
+            num = _to_sipcalc(addr).host_address_dec
         else:
             num = self.host_address_dec
 
@@ -374,229 +502,206 @@ class sipcalc_ipv4_type(sipcalc_base_type):
         if num is None:
             num = self.host_address_dec
 
-        oct1 = (num >> 24) & 0xff
-        oct2 = (num >> 16) & 0xff
-        oct3 = (num >> 8) & 0xff
-        oct4 = (num >> 0) & 0xff
-
-        addr = "%d.%d.%d.%d/%d" % (oct1, oct2, oct3, oct4, self.network_mask_bits)
+        addr = "%s/%d" % (_decimal_to_ipv4(num), self.network_mask_bits)
         return addr
 
     def in_network(self, addr):
-        res = False
+        st_addr = _to_sipcalc(addr).host_address_dec
+        st_start = _ipv4_to_decimal(self.network_range[0])
+        st_end = _ipv4_to_decimal(self.network_range[1])
 
-        st_addr = sipcalc_type(addr).host_address_dec
-        st_start = sipcalc_type("%s/%d" % (self.network_range[0],
-            self.network_mask_bits)).host_address_dec
-        st_end = sipcalc_type("%s/%d" % (self.network_range[1],
-            self.network_mask_bits)).host_address_dec
-
-        if st_addr >= st_start and st_addr <= st_end:
-            res = True 
-
-        return res
+        return st_addr >= st_start and st_addr <= st_end
 
     def get_next_addr(self, addr=None):
-        naddr = ""
-
         if addr is not None:
-            addr = sipcalc_type(addr).host_address_dec
+            addr = _to_sipcalc(addr).host_address_dec
         else:
             addr = self.host_address_dec
 
-        addr += 1
-
-        oct1 = (addr >> 24) & 0xff
-        oct2 = (addr >> 16) & 0xff
-        oct3 = (addr >> 8) & 0xff
-        oct4 = (addr >> 0) & 0xff
+        return _decimal_to_ipv4(addr + 1)
 
-        naddr = "%d.%d.%d.%d" % (oct1, oct2, oct3, oct4)
-        return naddr
 
 class sipcalc_ipv6_type(sipcalc_base_type):
     def __init__(self, *args, **kwargs):
         super(sipcalc_ipv6_type, self).__init__(*args, **kwargs)
-
-        network_range = 0
-        for line in self.sipcalc_out:
-            parts = line.split("-") 
-
-            i = 0
-            plen = len(parts)
-            while i < plen:
-                parts[i] = parts[i].strip()
-                i += 1
-
-            if parts[0] == "Expanded Address":
-                self.expanded_address = parts[1]
-
-            elif parts[0] == "Compressed address":
-                self.compressed_address = parts[1]
-
-            elif parts[0] == "Subnet prefix (masked)":
-                self.subnet_prefix_masked = parts[1]
-
-            elif parts[0] == "Address ID (masked)":
-                self.address_id_masked = parts[1]
-
-            elif parts[0] == "Prefix address":
-                self.prefix_address = parts[1]
-
-            elif parts[0] == "Prefix length":
-                self.prefix_length = int(parts[1])
-
-            elif parts[0] == "Address type":
-                self.address_type = parts[1]
-
-            elif parts[0] == "Network range":
-                self.network_range = [None, None]
-                self.network_range[0] = parts[1]
-                network_range = 1
-
-            elif network_range == 1:
-                network_range = 0
-                self.network_range[1] = parts[0]
+        self._calculate()
+
+    def _calculate(self):
+        num, bits = self._num, self._bits
+        mask = (IPV6_MAX << (128 - bits)) & IPV6_MAX
+        network = num & mask
+        last = network | (~mask & IPV6_MAX)
+
+        self.expanded_address = _decimal_to_ipv6(num)
+        self.compressed_address = socket.inet_ntop(
+            socket.AF_INET6,
+            binascii.unhexlify("%032x" % num),
+        )
+        self.subnet_prefix_masked = "%s/%d" % (
+            _decimal_to_ipv6(network, expanded=False), bits
+        )
+        self.address_id_masked = "%s/%d" % (
+            _decimal_to_ipv6(num & ~mask & IPV6_MAX, expanded=False), bits
+        )
+        self.prefix_address = _decimal_to_ipv6(mask, expanded=False)
+        self.prefix_length = bits
+        self.address_type = _ipv6_address_type(num)
+        self.network_range = [
+            _decimal_to_ipv6(network),
+            _decimal_to_ipv6(last),
+        ]
 
     def to_binary(self, addr=None):
-        numbers = { '0': 0, '1': 1, '2': 2, '3': 3, '4': 4,
-            '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, 'a': 10,
-            'b': 11, 'c': 12, 'd': 13, 'e': 14, 'f': 15 }
-   
         if addr is not None:
-            addr = sipcalc_type(addr).expanded_address
+            num = _to_sipcalc(addr).to_decimal()
         else:
-            addr = self.expanded_address
-
-        bnum = ""
-        octets = addr.split(':')
-        for oct in octets:
-
-            # hex to decimal
-            dnum = 0
-            for b in oct:
-                b = b.lower()
-                dnum *= 16
-                dnum += numbers[b]
+            num = self._num
 
-            # decimal to binary
-            tbnum = ""
-            while True:
-                if dnum & 1:
-                    tbnum = "1%s" % tbnum
-                else:
-                    tbnum = "0%s" % tbnum
-
-                dnum /= 2
-                if dnum < 1:
-                    break
-
-            tbnum = tbnum.zfill(16)
-            bnum = "%s%s" % (bnum, tbnum)
-
-        return bnum
+        return bin(num)[2:].zfill(128)
 
     def to_decimal(self, addr=None):
-        numbers = { '0': 0, '1': 1, '2': 2, '3': 3, '4': 4,
-            '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, 'a': 10,
-            'b': 11, 'c': 12, 'd': 13, 'e': 14, 'f': 15 }
         if addr is not None:
-            addr = sipcalc_type(addr).expanded_address
-        else:
-            addr = self.expanded_address
-
-        si = 128
-        num = 0
-        octets = addr.split(':')
-        for oct in octets:
-            si -= 16
-
-            # hex to decimal
-            dnum = 0
-            for b in oct:
-                b = b.lower()
-                dnum *= 16
-                dnum += numbers[b]
-
-            num += dnum << si
-
-        return num
+            return _to_sipcalc(addr).to_decimal()
+        return self._num
 
     def to_ip(self, num=None):
         if num is None:
-           num = self.to_decimal()
-
-        addr = "" 
-        haddr = hex(num)
-        parts1 = haddr.split('x')
-        if len(parts1) > 1:
-            parts2 = parts1[1].split('L') 
-            hstr = parts2[0]
-
-            i = 0
-            hlen = len(hstr) 
-            while i < hlen:
-                addr += hstr[i]
-                if (i + 1) % 4 == 0 and (i + 1) < hlen:
-                    addr += ':'
-                i += 1 
-
-        addr = "%s/%d" % (addr, self.prefix_length)
-        return addr
-   
-    def in_network(self, addr):
-        res = False
+            num = self.to_decimal()
 
-        st_addr = sipcalc_type(addr)
-        st_start = sipcalc_type(self.network_range[0])
-
-        st_baddr = self.to_binary(st_addr.expanded_address)
-        st_bstart = self.to_binary(st_start.expanded_address)
+        addr = "%s/%d" % (_decimal_to_ipv6(num & IPV6_MAX), self.prefix_length)
+        return addr
 
-        if st_baddr[0:self.prefix_length] == st_bstart[0:self.prefix_length]:
-            res = True
+    def in_network(self, addr):
+        shift = 128 - self.prefix_length
+        st_addr = _to_sipcalc(addr).to_decimal()
 
-        return res
+        return st_addr >> shift == self._num >> shift
 
     def get_next_addr(self, addr=None):
-        naddr = ""
-
         if addr is not None:
-            addr = sipcalc_type(addr).expanded_address
+            addr = _to_sipcalc(addr).to_decimal()
         else:
-            addr = self.expanded_address
-
-        daddr = self.to_decimal(addr)
-        daddr += 1
-
-        haddr = hex(daddr)
-        parts1 = haddr.split('x')
-        if len(parts1) > 1:
-            parts2 = parts1[1].split('L') 
-            hstr = parts2[0]
+            addr = self.to_decimal()
 
-            i = 0
-            hlen = len(hstr) 
-            while i < hlen:
-                naddr += hstr[i]
-                if (i + 1) % 4 == 0 and (i + 1) < hlen:
-                    naddr += ':'
-                i += 1 
+        if addr >= IPV6_MAX:
+            return None
 
-        if not naddr:
-            naddr = None
+        return _decimal_to_ipv6(addr + 1)
 
-        return naddr
 
 class sipcalc_type(sipcalc_base_type):
-    def __new__(cls, *args, **kwargs):    
+    def __new__(cls, *args, **kwargs):
         obj = None
-        sbt = sipcalc_base_type(*args, **kwargs) 
+        sbt = sipcalc_base_type(*args, **kwargs)
 
         if sbt.is_ipv4():
-            obj = sipcalc_ipv4_type(*args, **kwargs)
+            obj = object.__new__(sipcalc_ipv4_type)
 
         elif sbt.is_ipv6():
-            obj = sipcalc_ipv6_type(*args, **kwargs)
+            obj = object.__new__(sipcalc_ipv6_type)
+
+        if obj is not None:
+            # Reuse what has already been parsed, interfaces are not
+            # queried twice
+            obj.__dict__.update(sbt.__dict__)
+            obj._calculate()
 
         return obj
+
+
+class sipcalc_range_type(object):
+    """
+    Inclusive range of addresses between two sipcalc types
+
+    The range is kept as a sorted list of disjoint [first, last] decimal
+    intervals, excluded addresses (or whole ranges) are subtracted by
+    splitting intervals, so iterating over the free addresses never has
+    to test every candidate against the excluded set.
+
+    Addresses yielded keep the netmask/prefix length of ``start``.
+    """
+
+    def __init__(self, start, end):
+        self.start = _to_sipcalc(start)
+        self.end = _to_sipcalc(end)
+        if self.start is None or self.end is None:
+            raise ValueError("Invalid address range")
+        if self.start.version != self.end.version:
+            raise ValueError("Range boundaries of different versions")
+
+        first, last = int(self.start), int(self.end)
+        self.intervals = [[first, last]] if first <= last else []
+
+    def _decimals(self, others):
+        if isinstance(others, (sipcalc_base_type, sipcalc_range_type)):
+            others = [others]
+        elif isinstance(others, dict):
+            others = others.values()
+
+        intervals = []
+        for other in others:
+            if isinstance(other, sipcalc_range_type):
+                intervals.extend(other.intervals)
+                continue
+            if not isinstance(other, (int, long)):
+                other = _to_sipcalc(other)
+                if other is None or other.version != self.start.version:
+                    continue
+                other = int(other)
+            intervals.append([other, other])
+        intervals.sort()
+        return intervals
+
+    def __sub__(self, others):
+        """
+        New range without the addresses in ``others``, which can be an
+        iterable (or dict values) of sipcalc types, strings, decimals or
+        other ranges
+        """
+        excluded = self._decimals(others)
+        intervals = []
+        i = 0
+        for first, last in self.intervals:
+            while i < len(excluded) and excluded[i][1] < first:
+                i += 1
+            j = i
+            while j < len(excluded) and excluded[j][0] <= last:
+                efirst, elast = excluded[j]
+                if efirst > first:
+                    intervals.append([first, efirst - 1])
+                first = max(first, elast + 1)
+                j += 1
+            if first <= last:
+                intervals.append([first, last])
+
+        new = object.__new__(sipcalc_range_type)
+        new.start = self.start
+        new.end = self.end
+        new.intervals = intervals
+        return new
+
+    def __contains__(self, addr):
+        if not isinstance(addr, (int, long)):
+            addr = int(_to_sipcalc(addr))
+        for first, last in self.intervals:
+            if first <= addr <= last:
+                return True
+        return False
+
+    def __iter__(self):
+        for first, last in self.intervals:
+            num = first
+            while num <= last:
+                yield sipcalc_type(self.start.to_ip(num))
+                num += 1
+
+    def __nonzero__(self):
+        return bool(self.intervals)
+
+    def size(self):
+        return sum([last - first + 1 for first, last in self.intervals])
+
+    def first(self):
+        for addr in self:
+            return addr
+        return None
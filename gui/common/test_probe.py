@@ -0,0 +1,123 @@
+import threading
+import time
+import unittest
+
+from freenasUI.common import probe
+from freenasUI.common.probe import AddressProbe
+
+
+class FakeBackend(object):
+    """
+    Stand-in for ping_host, ``alive`` hosts answer and ``delays`` hold
+    some of them back
+    """
+
+    def __init__(self, alive, delays=None, delay=0):
+        self.alive = set(alive)
+        self.delays = delays or {}
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, host, ping6):
+        with self._lock:
+            self.calls.append(host)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(self.delays.get(host, self.delay))
+            return host in self.alive
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class AddressProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time = probe.time
+        probe.time = self.clock
+
+    def tearDown(self):
+        probe.time = self._time
+
+    def candidates(self, count):
+        return ['10.0.0.%d/24' % i for i in range(1, count + 1)]
+
+    def test_first_free_in_order(self):
+        # 10.0.0.3 is free but answers last, 10.0.0.7 is free too
+        hosts = ['10.0.0.%d' % i for i in range(1, 9)]
+        backend = FakeBackend(
+            [h for h in hosts if h not in ('10.0.0.3', '10.0.0.7')],
+            delays={'10.0.0.3': 0.2},
+        )
+        prober = AddressProbe(backend, workers=8)
+        self.assertEqual(
+            prober.first_free(self.candidates(8)),
+            '10.0.0.3/24',
+        )
+
+    def test_all_in_use(self):
+        backend = FakeBackend(['10.0.0.%d' % i for i in range(1, 6)])
+        prober = AddressProbe(backend, workers=2)
+        self.assertEqual(prober.first_free(self.candidates(5)), None)
+        self.assertEqual(len(backend.calls), 5)
+
+    def test_fan_out_bound(self):
+        backend = FakeBackend(
+            ['10.0.0.%d' % i for i in range(1, 21)],
+            delay=0.05,
+        )
+        prober = AddressProbe(backend, workers=4)
+        self.assertEqual(prober.first_free(self.candidates(20)), None)
+        self.assertEqual(len(backend.calls), 20)
+        self.assertTrue(1 < backend.peak <= 4)
+
+    def test_stops_at_first_free_window(self):
+        backend = FakeBackend(['10.0.0.1'])
+        prober = AddressProbe(backend, workers=2)
+        self.assertEqual(
+            prober.first_free(self.candidates(10)),
+            '10.0.0.2/24',
+        )
+        self.assertEqual(sorted(backend.calls), ['10.0.0.1', '10.0.0.2'])
+
+    def test_inuse_ttl(self):
+        backend = FakeBackend(['10.0.0.1', '10.0.0.2'])
+        prober = AddressProbe(backend, workers=1, ttl=30)
+        self.assertEqual(prober.first_free(self.candidates(3)), '10.0.0.3/24')
+        self.assertEqual(len(backend.calls), 3)
+
+        # Addresses in use are skipped without being probed again
+        self.clock.now += 29
+        self.assertEqual(prober.first_free(self.candidates(3)), '10.0.0.3/24')
+        self.assertEqual(backend.calls[3:], ['10.0.0.3'])
+
+        # and probed once the ttl is over
+        self.clock.now += 2
+        backend.alive.discard('10.0.0.1')
+        self.assertEqual(prober.first_free(self.candidates(3)), '10.0.0.1/24')
+        self.assertEqual(backend.calls[4:], ['10.0.0.1'])
+
+    def test_backend_failure_means_in_use(self):
+
+        def backend(host, ping6):
+            if host == '10.0.0.1':
+                raise OSError('ping failed')
+            return False
+
+        prober = AddressProbe(backend, workers=1)
+        self.assertEqual(prober.first_free(self.candidates(2)), '10.0.0.2/24')
+        self.assertTrue(prober.in_use('10.0.0.1'))
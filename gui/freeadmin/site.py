@@ -245,10 +245,9 @@ class FreeAdminSite(object):
 
     @never_cache
     def alert_status(self, request):
-        from freenasUI.system.models import Alert
         from freenasUI.system.alert import alertPlugins
-        dismisseds = [a.message_id for a in Alert.objects.filter(dismiss=True)]
-        alerts = alertPlugins.run()
+        dismisseds = alertPlugins.dismissed()
+        alerts = alertPlugins.get_alerts()
         current = 'OK'
         for alert in alerts:
             # Skip dismissed alerts
@@ -265,10 +264,9 @@ class FreeAdminSite(object):
 
     @never_cache
     def alert_detail(self, request):
-        from freenasUI.system.models import Alert
         from freenasUI.system.alert import alertPlugins
-        dismisseds = [a.message_id for a in Alert.objects.filter(dismiss=True)]
-        alerts = alertPlugins.run()
+        dismisseds = alertPlugins.dismissed()
+        alerts = alertPlugins.get_alerts()
         return render(request, "freeadmin/alert_status.html", {
             'alerts': alerts,
             'dismisseds': dismisseds,
@@ -2,6 +2,8 @@ define([
     "dojo/_base/declare",
     "dojo/dom-attr",
     "dojo/io-query",
+    "dojo/json",
+    "dojo/request/xhr",
     "dijit/_Widget",
     "dijit/_TemplatedMixin",
     "dijit/form/TextBox",
@@ -10,13 +12,63 @@ define([
     "dijit/layout/ContentPane",
     "dojox/timing",
     "dojo/text!freeadmin/templates/rrdcontrol.html"
-    ], function(declare, domAttr, ioQuery, _Widget, _Templated, TextBox, Button, TabContainer, ContentPane, timing, template) {
+    ], function(declare, domAttr, ioQuery, JSON, xhr, _Widget, _Templated, TextBox, Button, TabContainer, ContentPane, timing, template) {
+
+    /*
+     * Graphs queried within the same tick are fetched with a single
+     * request to the batch view, keyed by its url. The list is POSTed,
+     * a page of graphs does not fit in a query string. Graphs the batch
+     * failed to render are loaded on their own.
+     */
+    var pending = {};
+
+    var batchQuery = function(href, widget) {
+        if(!pending[href]) {
+            pending[href] = [];
+            setTimeout(function() {
+                var widgets = pending[href];
+                delete pending[href];
+                var graphs = [];
+                for(var i=0;i<widgets.length;i++) {
+                    graphs.push({
+                        plugin: widgets[i].plugin,
+                        identifier: widgets[i].identifier,
+                        unit: widgets[i].unit,
+                        step: widgets[i].step
+                    });
+                }
+                xhr.post(href, {
+                    data: {graphs: JSON.stringify(graphs)},
+                    headers: {
+                        'X-CSRFToken': CSRFToken
+                    },
+                    handleAs: "json",
+                    preventCache: true
+                }).then(function(data) {
+                    for(var i=0;i<widgets.length;i++) {
+                        var graph = data.graphs[i];
+                        if(graph && graph.image) {
+                            domAttr.set(widgets[i].imageNode, "src", graph.image);
+                        } else {
+                            widgets[i].load();
+                        }
+                    }
+                }, function(error) {
+                    for(var i=0;i<widgets.length;i++) {
+                        widgets[i].load();
+                    }
+                });
+            }, 50);
+        }
+        pending[href].push(widget);
+    };
 
     var RRDControl = declare("freeadmin.RRDControl", [ _Widget, _Templated ], {
         templateString : template,
         name : "",
         value: "",
         href: "",
+        batchHref: "",
         step: 0,
         unit: "hourly",
         plugin: "",
@@ -134,6 +186,15 @@ define([
         },
         query: function() {
 
+            if(this.batchHref) {
+                batchQuery(this.batchHref, this);
+                return;
+            }
+            this.load();
+
+        },
+        load: function() {
+
             var query = ioQuery.objectToQuery({
                 unit: this.unit,
                 plugin: this.plugin,
@@ -36,8 +36,12 @@ define([
     width: 80,
     height: 24,
     qtime: 100,
+    pollWait: 10,
+    polling: false,
+    sending: false,
     retry: 0,
     cy: 0,
+    seq: 0,
     kb: [],
     connections: [],
     sizeChange: true,
@@ -191,70 +195,107 @@ define([
         this.queue(string[chr]);
       }
     },
+    _request: function(wait, keys) {
+      var send = "";
+      while(keys && this.kb.length > 0)
+        send += this.kb.pop();
+      return xhr.post("/system/terminal/", {
+        data: {
+          s: this.sid,
+          jid: this.jid,
+          shell: this.shell,
+          w: this.width,
+          h: this.height,
+          k: send,
+          seq: this.seq,
+          wait: wait
+        },
+        headers: {
+          'Content-Type': 'application/x-www-form-urlencoded',
+          'X-CSRFToken': CSRFToken
+        },
+        sync: false,
+        preventCache: true,
+        handleAs: 'json'
+      });
+    },
+    _render: function(data) {
+      if(!data || !data.rows || data.rows.length == 0)
+        return;
+      // Key and poll requests may cross, never go back in time
+      if(!data.full && data.seq <= this.seq)
+        return;
+      // Only the rows changed since our version are sent back
+      if(data.full) {
+        var html = [];
+        for(var i=0;i<data.rows.length;i++) {
+          html.push('<div>' + data.rows[i][1] + '</div>');
+        }
+        this._content.innerHTML = html.join('');
+      } else {
+        for(var i=0;i<data.rows.length;i++) {
+          this._content.childNodes[data.rows[i][0]].innerHTML = data.rows[i][1];
+        }
+      }
+      this.seq = data.seq;
+      this.handler('curs', data.cy);
+      if(this.onUpdate) {
+        lang.hitch(this, this.onUpdate)();
+      }
+    },
     update: function() {
 
       var me = this;
-      if(!this.islocked) {
-        this.islocked = true;
-        var send = "";
-        while(this.kb.length > 0)
-          send += this.kb.pop();
-        var req = xhr.post("/system/terminal/", {
-          data: {
-            s: this.sid,
-            jid: this.jid,
-            shell: this.shell,
-            w: this.width,
-            h: this.height,
-            k: send
-          },
-          headers: {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'X-CSRFToken': CSRFToken
-          },
-          sync: false,
-          preventCache: true,
-          handleAs: 'text'
-        }).then(function(data) {
+      if(this.islocked)
+        return;
 
-          me.islocked = false;
-          if (!me.isactive) {
-            me.isactive = true;
-            me.handler('conn', 0);
-          }
+      // Keys do not wait for the pending poll to return, but only one
+      // request carries keys at a time so they reach the server in
+      // order, the others stay queued until it returns
+      if(this.kb.length > 0 && !this.sending) {
+        this.sending = true;
+        this._request(0, true).then(function(data) {
+          me.sending = false;
+          me._render(data);
+          if(me.kb.length > 0)
+            me.qtimer.setInterval(1);
+        }, function(req) {
+          me.sending = false;
+        });
+      }
 
-          me.retry = 0;
-          cy = data.substring(45, 48);
-          html = data.substring(52);
-          if(html.length > 0) {
-            me._content.innerHTML = html;
-            me.handler('curs', cy);
-            qtime = 100;
-          } else {
-            qtime *= 2;
-            if(qtime > 2000)
-              qtime = 2000;
-          }
-          me.qtimer.setInterval(qtime);
-          if(me.onUpdate) {
-            lang.hitch(me, me.onUpdate)();
-          }
+      if(this.polling) {
+        this.qtimer.setInterval(this.qtime);
+        return;
+      }
 
-        }, function(req) {
+      this.polling = true;
+      this._request(this.pollWait, false).then(function(data) {
 
-          if (req.response.status == 400) {
-            me.handler('disc',0);
-          } else {
-            me.retry++;
-            if (me.retry<3)
-              me.qtimer.setInterval(2000);
-            else
-              me.handler('disc',1);
-          }
+        me.polling = false;
+        if (!me.isactive) {
+          me.isactive = true;
+          me.handler('conn', 0);
+        }
 
-        });
+        me.retry = 0;
+        me._render(data);
+        me.qtimer.setInterval(me.qtime);
 
-      }
+      }, function(req) {
+
+        me.polling = false;
+        if (req.response.status == 400) {
+          me.handler('disc',0);
+        } else {
+          me.retry++;
+          if (me.retry<3)
+            me.qtimer.setInterval(2000);
+          else
+            me.handler('disc',1);
+        }
+
+      });
     },
     queue: function (s) {
       this.kb.unshift(s);
@@ -7,8 +7,9 @@ import time
 
 from django.utils.translation import ugettext as _
 
-from freenasUI.common.sipcalc import sipcalc_type
+from freenasUI.common.sipcalc import sipcalc_type, sipcalc_range_type
 from freenasUI.common.pipesubr import pipeopen
+from freenasUI.common.probe import AddressProbe
 from freenasUI.common import warden
 from freenasUI.jails.models import (
     Jails,
@@ -84,6 +85,12 @@ def ping_host(host, ping6=False):
     return True
 
 
+#
+# Probe candidate addresses concurrently, remembering the ones in use
+#
+ADDRESS_PROBE = AddressProbe(ping_host)
+
+
 #
 # get_ipv4_exclude_list()
 #
@@ -214,45 +221,26 @@ def get_ipv6_exclude_dict():
 # get_available_ipv4()
 #
 # Find an IPv4 address in a given range. If no end address
-# is provided, use the netmask to determine how many addresses
-# to probe. If not netmask is provided, assume /24.
+# is provided, probe up to the last usable address of the
+# start address network.
 #
 def get_available_ipv4(ipv4_start, ipv4_end=None, ipv4_exclude_dict=None):
     available_ipv4 = None
-    addr = ipv4_start
-
-    if not ipv4_end:
-        mask = 0
-        try:
-            mask = int(str(addr).split('/')[1])
-            if not mask:
-                mask = 24
-        except:
-            mask = 24
 
-        naddrs = 2**mask
+    if not ipv4_start:
+        return None
 
-    else:
-        naddrs = int(ipv4_end) - int(ipv4_start)
-
-    i = 0
-    while i <= naddrs:
-        if not addr:
-            break
-
-        if ipv4_exclude_dict and str(addr) in ipv4_exclude_dict:
-            addr += 1
-            continue
+    if not ipv4_end:
+        ipv4_end = "%s/%d" % (
+            ipv4_start.usable_range[1],
+            ipv4_start.network_mask_bits
+        )
 
-        if ping_host(str(addr).split('/')[0]):
-            addr += 1
-            continue
+    candidates = sipcalc_range_type(ipv4_start, ipv4_end)
+    if ipv4_exclude_dict:
+        candidates -= ipv4_exclude_dict
 
-        else:
-            available_ipv4 = addr
-            break
-
-        i += 1
+    available_ipv4 = ADDRESS_PROBE.first_free(candidates)
 
     return available_ipv4
 
@@ -261,46 +249,26 @@ def get_available_ipv4(ipv4_start, ipv4_end=None, ipv4_exclude_dict=None):
 # get_available_ipv6()
 #
 # Find an IPv6 address in a given range. If no end address
-# is provided, use the prefix to determine how many addresses
-# to probe. If not prefix is provided, assume /64.
+# is provided, probe up to the last address of the start
+# address prefix.
 #
 def get_available_ipv6(ipv6_start, ipv6_end=None, ipv6_exclude_dict=None):
     available_ipv6 = None
-    addr = ipv6_start
-
-    if not ipv6_end:
-        prefix = 0
-        try:
-            prefix = int(str(addr).split('/')[1])
-            if not prefix:
-                prefix = 64
 
-        except:
-            prefix = 64
+    if not ipv6_start:
+        return None
 
-        naddrs = 2**prefix
-
-    else:
-        naddrs = int(ipv6_end) - int(ipv6_start)
-
-    i = 0
-    while i <= naddrs:
-        if not addr:
-            break
-
-        if ipv6_exclude_dict and str(addr) in ipv6_exclude_dict:
-            addr += 1
-            continue
-
-        if ping_host(str(addr).split('/')[0], ping6=True):
-            addr += 1
-            continue
+    if not ipv6_end:
+        ipv6_end = "%s/%d" % (
+            ipv6_start.network_range[1],
+            ipv6_start.prefix_length
+        )
 
-        else:
-            available_ipv6 = addr
-            break
+    candidates = sipcalc_range_type(ipv6_start, ipv6_end)
+    if ipv6_exclude_dict:
+        candidates -= ipv6_exclude_dict
 
-        i += 1
+    available_ipv6 = ADDRESS_PROBE.first_free(candidates, ping6=True)
 
     return available_ipv6
 
@@ -0,0 +1,176 @@
+#-
+# Copyright (c) 2013 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+import time
+
+log = logging.getLogger('middleware.disk')
+
+# Maximum number of concurrent serial probes (smartctl processes)
+PROBE_WORKERS = 8
+# Seconds before a device whose probe failed is probed again
+PROBE_RETRY = 60
+
+
+class DiskInventory(object):
+    """
+    Process wide device <-> serial map
+
+    Serial numbers are probed through a caller supplied ``probe``
+    callable (e.g. running smartctl), concurrently for every device
+    not yet known, using a bounded pool of worker threads.
+
+    The map is tied to a ``generation`` (anything hashable describing the
+    current set of attached disks, e.g. GEOM DISK geom ids), whenever the
+    generation changes the map is thrown away so devices that were
+    detached/attached (devd events) are probed again.
+    """
+
+    def __init__(self, workers=PROBE_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._generation = None
+        # devname -> serial
+        self._serials = {}
+        # serial -> set(devname), more than one for multipath
+        self._devices = defaultdict(set)
+        # devname -> time of the last failed probe
+        self._failed = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._generation = None
+            self._serials.clear()
+            self._devices.clear()
+            self._failed.clear()
+
+    def forget(self, devname):
+        with self._lock:
+            self._failed.pop(devname, None)
+            serial = self._serials.pop(devname, None)
+            if serial:
+                self._devices[serial].discard(devname)
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            self._generation = generation
+            self._serials.clear()
+            self._devices.clear()
+            self._failed.clear()
+
+    def _known(self, devname, now):
+        if devname in self._serials:
+            return True
+        failed = self._failed.get(devname)
+        return failed is not None and now - failed < PROBE_RETRY
+
+    def _probe(self, devnames, probe):
+
+        def _wrap(devname):
+            try:
+                return devname, probe(devname)
+            except Exception, e:
+                log.warn("Failed to get serial of %s: %s", devname, e)
+                return devname, None
+
+        if len(devnames) == 1:
+            return [_wrap(devnames[0])]
+
+        pool = ThreadPool(min(self.workers, len(devnames)))
+        try:
+            return pool.map(_wrap, devnames)
+        finally:
+            pool.close()
+            pool.join()
+
+    def sweep(self, devnames, probe, generation=None):
+        """
+        Make sure the serial of every device in ``devnames`` is known,
+        probing all the missing ones in one parallel sweep.
+
+        Returns:
+            dict(devname) = serial
+        """
+        with self._lock:
+            self._check_generation(generation)
+            now = time.time()
+            missing = [d for d in devnames if not self._known(d, now)]
+
+        if missing:
+            results = self._probe(missing, probe)
+        else:
+            results = []
+
+        with self._lock:
+            if generation != self._generation:
+                # Topology changed while we were probing, do not pollute
+                # the new generation with stale results
+                return dict(results)
+            for devname, serial in results:
+                # Failed probes are only remembered for PROBE_RETRY, a
+                # transient failure must not hide the serial for good
+                if not serial:
+                    self._failed[devname] = time.time()
+                    continue
+                self._failed.pop(devname, None)
+                self._serials[devname] = serial
+                self._devices[serial].add(devname)
+            return dict(
+                (devname, self._serials.get(devname))
+                for devname in devnames
+            )
+
+    def serial(self, devname, probe, generation=None):
+        with self._lock:
+            self._check_generation(generation)
+            if self._known(devname, time.time()):
+                return self._serials.get(devname)
+        return self.sweep([devname], probe, generation).get(devname)
+
+    def device(self, serial, devnames, probe, generation=None):
+        """
+        Resolve a serial number back to a device name out of ``devnames``
+
+        If more than one device share the serial (multipath) the first
+        one in ``devnames`` wins.
+        """
+        serials = self.sweep(devnames, probe, generation)
+        with self._lock:
+            candidates = set(self._devices.get(serial, ()))
+        if not candidates:
+            # Generation changed during the sweep
+            candidates = set(
+                d for d, s in serials.items() if s == serial
+            )
+        if len(candidates) == 1:
+            devname = candidates.pop()
+            return devname if devname in serials else None
+        for devname in devnames:
+            if devname in candidates:
+                return devname
+        return None
@@ -0,0 +1,127 @@
+#-
+# Copyright (c) 2013 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+from collections import defaultdict, OrderedDict
+
+
+class GEOMTopology(object):
+    """
+    Indexed view of the kern.geom.confxml tree
+
+    The whole document is walked once and every class, geom and provider
+    is put into hash tables, so lookups do not need XPath descendant
+    scans over the whole mesh.
+
+    The indexes hold the original lxml nodes, callers expecting a
+    provider xmlnode (e.g. get_label_consumer) keep working.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        # provider id -> provider node
+        self.providers = {}
+        # provider id -> class name
+        self.provider_class = {}
+        # class name -> geom name -> geom node
+        self.geoms = defaultdict(OrderedDict)
+        # class name -> provider name -> provider node
+        self.provider_names = defaultdict(dict)
+        # rawuuid -> [PART provider nodes]
+        self.rawuuids = defaultdict(list)
+        # provider id -> [geom nodes consuming it]
+        self.consumers = defaultdict(list)
+        self._build()
+
+    def _build(self):
+        for cls in self.doc.iterchildren('class'):
+            cname = cls.findtext('name')
+            geoms = self.geoms[cname]
+            provnames = self.provider_names[cname]
+            for geom in cls.iterchildren('geom'):
+                geoms.setdefault(geom.findtext('name'), geom)
+                for prov in geom.iterchildren('provider'):
+                    provid = prov.get('id')
+                    self.providers[provid] = prov
+                    self.provider_class[provid] = cname
+                    provnames.setdefault(prov.findtext('name'), prov)
+                    rawuuid = prov.findtext('config/rawuuid')
+                    if rawuuid:
+                        self.rawuuids[rawuuid].append(prov)
+                for cons in geom.iterchildren('consumer'):
+                    ref = cons.find('provider')
+                    if ref is not None:
+                        self.consumers[ref.get('ref')].append(geom)
+
+    def geom(self, cname, name):
+        return self.geoms.get(cname, {}).get(name)
+
+    def provider(self, provid):
+        return self.providers.get(provid)
+
+    def provider_by_name(self, cname, name):
+        return self.provider_names.get(cname, {}).get(name)
+
+    def class_name(self, provider):
+        """
+        Class name of the geom owning ``provider``
+        """
+        return self.provider_class.get(provider.get('id'))
+
+    def geom_name(self, provider):
+        return provider.getparent().findtext('name')
+
+    def consumed(self, geom):
+        """
+        Providers consumed by the given ``geom`` node, in document order
+        """
+        provs = []
+        for ref in geom.xpath('./consumer/provider/@ref'):
+            prov = self.providers.get(ref)
+            if prov is not None:
+                provs.append(prov)
+        return provs
+
+    def consumers_of(self, provid):
+        return self.consumers.get(provid, [])
+
+    def partitions(self, device, parttype=None):
+        """
+        Partition providers of a PART geom ``device``, optionally
+        restricted to a given partition type (freebsd-zfs, freebsd-swap...)
+        """
+        geom = self.geom('PART', device)
+        if geom is None:
+            return []
+        provs = []
+        for prov in geom.iterchildren('provider'):
+            if parttype is None or prov.findtext('config/type') == parttype:
+                provs.append(prov)
+        return provs
+
+    def mediasize(self, disk):
+        geom = self.geom('DISK', disk)
+        if geom is None:
+            return None
+        return geom.findtext('provider/mediasize')
@@ -80,6 +80,7 @@ cache.get_apps()
 from django.utils.translation import ugettext as _
 
 from freenasUI.common.acl import ACL_FLAGS_OS_WINDOWS, ACL_WINDOWS_FILE
+from freenasUI.common.acltree import change_permission
 from freenasUI.common.freenasacl import ACL
 from freenasUI.common.jail import Jls, Jexec
 from freenasUI.common.locks import mntlock
@@ -102,7 +103,9 @@ from freenasUI.common.warden import (Warden, WardenJail,
     WARDEN_TYPE_PLUGINJAIL, WARDEN_STATUS_RUNNING)
 from freenasUI.freeadmin.hook import HookMetaclass
 from freenasUI.middleware import zfs
+from freenasUI.middleware.disk import DiskInventory
 from freenasUI.middleware.encryption import random_wipe
+from freenasUI.middleware.geom import GEOMTopology
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.multipath import Multipath
 import sysctl
@@ -110,6 +113,11 @@ import sysctl
 RE_DSKNAME = re.compile(r'^([a-z]+)([0-9]+)$')
 log = logging.getLogger('middleware.notifier')
 
+# Shared by every notifier instance of the process
+DISK_INVENTORY = DiskInventory()
+# Seconds between two progress log lines of a recursive permission change
+PERMISSION_PROGRESS_INTERVAL = 30
+
 
 class StartNotify(threading.Thread):
     """
@@ -1571,23 +1579,11 @@ class notifier:
             self.restart("collectd")
         return zfs_error, zfs_err
 
-    def list_zfs_vols(self, volname):
+    def list_zfs_vols(self, volname, inventory=None):
         """Return a dictionary that contains all ZFS volumes list"""
-        zfsproc = self._pipeopen("/sbin/zfs list -H -o name,volsize,used,avail,refer -t volume -r '%s'" % (str(volname),))
-        zfs_output, zfs_err = zfsproc.communicate()
-        zfs_output = zfs_output.split('\n')
-        retval = {}
-        for line in zfs_output:
-            if line == "":
-                continue
-            data = line.split('\t')
-            retval[data[0]] = {
-                'volsize': data[1],
-                'used': data[2],
-                'avail': data[3],
-                'refer': data[4],
-            }
-        return retval
+        if inventory is None:
+            inventory = zfs.ZFSInventory(path=volname, types=('volume', ))
+        return inventory.zvols(str(volname))
 
     def list_zfs_fsvols(self):
         proc = self._pipeopen("/sbin/zfs list -H -o name -t volume,filesystem")
@@ -1617,6 +1613,9 @@ class notifier:
     def repl_remote_snapshots(self, repl):
         """
         Get a list of snapshots in the remote side
+
+        Raises:
+            MiddlewareError: the remote system could not be queried
         """
         if repl.repl_remote.ssh_remote_dedicateduser_enabled:
             user = repl.repl_remote.ssh_remote_dedicateduser
@@ -1627,9 +1626,14 @@ class notifier:
             user,
             repl.repl_remote.ssh_remote_hostname,
         ))
-        data = proc.communicate()[0]
+        data, err = proc.communicate()
         if proc.returncode != 0:
-            return []
+            raise MiddlewareError(
+                "Failed to list snapshots of %s: %s" % (
+                    repl.repl_remote.ssh_remote_hostname,
+                    err.strip() or proc.returncode,
+                )
+            )
         return data.strip('\n').split('\n')
 
     def destroy_zfs_dataset(self, path, recursive=False):
@@ -2390,16 +2394,57 @@ class notifier:
                 self._system(cmd)
 
         else:
-            if recursive:
-                apply_paths = exclude_path(path, exclude)
-                apply_paths = map(lambda y: (y, '-R'), apply_paths)
-                if len(apply_paths) > 1:
-                    apply_paths.insert(0, (path, ''))
+            started = time.time()
+            last = [started]
+            lock = threading.Lock()
+
+            def progress(count, current):
+                # Called from the tree walking threads every few thousand
+                # entries, only log once in a while and when done
+                now = time.time()
+                with lock:
+                    if current != path:
+                        if now - last[0] < PERMISSION_PROGRESS_INTERVAL:
+                            return
+                        last[0] = now
+                if current == path:
+                    log.info(
+                        "Changed permissions of %d entries under %s in %ds",
+                        count,
+                        path,
+                        now - started,
+                    )
+                else:
+                    log.info(
+                        "Changing permissions under %s: %d entries so far "
+                        "(%s)",
+                        path,
+                        count,
+                        current,
+                    )
+
+            try:
+                errors = change_permission(
+                    path,
+                    user=user,
+                    group=group,
+                    mode=mode or None,
+                    recursive=recursive,
+                    exclude=[
+                        e.encode('utf-8') if isinstance(e, unicode) else e
+                        for e in exclude
+                    ],
+                    progress=progress,
+                )
+            except (KeyError, OSError), e:
+                log.error("Failed to change permissions of %s: %s", path, e)
             else:
-                apply_paths = [(path, '')]
-            for apath, flags in apply_paths:
-                self._system("/usr/sbin/chown %s '%s':'%s' '%s'" % (flags, user, group, apath))
-                self._system("/bin/chmod %s %s '%s'" % (flags, mode, apath))
+                if errors:
+                    log.warn(
+                        "Failed to change permissions of %d entries under %s",
+                        errors,
+                        path,
+                    )
 
     def mp_get_permission(self, path):
         if os.path.isdir(path):
@@ -3514,58 +3559,56 @@ class notifier:
             raise MiddlewareError('Unable to scrub %s: %s' % (name, stderr))
         return True
 
-    def zfs_snapshot_list(self, path=None, replications=None):
-        fsinfo = dict()
-
-        zfsproc = self._pipeopen("/sbin/zfs list -t volume -o name -H")
-        zvols = filter(lambda y: y != '', zfsproc.communicate()[0].split('\n'))
+    def zfs_snapshot_list(self, path=None, replications=None, inventory=None):
+        """
+        Snapshots grouped by filesystem, oldest first
 
-        if path:
-            zfsproc = self._pipeopen("/sbin/zfs list -r -t snapshot -H -S creation '%s'" % path)
-        else:
-            zfsproc = self._pipeopen("/sbin/zfs list -t snapshot -H -S creation")
-        lines = zfsproc.communicate()[0].split('\n')
-        for line in lines:
-            if line != '':
-                list = line.split('\t')
-                snapname = list[0]
-                used = list[1]
-                refer = list[3]
-                fs, name = snapname.split('@')
-                try:
-                    snaplist = fsinfo[fs]
-                    mostrecent = False
-                except:
-                    snaplist = []
-                    mostrecent = True
-                replication = None
-                if replications:
-                    for repl, snaps in replications.iteritems():
-                        remotename = '%s@%s' % (
-                            fs.replace(
-                                repl.repl_filesystem + '@',
-                                repl.repl_zfs + '@',
-                            ),
-                            name,
-                        )
-                        if remotename in snaps:
-                            replication = 'OK'
-                            #TODO: Multiple replication tasks
-                            break
+        An already gathered zfs.ZFSInventory containing the snapshots
+        can be given through ``inventory``.
+        """
+        if inventory is None:
+            inventory = zfs.ZFSInventory(path=path, types=('snapshot', ))
+        fsinfo = inventory.snapshot_list()
 
-                snaplist.insert(0,
-                    zfs.Snapshot(
-                        name=name,
-                        filesystem=fs,
-                        used=used,
-                        refer=refer,
-                        mostrecent=mostrecent,
-                        parent_type='filesystem' if fs not in zvols else 'volume',
-                        replication=replication
-                    ))
-                fsinfo[fs] = snaplist
+        if replications:
+            for snaplist in fsinfo.itervalues():
+                self.zfs_snapshot_replication(snaplist, replications)
         return fsinfo
 
+    def zfs_snapshot_replication(self, snapshots, replications):
+        """
+        Flag the zfs.Snapshot objects that already exist in the remote
+        side of a replication task
+
+        replications: dict(Replication) = list(remote snapshot names)
+        """
+        # Translate remote names back to local ones once, the stream is
+        # received with zfs receive -d so the local pool name is replaced
+        # by the remote dataset, e.g. tank/a@snap -> backup/a@snap
+        replicated = set()
+        for repl, snaps in replications.iteritems():
+            localfs = repl.repl_filesystem
+            pool = localfs.split('/', 1)[0]
+            remotefs = repl.repl_zfs
+            for remotename in snaps:
+                if not remotename.startswith(remotefs):
+                    continue
+                rest = remotename[len(remotefs):]
+                if rest[:1] not in ('/', '@'):
+                    continue
+                localname = pool + rest
+                if (
+                    localname.startswith(localfs) and
+                    localname[len(localfs):len(localfs) + 1] in ('/', '@')
+                ):
+                    replicated.add(localname)
+                # Remote side laid out as the local one
+                replicated.add(remotename)
+
+        for snap in snapshots:
+            if snap.fullname in replicated:
+                snap.replication = 'OK'
+
     def zfs_mksnap(self, dataset, name, recursive=False):
         if recursive:
             p1 = self._pipeopen("/sbin/zfs snapshot -r '%s'@'%s'" % (dataset, name))
@@ -3843,18 +3886,30 @@ class notifier:
 
     def __init__(self):
         self.__confxml = None
+        self.__geomtopology = None
         self.__camcontrol = None
-        self.__diskserial = {}
         self.__twcli = {}
 
     def __del__(self):
         self.__confxml = None
+        self.__geomtopology = None
 
     def _geom_confxml(self):
         if self.__confxml is None:
             self.__confxml = etree.fromstring(self.sysctl('kern.geom.confxml'))
         return self.__confxml
 
+    def _geom_topology(self):
+        """
+        Indexed GEOM topology for the current confxml
+
+        It is rebuilt whenever the confxml cache is invalidated
+        """
+        doc = self._geom_confxml()
+        if self.__geomtopology is None or self.__geomtopology.doc is not doc:
+            self.__geomtopology = GEOMTopology(doc)
+        return self.__geomtopology
+
     def __get_twcli(self, controller):
         if controller in self.__twcli:
             return self.__twcli[controller]
@@ -3870,10 +3925,40 @@ class notifier:
         self.__twcli[controller] = units
         return self.__twcli[controller]
 
+    def _disk_generation(self):
+        """
+        Describe the set of attached disks, any attach/detach event
+        yields a different value (new GEOM ids)
+        """
+        return frozenset(
+            (name, geom.get('id'))
+            for name, geom in self._geom_topology().geoms['DISK'].items()
+        )
+
     def serial_from_device(self, devname):
-        if devname in self.__diskserial:
-            return self.__diskserial.get(devname)
+        return DISK_INVENTORY.serial(
+            devname,
+            self._probe_serial,
+            self._disk_generation(),
+        )
+
+    def serials_from_devices(self, devnames):
+        """
+        Get the serial of every device in ``devnames`` at once,
+        probing the unknown ones concurrently
 
+        Returns:
+            dict(devname) = serial
+        """
+        # Warm up controller info before spawning the workers
+        self._camcontrol_list()
+        return DISK_INVENTORY.sweep(
+            devnames,
+            self._probe_serial,
+            self._disk_generation(),
+        )
+
+    def _probe_serial(self, devname):
         args = ["/dev/%s" % devname]
         camcontrol = self._camcontrol_list()
         info = camcontrol.get(devname)
@@ -3919,9 +4004,7 @@ class notifier:
         output = p1.communicate()[0]
         search = re.search(r'Serial Number:\s+(?P<serial>.+)', output, re.I)
         if search:
-            serial = search.group("serial")
-            self.__diskserial[devname] = serial
-            return serial
+            return search.group("serial")
         return None
 
     def label_to_disk(self, name):
@@ -3929,46 +4012,53 @@ class notifier:
         Given a label go through the geom tree to find out the disk name
         label = a geom label or a disk partition
         """
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         # try to find the provider from GEOM_LABEL
-        search = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % name)
-        if len(search) > 0:
-            provider = search[0]
+        label = topology.provider_by_name('LABEL', name)
+        if label is not None:
+            geom = label.getparent()
         else:
             # the label does not exist, try to find it in GEOM DEV
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']//provider/@ref" % name)
-            if len(search) > 0:
-                provider = search[0]
-            else:
-                return None
-        search = doc.xpath("//provider[@id = '%s']/../name" % provider)
-        disk = search[0].text
-        if search[0].getparent().getparent().xpath("./name")[0].text in ('ELI', ):
+            geom = topology.geom('DEV', name)
+        if geom is None:
+            return None
+        consumed = topology.consumed(geom)
+        if not consumed:
+            return None
+        provider = consumed[0]
+        disk = topology.geom_name(provider)
+        if topology.class_name(provider) in ('ELI', ):
             return self.label_to_disk(disk.replace(".eli", ""))
         return disk
 
     def device_to_identifier(self, name):
         name = str(name)
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         serial = self.serial_from_device(name)
         if serial:
             return "{serial}%s" % serial
 
-        search = doc.xpath("//class[name = 'PART']/..//*[name = '%s']//config[type = 'freebsd-zfs']/rawuuid" % name)
-        if len(search) > 0:
-            return "{uuid}%s" % search[0].text
-        search = doc.xpath("//class[name = 'PART']/geom/..//*[name = '%s']//config[type = 'freebsd-ufs']/rawuuid" % name)
-        if len(search) > 0:
-            return "{uuid}%s" % search[0].text
+        for parttype in ('freebsd-zfs', 'freebsd-ufs'):
+            # name can either be a partition or a partitioned disk
+            part = topology.provider_by_name('PART', name)
+            if part is not None:
+                parts = [part] if part.findtext('config/type') == parttype else []
+            else:
+                parts = topology.partitions(name, parttype)
+            for part in parts:
+                rawuuid = part.findtext('config/rawuuid')
+                if rawuuid:
+                    return "{uuid}%s" % rawuuid
 
-        search = doc.xpath("//class[name = 'LABEL']/geom[name = '%s']/provider/name" % name)
-        if len(search) > 0:
-            return "{label}%s" % search[0].text
+        geom = topology.geom('LABEL', name)
+        if geom is not None:
+            label = geom.findtext('provider/name')
+            if label:
+                return "{label}%s" % label
 
-        search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % name)
-        if len(search) > 0:
+        if topology.geom('DEV', name) is not None:
             return "{devicename}%s" % name
 
         return ''
@@ -3978,7 +4068,7 @@ class notifier:
         if not ident:
             return None
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         search = re.search(r'\{(?P<type>.+?)\}(?P<value>.+)', ident)
         if not search:
@@ -3988,29 +4078,32 @@ class notifier:
         value = search.group("value")
 
         if tp == 'uuid':
-            search = doc.xpath("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % value)
-            if len(search) > 0:
-                for entry in search:
-                    if not entry.text.startswith('label'):
-                        return entry.text
+            for part in topology.rawuuids.get(value, []):
+                if topology.class_name(part) != 'PART':
+                    continue
+                disk = topology.geom_name(part)
+                if not disk.startswith('label'):
+                    return disk
             return None
 
         elif tp == 'label':
-            search = doc.xpath("//class[name = 'LABEL']/geom//provider[name = '%s']/../name" % value)
-            if len(search) > 0:
-                return search[0].text
+            label = topology.provider_by_name('LABEL', value)
+            if label is not None:
+                return topology.geom_name(label)
             return None
 
         elif tp == 'serial':
-            for devname in self.__get_disks():
-                serial = self.serial_from_device(devname)
-                if serial == value:
-                    return devname
-            return None
+            # Warm up controller info before spawning the workers
+            self._camcontrol_list()
+            return DISK_INVENTORY.device(
+                value,
+                self.__get_disks(),
+                self._probe_serial,
+                self._disk_generation(),
+            )
 
         elif tp == 'devicename':
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % value)
-            if len(search) > 0:
+            if topology.geom('DEV', value) is not None:
                 return value
             return None
         else:
@@ -4021,11 +4114,11 @@ class notifier:
         Given a partition a type and a disk name (adaX)
         get the first partition that matches the type
         """
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         #TODO get from MBR as well?
-        search = doc.xpath("//class[name = 'PART']/geom[name = '%s']//config[type = 'freebsd-%s']/../name" % (device, name))
-        if len(search) > 0:
-            return search[0].text
+        parts = topology.partitions(device, 'freebsd-%s' % name)
+        if parts:
+            return parts[0].findtext('name')
         else:
             return ''
 
@@ -4044,21 +4137,22 @@ class notifier:
         Returns:
             The provider xmlnode if found, None otherwise
         """
-        doc = self._geom_confxml()
-        xpath = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % "%s/%s" % (geom, name))
-        if not xpath:
+        topology = self._geom_topology()
+        label = topology.provider_by_name('LABEL', "%s/%s" % (geom, name))
+        if label is None:
+            return None
+        consumed = topology.consumed(label.getparent())
+        if not consumed:
             return None
-        providerid = xpath[0]
-        provider = doc.xpath("//provider[@id = '%s']" % providerid)[0]
+        provider = consumed[0]
 
-        class_name = provider.xpath("../../name")[0].text
+        class_name = topology.class_name(provider)
 
         # We've got a GPT over the softraid, not raw UFS filesystem
         # So we need to recurse one more time
         if class_name == 'PART':
-            providerid = provider.xpath("../consumer/provider/@ref")[0]
-            newprovider = doc.xpath("//provider[@id = '%s']" % providerid)[0]
-            class_name = newprovider.xpath("../../name")[0].text
+            newprovider = topology.consumed(provider.getparent())[0]
+            class_name = topology.class_name(newprovider)
             # if this PART is really backed up by softraid the hypothesis was correct
             if class_name in ('STRIPE', 'MIRROR', 'RAID3'):
                 return newprovider
@@ -4071,10 +4165,9 @@ class notifier:
         if geomname in ('DISK', 'PART'):
             disks.append(provider.xpath("../name")[0].text)
         elif geomname in ('STRIPE', 'MIRROR', 'RAID3'):
-            doc = self._geom_confxml()
-            for prov in provider.xpath("../consumer/provider/@ref"):
-                prov2 = doc.xpath("//provider[@id = '%s']" % prov)[0]
-                disks.append(prov2.xpath("../name")[0].text)
+            topology = self._geom_topology()
+            for prov2 in topology.consumed(provider.getparent()):
+                disks.append(topology.geom_name(prov2))
         else:
             #TODO log, could not get disks
             pass
@@ -4175,8 +4268,8 @@ class notifier:
         if devname.find("/") != -1:
             return
 
-        doc = self._geom_confxml()
-        self.__diskserial.clear()
+        topology = self._geom_topology()
+        DISK_INVENTORY.forget(devname)
         self.__camcontrol = None
 
         ident = self.device_to_identifier(devname)
@@ -4196,9 +4289,9 @@ class notifier:
         if reg:
             disk.disk_subsystem = reg.group(1)
             disk.disk_number = int(reg.group(2))
-        mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % devname)
+        mediasize = topology.mediasize(devname)
         if mediasize:
-            disk.disk_size = mediasize[0].text
+            disk.disk_size = mediasize
         disk.save()
 
     def sync_disk_extra(self, disk, add=False):
@@ -4207,10 +4300,12 @@ class notifier:
     def sync_disks(self):
         from freenasUI.storage.models import Disk
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         disks = self.__get_disks()
-        self.__diskserial.clear()
+        DISK_INVENTORY.invalidate()
         self.__camcontrol = None
+        # Probe every serial in one parallel sweep
+        self.serials_from_devices(disks)
 
         in_disks = {}
         serials = []
@@ -4236,9 +4331,9 @@ class notifier:
             if disk.disk_serial:
                 serials.append(disk.disk_serial)
 
-            mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % dskname)
+            mediasize = topology.mediasize(dskname)
             if mediasize:
-                disk.disk_size = mediasize[0].text
+                disk.disk_size = mediasize
 
             self.sync_disk_extra(disk, add=False)
 
@@ -4259,9 +4354,9 @@ class notifier:
                 d.disk_name = disk
                 d.disk_identifier = self.device_to_identifier(disk)
                 d.disk_serial = self.serial_from_device(disk) or ''
-                mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % disk)
+                mediasize = topology.mediasize(disk)
                 if mediasize:
-                    d.disk_size = mediasize[0].text
+                    d.disk_size = mediasize
                 if d.disk_serial:
                     if d.disk_serial in serials:
                         #Probably dealing with multipath here, do not add another
@@ -4434,13 +4529,12 @@ class notifier:
         """
         from freenasUI.storage.models import Volume, Disk
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         mp_disks = []
-        for geom in doc.xpath("//class[name = 'MULTIPATH']/geom"):
-            for provref in geom.xpath("./consumer/provider/@ref"):
-                prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
-                class_name = prov.xpath("../../name")[0].text
+        for geom in topology.geoms['MULTIPATH'].values():
+            for prov in topology.consumed(geom):
+                class_name = topology.class_name(prov)
                 #For now just DISK is allowed
                 if class_name != 'DISK':
                     log.warn(
@@ -4449,7 +4543,7 @@ class notifier:
                         class_name
                     )
                     continue
-                disk = prov.xpath("../name")[0].text
+                disk = topology.geom_name(prov)
                 mp_disks.append(disk)
 
         reserved = [self._find_root_dev()]
@@ -4461,8 +4555,7 @@ class notifier:
         serials = defaultdict(list)
         active_active = []
         RE_CD = re.compile('^cd[0-9]')
-        for geom in doc.xpath("//class[name = 'DISK']/geom"):
-            name = geom.xpath("./name")[0].text
+        for name, geom in topology.geoms['DISK'].items():
             if RE_CD.match(name) or name in reserved or name in mp_disks:
                 continue
             if self._multipath_is_active(name, geom):
@@ -4485,17 +4578,16 @@ class notifier:
             self.multipath_create(name, disks, active_active)
 
         # Grab confxml again to take new multipaths into account
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         mp_ids = []
-        for geom in doc.xpath("//class[name = 'MULTIPATH']/geom"):
+        for geom in topology.geoms['MULTIPATH'].values():
             _disks = []
-            for provref in geom.xpath("./consumer/provider/@ref"):
-                prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
-                class_name = prov.xpath("../../name")[0].text
+            for prov in topology.consumed(geom):
+                class_name = topology.class_name(prov)
                 #For now just DISK is allowed
                 if class_name != 'DISK':
                     continue
-                disk = prov.xpath("../name")[0].text
+                disk = topology.geom_name(prov)
                 _disks.append(disk)
             qs = Disk.objects.filter(
                 Q(disk_name__in=_disks)|Q(disk_multipath_member__in=_disks)
@@ -4672,12 +4764,9 @@ class notifier:
         """
         Get _ALL_ geom nodes that depends on a given provider
         """
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         geoms = []
-        for c in doc.xpath("//consumer/provider[@ref = '%s']" % (prvid, )):
-            geom = c.getparent().getparent()
-            if geom.tag != 'geom':
-                continue
+        for geom in topology.consumers_of(prvid):
             geoms.append(geom)
             for prov in geom.xpath('./provider'):
                 geoms.extend(self.__get_geoms_recursive(prov.attrib.get('id')))
@@ -4685,12 +4774,9 @@ class notifier:
         return geoms
 
     def disk_get_consumers(self, devname):
-        doc = self._geom_confxml()
-        geom = doc.xpath("//class[name = 'DISK']/geom[name = '%s']" % (
-            devname,
-        ))
-        if geom:
-            provid = geom[0].xpath("./provider/@id")[0]
+        geom = self._geom_topology().geom('DISK', devname)
+        if geom is not None:
+            provid = geom.xpath("./provider/@id")[0]
         else:
             raise ValueError("Unknown disk %s" % (devname, ))
         return self.__get_geoms_recursive(provid)
@@ -4716,8 +4802,10 @@ class notifier:
 
     def disk_wipe(self, devname, mode='quick'):
         if mode == 'quick':
-            doc = self._geom_confxml()
-            parts = [node.text for node in doc.xpath("//class[name = 'PART']/geom[name = '%s']/provider/name" % devname)]
+            parts = [
+                node.findtext('name')
+                for node in self._geom_topology().partitions(devname)
+            ]
             """
             Wipe beginning and the end of every partition
             This should erase ZFS label and such to prevent further errors on replace
@@ -0,0 +1,408 @@
+#-
+# Copyright (c) 2013 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+from collections import defaultdict
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('middleware.replication')
+
+# Seconds a remote snapshot list is considered fresh
+REMOTE_SNAPSHOTS_TTL = 60
+# Seconds to wait for a remote that was never queried yet
+REMOTE_SNAPSHOTS_WAIT = 5
+# Seconds before a remote that could not be queried is queried again
+REMOTE_SNAPSHOTS_RETRY = 30
+# Touched by autorepl after a task sent snapshots to user@host:port,
+# entries of that remote older than this file are refreshed
+REMOTE_SNAPSHOTS_STAMP = '/tmp/.repl-remote-stamp-%s@%s:%d'
+# Replication tasks running at once, overall and per remote system
+REPL_WORKERS = 4
+REPL_REMOTE_WORKERS = 2
+# Bytes moved per read/write between zfs send and the transport
+REPL_BUFSIZE = 1024 * 1024
+# Seconds between two updates of the progress file
+REPL_PROGRESS_INTERVAL = 1
+# Seconds without update after which a progress file is ignored, the
+# autorepl process that wrote it is gone
+REPL_PROGRESS_STALE = 60
+# Replication compression -> (local compress, remote decompress) commands
+REPL_COMPRESSION = {
+    'pigz': ('/usr/local/bin/pigz', '/usr/local/bin/pigz -d'),
+    'plzip': ('/usr/local/bin/plzip', '/usr/local/bin/plzip -d'),
+    'lz4': ('/usr/local/bin/lz4c', '/usr/local/bin/lz4c -d'),
+}
+
+
+def remote_key(remote):
+    """
+    Hashable key of a ReplRemote, tasks sharing the same remote system
+    share the same snapshot list
+    """
+    if remote.ssh_remote_dedicateduser_enabled:
+        user = remote.ssh_remote_dedicateduser
+    else:
+        user = 'root'
+    return (remote.ssh_remote_hostname, remote.ssh_remote_port, user)
+
+
+class RemoteSnapshotCache(object):
+    """
+    Snapshot lists of the remote side of replication tasks
+
+    Lists are fetched in background threads, one per remote system, so
+    remotes are queried concurrently and a slow or unreachable one does
+    not hold up the others nor the caller once it was queried.
+    """
+
+    def __init__(self, ttl=REMOTE_SNAPSHOTS_TTL, wait=REMOTE_SNAPSHOTS_WAIT,
+                 retry=REMOTE_SNAPSHOTS_RETRY, stamp=REMOTE_SNAPSHOTS_STAMP):
+        self.ttl = ttl
+        self.wait = wait
+        self.retry = retry
+        self.stamp = stamp
+        self._lock = threading.Lock()
+        # remote key -> (timestamp, frozenset(snapshot names))
+        self._entries = {}
+        # remote key -> time of the last failed refresh
+        self._failed = {}
+        # remote key -> threading.Event set once the refresh is done
+        self._refreshing = {}
+
+    def _stampfile(self, key):
+        host, port, user = key
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        if isinstance(host, unicode):
+            host = host.encode('utf-8')
+        return self.stamp % (user, host, port)
+
+    def _stamp(self, key):
+        try:
+            return os.stat(self._stampfile(key)).st_mtime
+        except OSError:
+            return 0
+
+    def _refresh(self, key, fetch, repl):
+        try:
+            names = frozenset(fetch(repl))
+        except Exception, e:
+            log.warn("Failed to get remote snapshots of %s: %s", key[0], e)
+            names = None
+        with self._lock:
+            # A failure keeps the previous list, if any, and is only
+            # retried after self.retry
+            if names is None:
+                self._failed[key] = time.time()
+            else:
+                self._failed.pop(key, None)
+                self._entries[key] = (time.time(), names)
+            event = self._refreshing.pop(key)
+        event.set()
+
+    def get(self, replications, fetch):
+        """
+        Snapshot names present in the remote side of every replication
+
+        ``fetch(repl)`` returns the list of snapshot names of the remote
+        system of ``repl``, it is called from a worker thread.
+
+        Returns:
+            dict(Replication) = frozenset(remote snapshot names)
+        """
+        now = time.time()
+        byremote = {}
+        for repl in replications:
+            byremote.setdefault(remote_key(repl.repl_remote), repl)
+
+        waits = []
+        with self._lock:
+            for key, repl in byremote.items():
+                entry = self._entries.get(key)
+                if (
+                    entry and entry[0] >= self._stamp(key) and
+                    now - entry[0] < self.ttl
+                ):
+                    continue
+                failed = self._failed.get(key)
+                if failed is not None and now - failed < self.retry:
+                    continue
+                event = self._refreshing.get(key)
+                if event is None:
+                    event = self._refreshing[key] = threading.Event()
+                    thread = threading.Thread(
+                        target=self._refresh,
+                        args=(key, fetch, repl),
+                    )
+                    thread.daemon = True
+                    thread.start()
+                # Stale entries are served while being refreshed, only
+                # wait for a remote that was never queried
+                if entry is None and failed is None:
+                    waits.append(event)
+
+        deadline = now + self.wait
+        for event in waits:
+            event.wait(max(deadline - time.time(), 0))
+
+        retval = {}
+        with self._lock:
+            for repl in replications:
+                entry = self._entries.get(remote_key(repl.repl_remote))
+                retval[repl] = entry[1] if entry else frozenset()
+        return retval
+
+    def invalidate(self, remote):
+        """
+        Mark the list of a ReplRemote as stale, for this and other
+        processes
+        """
+        stamp = self._stampfile(remote_key(remote))
+        try:
+            with open(stamp, 'a'):
+                os.utime(stamp, None)
+        except IOError, e:
+            log.warn("Failed to touch %s: %s", stamp, e)
+
+
+REMOTE_SNAPSHOTS = RemoteSnapshotCache()
+
+
+class ReplicationScheduler(object):
+    """
+    Runs replication tasks concurrently
+
+    Tasks are started most lagging first, no more than ``workers`` at once
+    overall and ``per_remote`` at once against the same remote system, so
+    a large send to one target does not hold up the tasks of the others.
+    Tasks of the same local dataset share its snapshot states and are
+    never run at the same time.
+    """
+
+    def __init__(self, workers=REPL_WORKERS, per_remote=REPL_REMOTE_WORKERS):
+        self.workers = workers
+        self.per_remote = per_remote
+        self._cond = threading.Condition()
+        self._pending = []
+        # remote key -> number of running tasks
+        self._remotes = defaultdict(int)
+        # local datasets being replicated
+        self._datasets = set()
+
+    def _keys(self, repl):
+        return remote_key(repl.repl_remote), repl.repl_filesystem
+
+    def _next(self):
+        with self._cond:
+            while self._pending:
+                for i, repl in enumerate(self._pending):
+                    remote, dataset = self._keys(repl)
+                    if self._remotes[remote] >= self.per_remote:
+                        continue
+                    if dataset in self._datasets:
+                        continue
+                    del self._pending[i]
+                    self._remotes[remote] += 1
+                    self._datasets.add(dataset)
+                    return repl
+                # Everything left waits for a running task to finish
+                self._cond.wait()
+        return None
+
+    def _done(self, repl):
+        remote, dataset = self._keys(repl)
+        with self._cond:
+            self._remotes[remote] -= 1
+            self._datasets.discard(dataset)
+            self._cond.notify_all()
+
+    def _worker(self, func):
+        while True:
+            repl = self._next()
+            if repl is None:
+                break
+            try:
+                func(repl)
+            except Exception, e:
+                log.error("Replication %s failed: %s", repl, e, exc_info=True)
+            finally:
+                self._done(repl)
+
+    def run(self, replications, func, lag):
+        """
+        Call ``func(repl)`` for every replication and wait for all of them
+
+        ``lag(repl)`` is the time of the last snapshot replicated by
+        ``repl``, the oldest ones are started first.
+        """
+        with self._cond:
+            self._pending = sorted(replications, key=lag)
+            count = min(self.workers, len(self._pending))
+
+        threads = []
+        for i in range(count):
+            thread = threading.Thread(target=self._worker, args=(func, ))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+
+class TokenBucket(object):
+    """
+    Limits a byte stream to ``rate`` bytes per second
+
+    Bursts up to ``burst`` bytes pass through, beyond that consume()
+    sleeps for as long as the stream is ahead of its rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate), REPL_BUFSIZE)
+        self._tokens = self.burst
+        self._last = time.time()
+
+    def consume(self, nbytes):
+        now = time.time()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last) * self.rate
+        )
+        self._last = now
+        self._tokens -= nbytes
+        if self._tokens < 0:
+            time.sleep(-self._tokens / self.rate)
+
+
+class ReplicationProgress(object):
+    """
+    Progress of the snapshot being sent by a replication task
+
+    Written by autorepl at most every ``interval`` seconds to ``path`` as
+    JSON and read back by Replication.status through read().
+    """
+
+    def __init__(self, path, snapshot, total=None,
+                 interval=REPL_PROGRESS_INTERVAL):
+        self.path = path
+        self.snapshot = snapshot
+        self.total = total
+        self.interval = interval
+        self.sent = 0
+        self.started = time.time()
+        self._written = 0
+
+    def update(self, nbytes, force=False):
+        self.sent += nbytes
+        now = time.time()
+        if force or now - self._written >= self.interval:
+            self._written = now
+            self._write(now)
+
+    def _write(self, now):
+        elapsed = now - self.started
+        rate = self.sent / elapsed if elapsed > 0 else 0
+        if self.total and rate:
+            eta = max(self.total - self.sent, 0) / rate
+        else:
+            eta = None
+        data = {
+            'snapshot': self.snapshot,
+            'sent': self.sent,
+            'total': self.total,
+            'rate': rate,
+            'eta': eta,
+            'started': self.started,
+            'updated': now,
+        }
+        tmp = '%s.tmp' % self.path
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            log.warn("Failed to write %s: %s", self.path, e)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def read(path, stale=REPL_PROGRESS_STALE):
+        """
+        Returns:
+            dict(snapshot, sent, total, rate, eta, started, updated)
+            or None if nothing is being sent or it was not updated for
+            ``stale`` seconds
+        """
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if time.time() - data.get('updated', 0) > stale:
+            return None
+        return data
+
+
+class ReplicationStream(object):
+    """
+    Moves a zfs send stream from ``src`` to ``dst`` file descriptors
+
+    One buffer is reused for every chunk so the stream is not copied
+    into new strings on its way, the rate limit and progress accounting
+    are applied in between.
+    """
+
+    def __init__(self, limit=0, progress=None, bufsize=REPL_BUFSIZE):
+        # limit in KiB/s, as the replication task stores it
+        self.bucket = TokenBucket(limit * 1024) if limit else None
+        self.progress = progress
+        self.bufsize = bufsize
+
+    def run(self, src, dst):
+        buf = bytearray(self.bufsize)
+        view = memoryview(buf)
+        reader = io.FileIO(src, 'r', closefd=False)
+        writer = io.FileIO(dst, 'w', closefd=False)
+        while True:
+            nbytes = reader.readinto(buf)
+            if not nbytes:
+                break
+            if self.bucket:
+                self.bucket.consume(nbytes)
+            written = 0
+            while written < nbytes:
+                written += writer.write(view[written:nbytes])
+            if self.progress:
+                self.progress.update(nbytes)
+        if self.progress:
+            self.progress.update(0, force=True)
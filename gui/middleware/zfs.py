@@ -35,6 +35,7 @@ from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext_lazy as _
 
 from freenasUI.common import humanize_size
+from freenasUI.middleware.exceptions import MiddlewareError
 
 log = logging.getLogger('middleware.zfs')
 
@@ -76,6 +77,34 @@ def zfs_size_to_bytes(size):
         return size
 
 
+def zfs_nicenum(num):
+    """
+    Format a number of bytes the same way zfs(8) does, e.g. 1.50G
+
+    This allows to use parsable (-p) output and still present the
+    very same strings the non parsable output would.
+    """
+    try:
+        num = int(num)
+    except (TypeError, ValueError):
+        return num
+    n = num
+    index = 0
+    while n >= 1024:
+        n /= 1024
+        index += 1
+    if index == 0:
+        return '%d' % n
+    unit = ' KMGTPE'[index]
+    if num & ((1 << 10 * index) - 1) == 0:
+        return '%d%s' % (n, unit)
+    for i in (2, 1, 0):
+        value = '%.*f%s' % (i, float(num) / (1 << 10 * index), unit)
+        if len(value) <= 5:
+            break
+    return value
+
+
 class Pool(object):
     """
     Class representing a Zpool
@@ -575,7 +604,9 @@ class Snapshot(object):
         refer,
         mostrecent=False,
         parent_type=None,
-        replication=None
+        replication=None,
+        used_bytes=None,
+        refer_bytes=None,
     ):
         self.name = name
         self.filesystem = filesystem
@@ -584,6 +615,8 @@ class Snapshot(object):
         self.mostrecent = mostrecent
         self.parent_type = parent_type
         self.replication = replication
+        self._used_bytes = used_bytes
+        self._refer_bytes = refer_bytes
 
     def __repr__(self):
         return u"<Snapshot: %s>" % self.fullname
@@ -594,10 +627,14 @@ class Snapshot(object):
 
     @property
     def used_bytes(self):
+        if self._used_bytes is not None:
+            return self._used_bytes
         return zfs_size_to_bytes(self.used)
 
     @property
     def refer_bytes(self):
+        if self._refer_bytes is not None:
+            return self._refer_bytes
         return zfs_size_to_bytes(self.refer)
 
 
@@ -837,65 +874,391 @@ def parse_status(name, doc, data):
     return pool
 
 
-def list_datasets(path="", recursive=False, hierarchical=False,
-                  include_root=False):
+class ZFSRecord(object):
     """
-    Return a dictionary that contains all ZFS dataset list and their
-    mountpoints
+    Compact record of a single dataset, zvol or snapshot
+
+    Sizes and creation are kept as integers (zfs list -p), None
+    stands for "-" (property not applicable).
+    """
+
+    __slots__ = (
+        'name', 'type', 'used', 'avail', 'refer', 'mountpoint', 'volsize',
+        'creation', 'props',
+    )
+
+    def __init__(self, name, type, used, avail, refer, mountpoint, volsize,
+                 creation, props=None):
+        self.name = name
+        self.type = type
+        self.used = used
+        self.avail = avail
+        self.refer = refer
+        self.mountpoint = mountpoint
+        self.volsize = volsize
+        self.creation = creation
+        self.props = props
+
+    def __repr__(self):
+        return "<ZFSRecord: %s (%s)>" % (self.name, self.type)
+
+    @property
+    def dataset(self):
+        """
+        Name of the dataset for snapshots, name itself otherwise
+        """
+        return self.name.split('@', 1)[0]
+
+
+def _zfs_int(value):
+    if value == '-':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class ZFSInventory(object):
+    """
+    Point in time snapshot of filesystems, zvols and snapshots
+
+    Everything is gathered from a single zfs list -p run and indexed by
+    name, by parent (the name prefix tree) and by dataset for snapshots,
+    so several views (datasets, zvols, snapshots, properties) can be
+    served without walking the pool again.
+    """
+
+    COLUMNS = (
+        'name', 'type', 'used', 'avail', 'refer', 'mountpoint', 'volsize',
+        'creation',
+    )
+
+    def __init__(self, path=None, types=None, props=None, recursive=True):
+        if types is None:
+            types = ('filesystem', 'volume', 'snapshot')
+        self.path = path
+        self.types = tuple(types)
+        self.props = tuple(props or ())
+        # name -> ZFSRecord
+        self.records = {}
+        # parent name -> [child names], filesystems and zvols only
+        self.children = {}
+        # dataset name -> [snapshot records], oldest first
+        self.snapshots = {}
+        # top level names (pools, or path itself)
+        self.roots = []
+        self._load(recursive)
+
+    def _load(self, recursive):
+        args = [
+            "/sbin/zfs",
+            "list",
+            "-H",
+            "-p",
+            "-t", ",".join(self.types),
+            "-o", ",".join(self.COLUMNS + self.props),
+        ]
+        if self.path:
+            if recursive:
+                args.append("-r")
+            args.append(str(self.path))
+
+        zfsproc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        ncols = len(self.COLUMNS)
+        for line in zfsproc.stdout:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            data = line.split('\t')
+            if self.props:
+                props = dict(zip(self.props, data[ncols:]))
+            else:
+                props = None
+            self._add(ZFSRecord(
+                name=data[0],
+                type=data[1],
+                used=_zfs_int(data[2]),
+                avail=_zfs_int(data[3]),
+                refer=_zfs_int(data[4]),
+                mountpoint=data[5] if data[5] != '-' else None,
+                volsize=_zfs_int(data[6]),
+                creation=_zfs_int(data[7]),
+                props=props,
+            ))
+        err = zfsproc.stderr.read()
+        zfsproc.wait()
+        if zfsproc.returncode != 0 and err:
+            log.debug("zfs list failed: %s", err)
+
+    def _add(self, record):
+        self.records[record.name] = record
+        if record.type == 'snapshot':
+            self.snapshots.setdefault(record.dataset, []).append(record)
+            return
+        self.children.setdefault(record.name, [])
+        if '/' in record.name:
+            parent = record.name.rsplit('/', 1)[0]
+            if parent in self.children:
+                self.children[parent].append(record.name)
+                return
+        self.roots.append(record.name)
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def get(self, name, default=None):
+        return self.records.get(name, default)
+
+    def descendants(self, name, include_self=False):
+        """
+        Walk the prefix tree below ``name``, parents before children
+        """
+        if include_self:
+            yield self.records[name]
+        stack = list(reversed(self.children.get(name, [])))
+        while stack:
+            child = stack.pop()
+            yield self.records[child]
+            stack.extend(reversed(self.children.get(child, [])))
+
+    def _walk(self, path=None, recursive=True):
+        if path and path in self.children:
+            if not recursive:
+                return [self.records[path]]
+            return self.descendants(path, include_self=True)
+        if path and not recursive:
+            return []
+        records = []
+        for root in self.roots:
+            records.extend(self.descendants(root, include_self=True))
+        if path:
+            # path itself was not listed, e.g. only zvols were asked for
+            prefix = path + '/'
+            records = [r for r in records if r.name.startswith(prefix)]
+        return records
+
+    def list_datasets(self, path="", recursive=False, hierarchical=False,
+                      include_root=False):
+        """
+        Same as the module level list_datasets but out of the inventory
+        """
+        zfslist = ZFSList()
+        datasets = {}
+        for record in self._walk(path, recursive or not path):
+            if record.type != 'filesystem':
+                continue
+            # root filesystem is not treated as dataset by us
+            if '/' not in record.name and not include_root:
+                continue
+            dataset = ZFSDataset(
+                path=record.name,
+                used=zfs_nicenum(record.used),
+                avail=zfs_nicenum(record.avail),
+                refer=zfs_nicenum(record.refer),
+                mountpoint=record.mountpoint or '-',
+            )
+            datasets[record.name] = dataset
+            if not hierarchical:
+                zfslist.append(dataset)
+                continue
+            parent = datasets.get(record.name.rsplit('/', 1)[0])
+            if parent is not None and '/' in record.name:
+                parent.append(dataset)
+            else:
+                zfslist.append(dataset)
+        return zfslist
+
+    def zvols(self, path=None):
+        """
+        Returns:
+            dict(name) = dict(volsize, used, avail, refer)
+        """
+        retval = {}
+        for record in self._walk(path):
+            if record.type != 'volume':
+                continue
+            retval[record.name] = {
+                'volsize': zfs_nicenum(record.volsize),
+                'used': zfs_nicenum(record.used),
+                'avail': zfs_nicenum(record.avail),
+                'refer': zfs_nicenum(record.refer),
+            }
+        return retval
+
+    def properties(self, props=None):
+        """
+        Extra properties requested at creation time
+
+        Returns:
+            dict(name) = dict(prop) = value
+        """
+        retval = {}
+        for name, record in self.records.iteritems():
+            if record.props is None:
+                continue
+            if props is None:
+                retval[name] = dict(record.props)
+            else:
+                retval[name] = dict(
+                    (k, v) for k, v in record.props.items() if k in props
+                )
+        return retval
+
+    def snapshot_list(self):
+        """
+        Snapshots grouped by dataset, oldest first, the way
+        notifier.zfs_snapshot_list presents them
+
+        Returns:
+            dict(dataset) = [Snapshot, ...]
+        """
+        fsinfo = {}
+        for fs, records in self.snapshots.iteritems():
+            snaplist = []
+            last = len(records) - 1
+            parent = self.records.get(fs)
+            for i, record in enumerate(records):
+                if parent is not None:
+                    volume = parent.type == 'volume'
+                else:
+                    # Only snapshots were listed, zvol snapshots have volsize
+                    volume = record.volsize is not None
+                snaplist.append(Snapshot(
+                    name=record.name.split('@', 1)[1],
+                    filesystem=fs,
+                    used=zfs_nicenum(record.used),
+                    refer=zfs_nicenum(record.refer),
+                    mostrecent=(i == last),
+                    parent_type='volume' if volume else 'filesystem',
+                    used_bytes=record.used,
+                    refer_bytes=record.refer,
+                ))
+            fsinfo[fs] = snaplist
+        return fsinfo
+
+
+# Snapshot fields which can be sorted natively by zfs list -s/-S
+SNAPSHOT_SORT_FIELDS = {
+    'fullname': 'name',
+    'filesystem': 'name',
+    'used': 'used',
+    'refer': 'refer',
+    'creation': 'creation',
+}
+
+
+def list_snapshots_window(offset=0, limit=None, sort=None, prefix=None):
+    """
+    Stream zfs list -t snapshot keeping only the [offset, offset + limit)
+    window, so memory does not grow with the number of snapshots.
+
+    ``sort`` is a list of fields, prefixed by '-' for descending order,
+    as in SNAPSHOT_SORT_FIELDS. Ordering is done by zfs list itself.
+    The last field is the primary key, as when sorting in python.
+
+    ``prefix`` only keeps snapshots whose full name starts with it.
+
+    Raises:
+        ValueError: a sort field cannot be handled by zfs list
+        MiddlewareError: zfs list failed, e.g. the dataset the prefix
+            implies does not exist
+
+    Returns:
+        tuple(total, [Snapshot, ...])
     """
     args = [
         "/sbin/zfs",
         "list",
         "-H",
-        "-t", "filesystem",
-        "-s", "name",
+        "-p",
+        "-t", "snapshot",
+        "-o", "name,used,refer,volsize,createtxg",
     ]
-    if recursive:
-        args.insert(3, "-r")
-    if path:
-        args.append(path)
-
+    for field in reversed(sort or []):
+        if field.startswith('-'):
+            flag, field = '-S', field[1:]
+        else:
+            flag = '-s'
+        if field not in SNAPSHOT_SORT_FIELDS:
+            raise ValueError(field)
+        args.extend([flag, SNAPSHOT_SORT_FIELDS[field]])
+    if prefix:
+        # Narrow down the walk to the deepest dataset the prefix implies
+        dataset = prefix.split('@', 1)[0]
+        if '@' not in prefix:
+            dataset = dataset.rsplit('/', 1)[0] if '/' in dataset else None
+        if dataset:
+            args.extend(["-r", str(dataset)])
+
+    end = offset + limit if limit is not None else None
+    total = 0
+    window = []
+    # dataset -> highest createtxg, to find out the most recent snapshot
+    latest = {}
     zfsproc = subprocess.Popen(
         args,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE)
-
-    zfs_output, zfs_err = zfsproc.communicate()
-    zfs_output = zfs_output.split('\n')
-    zfslist = ZFSList()
-    last_dataset = None
-    last_depth = 2
-    for line in zfs_output:
+    for line in zfsproc.stdout:
+        line = line.rstrip('\n')
         if not line:
             continue
-        data = line.split('\t')
-        depth = len(data[0].split('/'))
-        # root filesystem is not treated as dataset by us
-        if depth == 1 and not include_root:
+        name, used, refer, volsize, txg = line.split('\t')
+        fs = name.split('@', 1)[0]
+        txg = int(txg)
+        # Most recent of the dataset, whether it matches the prefix or not
+        if txg > latest.get(fs, -1):
+            latest[fs] = txg
+        if prefix and not name.startswith(prefix):
             continue
-        dataset = ZFSDataset(
-            path=data[0],
-            used=data[1],
-            avail=data[2],
-            refer=data[3],
-            mountpoint=data[4],
+        if total >= offset and (end is None or total < end):
+            window.append((name, used, refer, volsize, txg))
+        total += 1
+    err = zfsproc.stderr.read()
+    zfsproc.wait()
+    if zfsproc.returncode != 0:
+        raise MiddlewareError(
+            _("Failed to list snapshots: %s") % (err.strip() or prefix, )
         )
-        if not hierarchical:
-            zfslist.append(dataset)
-            continue
 
-        if depth == last_depth + 1:
-            last_dataset.append(dataset)
-        elif depth == 2:
-            zfslist.append(dataset)
-        elif depth > 2 and last_depth >= depth:
-            tmp = last_dataset
-            for i in range(last_depth - depth + 1):
-                tmp = tmp.parent
-            tmp.append(dataset)
-        else:
-            log.error("Failed to parse zfs list in hierarchical mode")
-        last_dataset = dataset
-        last_depth = depth
+    snapshots = []
+    for name, used, refer, volsize, txg in window:
+        fs, snapname = name.split('@', 1)
+        snapshots.append(Snapshot(
+            name=snapname,
+            filesystem=fs,
+            used=zfs_nicenum(used),
+            refer=zfs_nicenum(refer),
+            mostrecent=(latest.get(fs) == txg),
+            parent_type='filesystem' if volsize == '-' else 'volume',
+            used_bytes=_zfs_int(used),
+            refer_bytes=_zfs_int(refer),
+        ))
+    return total, snapshots
+
+
+def list_datasets(path="", recursive=False, hierarchical=False,
+                  include_root=False, inventory=None):
+    """
+    Return a dictionary that contains all ZFS dataset list and their
+    mountpoints
 
-    return zfslist
+    An already gathered ``inventory`` can be given to avoid another
+    zfs list run.
+    """
+    if inventory is None:
+        inventory = ZFSInventory(
+            path=path,
+            types=('filesystem', ),
+            recursive=recursive,
+        )
+    return inventory.list_datasets(
+        path=path,
+        recursive=recursive,
+        hierarchical=hierarchical,
+        include_root=include_root,
+    )
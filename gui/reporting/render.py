@@ -0,0 +1,154 @@
+#+
+# Copyright 2013 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+from collections import OrderedDict
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+log = logging.getLogger('reporting.render')
+
+# Maximum number of concurrent rrdtool graph processes
+RENDER_WORKERS = multiprocessing.cpu_count()
+# Bytes and number of rendered images kept in memory
+RENDER_CACHE_SIZE = 16 * 1024 * 1024
+RENDER_CACHE_ENTRIES = 256
+# Seconds a rendered image is served even if its RRD files did not
+# change, graphs end "now" so the time axis moves on regardless
+RENDER_MAXAGE = 60
+
+
+class _Render(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.data = None
+
+
+class RenderCache(object):
+    """
+    Rendered RRD graphs
+
+    Images are keyed on what the graph shows (plugin, identifier, unit,
+    step) plus the modification time of the RRD files it reads, so a
+    cached image is served without running rrdtool at all until collectd
+    writes new data points. The least recently used images are evicted
+    past the size bounds.
+
+    Concurrent requests for the same graph share a single rendering and
+    no more than ``workers`` rrdtool processes run at once.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, size=RENDER_CACHE_SIZE,
+                 entries=RENDER_CACHE_ENTRIES, maxage=RENDER_MAXAGE):
+        self.size = size
+        self.entries = entries
+        self.maxage = maxage
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers)
+        # graph -> (mtime, timestamp, image), least recently used first
+        self._images = OrderedDict()
+        self._bytes = 0
+        # (graph, mtime) -> _Render in progress
+        self._rendering = {}
+
+    @staticmethod
+    def _mtime(sources):
+        mtime = 0
+        for source in sources:
+            try:
+                mtime = max(mtime, os.stat(source).st_mtime)
+            except OSError:
+                pass
+        return mtime
+
+    def _store(self, graph, mtime, timestamp, data):
+        old = self._images.pop(graph, None)
+        if old is not None:
+            self._bytes -= len(old[2])
+        self._images[graph] = (mtime, timestamp, data)
+        self._bytes += len(data)
+        while self._images and (
+            self._bytes > self.size or len(self._images) > self.entries
+        ):
+            graph, entry = self._images.popitem(last=False)
+            self._bytes -= len(entry[2])
+
+    def invalidate(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def render(self, plugin):
+        """
+        Image of the graph drawn by the ``plugin`` instance
+
+        Returns:
+            str - image data
+        """
+        args = plugin.get_args('-')
+        graph = (
+            plugin.base_path,
+            plugin.plugin,
+            plugin.identifier,
+            plugin.unit,
+            plugin.step,
+        )
+        mtime = self._mtime(plugin.get_sources(args))
+        key = (graph, mtime)
+
+        now = time.time()
+        with self._lock:
+            entry = self._images.get(graph)
+            if entry and entry[0] == mtime and now - entry[1] < self.maxage:
+                # Most recently used goes last
+                del self._images[graph]
+                self._images[graph] = entry
+                return entry[2]
+            pending = self._rendering.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._rendering[key] = _Render()
+
+        if not owner:
+            pending.event.wait()
+            return pending.data or ''
+
+        try:
+            with self._slots:
+                pending.data = plugin.render(args)
+        finally:
+            with self._lock:
+                del self._rendering[key]
+                if pending.data:
+                    self._store(graph, mtime, now, pending.data)
+            pending.event.set()
+        return pending.data
+
+
+RENDER_CACHE = RenderCache()
@@ -30,6 +30,7 @@ import os
 import re
 import tempfile
 import subprocess
+import xml.etree.cElementTree as etree
 
 from freenasUI.common.pipesubr import pipeopen
 
@@ -98,21 +99,24 @@ class RRDBase(object):
     def get_identifiers(self):
         return None
 
-    def generate(self):
+    def get_timespan(self):
         """
-        Call rrdgraph to generate the graph on a temp file
-
-        Returns:
-            str - path to the image
+        rrdtool start and end time of the graph
         """
-
         starttime = '1%s' % (self.unit[0], )
         if self.step == 0:
             endtime = 'now'
         else:
             endtime = 'now-%d%s' % (self.step, self.unit[0], )
+        return 'end-%s' % starttime, endtime
 
-        fh, path = tempfile.mkstemp()
+    def get_args(self, path):
+        """
+        rrdtool graph command line drawing the graph into ``path``,
+        '-' meaning stdout
+        """
+
+        starttime, endtime = self.get_timespan()
         args = [
             "/usr/local/bin/rrdtool",
             "graph",
@@ -122,14 +126,129 @@ class RRDBase(object):
             '--title', str(self.get_title()),
             '--lower-limit', '0',
             '--end', endtime,
-            '--start', 'end-%s' % starttime, '-b', '1024',
+            '--start', starttime, '-b', '1024',
         ]
         args.extend(self.graph())
+        return args
+
+    @staticmethod
+    def get_sources(args):
+        """
+        RRD files read by a graph command line
+        """
+        sources = set()
+        for arg in args:
+            reg = re.search(r'^DEF:[^=]+=([^:]+):', arg)
+            if reg:
+                sources.add(reg.group(1))
+        return sources
+
+    def render(self, args=None):
+        """
+        Call rrdgraph to generate the graph in memory
+
+        Returns:
+            str - image data
+        """
+        if args is None:
+            args = self.get_args('-')
         # rrdtool python is suffering from some sort of threading locking issue
         # See #3478
         # rrdtool.graph(*args)
+        proc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        data, err = proc.communicate()
+        if proc.returncode != 0:
+            log.warn("Failed to render %r: %s", self, err.strip())
+        return data
+
+    def get_xport_args(self, start=None, end=None, points=None):
+        """
+        rrdtool xport command line exporting the series drawn by the
+        graph, every line with a legend
+        """
+        starttime, endtime = self.get_timespan()
+        args = [
+            "/usr/local/bin/rrdtool",
+            "xport",
+            '--end', str(end or endtime),
+            '--start', str(start or starttime),
+        ]
+        if points:
+            args.extend(['--maxrows', str(int(points))])
+
+        exported = set()
+        for arg in self.graph():
+            fields = re.split(r'(?<!\\):', arg)
+            if fields[0] in ('DEF', 'CDEF', 'VDEF'):
+                args.append(arg)
+                continue
+            if not re.search(r'^LINE', fields[0]) or len(fields) < 3:
+                continue
+            vname = fields[1].split('#', 1)[0]
+            legend = fields[2].replace('\\:', '').strip()
+            if vname in exported or not legend:
+                continue
+            exported.add(vname)
+            args.append('XPORT:%s:%s' % (vname, legend))
+        return args
+
+    def xport(self, start=None, end=None, points=None):
+        """
+        Call rrdxport to get the data points of the graph
+
+        ``start`` and ``end`` are anything rrdtool understands as a time
+        (e.g. seconds since the epoch), defaulting to the graph timespan.
+        ``points`` is the maximum number of rows, rrdtool consolidates
+        the data points to fit.
+
+        Returns:
+            dict - start, end and step in seconds, the legend of every
+                series and the rows of values, None for unknown
+        """
+        args = self.get_xport_args(start=start, end=end, points=points)
+        proc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise ValueError("rrdtool xport failed: %s" % err.strip())
+
+        root = etree.fromstring(out)
+        meta = root.find('meta')
+        rows = []
+        for row in root.find('data').findall('row'):
+            values = []
+            for v in row.findall('v'):
+                value = float(v.text)
+                values.append(None if value != value else value)
+            rows.append(values)
+        return {
+            'start': int(meta.findtext('start')),
+            'end': int(meta.findtext('end')),
+            'step': int(meta.findtext('step')),
+            'legend': [e.text for e in meta.find('legend').findall('entry')],
+            'data': rows,
+        }
+
+    def generate(self):
+        """
+        Call rrdgraph to generate the graph on a temp file
+
+        Returns:
+            str - path to the image
+        """
+
+        fh, path = tempfile.mkstemp()
         subprocess.Popen(
-            args, stdout=subprocess.PIPE, stdin=subprocess.PIPE
+            self.get_args(path), stdout=subprocess.PIPE, stdin=subprocess.PIPE
         ).communicate()
         return fh, path
 
@@ -39,4 +39,6 @@ urlpatterns = patterns('freenasUI.reporting.views',
     url(r'^partition/$', 'generic_graphs', {'names': ['df']}, name="reporting_partition"),
     url(r'^system/$', 'generic_graphs', {'names': ['processes', 'uptime']}, name="reporting_system"),
     url(r'^generate/$', 'generate', name="reporting_generate"),
+    url(r'^fetch/$', 'fetch', name="reporting_fetch"),
+    url(r'^batch/$', 'batch', name="reporting_batch"),
 )
@@ -24,8 +24,12 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 #####################################################################
+from multiprocessing.pool import ThreadPool
+import base64
+import json
 import logging
 import os
+import struct
 
 from django.http import HttpResponse
 from django.shortcuts import render
@@ -33,6 +37,7 @@ from django.shortcuts import render
 from freenasUI.freeadmin.apppool import appPool
 from freenasUI.system.models import SystemDataset
 from freenasUI.reporting import rrd
+from freenasUI.reporting.render import RENDER_CACHE, RENDER_WORKERS
 
 RRD_BASE_PATH = "/var/db/collectd/rrd/localhost"
 
@@ -98,33 +103,146 @@ def generic_graphs(request, names=None):
     })
 
 
+def _get_plugin(params, rrdpath=None):
+    """
+    Plugin instance of the graph described by the generate parameters
+    """
+    plugin = rrd.name2plugin.get(params.get("plugin"))
+    if plugin is None:
+        raise ValueError("Unknown plugin: %s" % params.get("plugin"))
+    return plugin(
+        base_path=rrdpath or _get_rrd_path(),
+        unit=params.get("unit", "hourly"),
+        step=params.get("step", "0"),
+        identifier=params.get("identifier"),
+    )
+
+
 def generate(request):
 
     try:
-        plugin = request.GET.get("plugin")
-        plugin = rrd.name2plugin.get(plugin)
-        unit = request.GET.get("unit", "hourly")
-        step = request.GET.get("step", "0")
-        identifier = request.GET.get("identifier")
-
-        plugin = plugin(
-            base_path=_get_rrd_path(),
-            unit=unit,
-            step=step,
-            identifier=identifier
-        )
-        fd, path = plugin.generate()
-        with open(path, 'rb') as f:
-            data = f.read()
-
-        try:
-            os.unlink(path)
-            os.close(fd)
-        except OSError, e:
-            log.warn("Failed to remove reporting temp file: %s", e)
+        plugin = _get_plugin(request.GET)
+        data = RENDER_CACHE.render(plugin)
 
         response = HttpResponse(data)
         response['Content-type'] = 'image/png'
         return response
     except Exception, e:
         log.debug("Failed to generate rrd graph: %s", e)
+
+
+def fetch(request):
+    """
+    Data points of a graph, as JSON or as a binary array
+
+    Besides the plugin, unit, step and identifier of ``generate``:
+        start, end - time range, defaulting to the graph one
+        points - maximum number of rows, consolidated by rrdtool
+        format - "json" (default) or "binary", little endian doubles
+            row after row, NaN for unknown, the JSON fields being
+            sent as X-RRD-* headers
+    """
+
+    try:
+        plugin = _get_plugin(request.GET)
+        points = request.GET.get("points")
+        xport = plugin.xport(
+            start=request.GET.get("start"),
+            end=request.GET.get("end"),
+            points=int(points) if points else None,
+        )
+    except Exception, e:
+        log.debug("Failed to export rrd data: %s", e)
+        return HttpResponse(
+            json.dumps({'error': str(e)}),
+            content_type='application/json',
+            status=400,
+        )
+
+    if request.GET.get("format") == "binary":
+        values = [
+            float('nan') if v is None else v
+            for row in xport['data'] for v in row
+        ]
+        response = HttpResponse(
+            struct.pack('<%dd' % len(values), *values),
+            content_type='application/octet-stream',
+        )
+        response['X-RRD-Start'] = xport['start']
+        response['X-RRD-End'] = xport['end']
+        response['X-RRD-Step'] = xport['step']
+        response['X-RRD-Legend'] = json.dumps(xport['legend'])
+        return response
+
+    return HttpResponse(
+        json.dumps(xport, separators=(',', ':')),
+        content_type='application/json',
+    )
+
+
+def batch(request):
+    """
+    Every graph of a page in a single request
+
+    Graphs are either listed in ``graphs``, a JSON list of objects holding
+    the generate parameters, or every graph of the comma separated plugin
+    ``names`` for the given unit and step. Parameters are read from the
+    POST data if any, a long list of graphs does not fit in a query string.
+
+    format - "png" (default), images sent back as data URIs, or "data"
+        for the series of fetch, points and time range parameters
+        applying to every graph
+    """
+
+    rrdpath = _get_rrd_path()
+    params = request.POST if request.method == "POST" else request.GET
+    fmt = params.get("format", "png")
+    points = params.get("points")
+    try:
+        if "graphs" in params:
+            graphs = json.loads(params["graphs"])
+        else:
+            graphs = []
+            for name in params.get("names", "").split(","):
+                for graph in plugin2graphs(name):
+                    graph["unit"] = params.get("unit", "hourly")
+                    graph["step"] = params.get("step", "0")
+                    graphs.append(graph)
+        points = int(points) if points else None
+    except ValueError, e:
+        return HttpResponse(
+            json.dumps({'error': str(e)}),
+            content_type='application/json',
+            status=400,
+        )
+
+    def _batch(graph):
+        try:
+            plugin = _get_plugin(graph, rrdpath)
+            if fmt == "data":
+                graph["data"] = plugin.xport(
+                    start=params.get("start"),
+                    end=params.get("end"),
+                    points=points,
+                )
+            else:
+                graph["image"] = "data:image/png;base64,%s" % (
+                    base64.b64encode(RENDER_CACHE.render(plugin)),
+                )
+        except Exception, e:
+            log.debug("Failed to generate rrd graph %r: %s", graph, e)
+            graph["error"] = str(e)
+        return graph
+
+    if graphs:
+        pool = ThreadPool(min(RENDER_WORKERS, len(graphs)))
+        try:
+            graphs = pool.map(_batch, graphs)
+        finally:
+            pool.close()
+            pool.join()
+
+    return HttpResponse(
+        json.dumps({'graphs': graphs}, separators=(',', ':')),
+        content_type='application/json',
+    )
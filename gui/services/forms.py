@@ -49,6 +49,7 @@ from freenasUI.common.samba import (
     Samba4
 )
 from freenasUI.freeadmin.forms import DirectoryBrowser
+from freenasUI.middleware import zfs
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.notifier import notifier
 from freenasUI.network.models import Interfaces
@@ -1310,17 +1311,20 @@ class iSCSITargetExtentForm(ModelForm):
             used_disks.extend(v.get_disks())
 
         _notifier = notifier()
+        # zvols and their snapshots out of a single zfs list
+        inventory = zfs.ZFSInventory(types=('volume', 'snapshot'))
+        snapshots = _notifier.zfs_snapshot_list(inventory=inventory)
         for volume in Volume.objects.filter(vol_fstype__exact='ZFS'):
-            zvols = _notifier.list_zfs_vols(volume.vol_name)
+            zvols = _notifier.list_zfs_vols(
+                volume.vol_name,
+                inventory=inventory,
+            )
             for zvol, attrs in zvols.items():
                 if "zvol/" + zvol not in used_zvol:
                     diskchoices["zvol/" + zvol] = "%s (%s)" % (
                         zvol,
                         attrs['volsize'])
-                zsnapshots = _notifier.zfs_snapshot_list(path=zvol).values()
-                if not zsnapshots:
-                    continue
-                for snap in zsnapshots[0]:
+                for snap in snapshots.get(zvol, []):
                     diskchoices["zvol/" + snap.fullname] = "%s (%s)" % (
                         snap.fullname,
                         attrs['volsize'])
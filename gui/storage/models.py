@@ -29,7 +29,6 @@ from datetime import time
 import cPickle
 import logging
 import os
-import re
 import uuid
 
 from django.db import models, transaction
@@ -38,6 +37,7 @@ from django.utils.translation import ugettext_lazy as _
 from freenasUI import choices
 from freenasUI.middleware import zfs
 from freenasUI.middleware.notifier import notifier
+from freenasUI.middleware.replication import ReplicationProgress
 from freenasUI.common import humanize_size
 from freenasUI.freeadmin.models import Model, UserField
 
@@ -96,13 +96,15 @@ class Volume(Model):
                 e)
             return []
 
-    def get_datasets(self, hierarchical=False, include_root=False):
+    def get_datasets(self, hierarchical=False, include_root=False,
+                     inventory=None):
         if self.vol_fstype == 'ZFS':
             return zfs.list_datasets(
                 path=self.vol_name,
                 recursive=True,
                 hierarchical=hierarchical,
-                include_root=include_root)
+                include_root=include_root,
+                inventory=inventory)
 
     def get_datasets_with_root(self, hierarchical=False):
         """
@@ -116,9 +118,12 @@ class Volume(Model):
                 include_root=True,
             )
 
-    def get_zvols(self):
+    def get_zvols(self, inventory=None):
         if self.vol_fstype == 'ZFS':
-            return notifier().list_zfs_vols(self.vol_name)
+            return notifier().list_zfs_vols(
+                self.vol_name,
+                inventory=inventory,
+            )
 
     def _get_status(self):
         try:
@@ -935,17 +940,32 @@ class Replication(Model):
 
     @property
     def status(self):
-        progressfile = '/tmp/.repl_progress_%d' % self.id
-        if os.path.exists(progressfile):
-            with open(progressfile, 'r') as f:
-                pid = int(f.read())
-            title = notifier().get_proc_title(pid)
-            if title:
-                reg = re.search(r'sending (\S+) \((\d+)%', title)
-                if reg:
-                    return _('Sending %s (%s%%)') % reg.groups()
-                else:
-                    return _('Sending')
+        progress = ReplicationProgress.read(
+            '/tmp/.repl_progress_%d' % self.id
+        )
+        if progress:
+            if progress['total']:
+                percent = min(100 * progress['sent'] / progress['total'], 100)
+                status = _('Sending %s (%s%%)') % (
+                    progress['snapshot'],
+                    percent,
+                )
+            else:
+                status = _('Sending %s (%s)') % (
+                    progress['snapshot'],
+                    humanize_size(progress['sent']),
+                )
+            if progress['rate']:
+                status = u'%s, %s/s' % (
+                    status,
+                    humanize_size(progress['rate']),
+                )
+            if progress['eta'] is not None:
+                status = u'%s, %s' % (
+                    status,
+                    _('%d min left') % (int(progress['eta']) / 60 + 1),
+                )
+            return status
         if self.repl_lastresult:
             return self.repl_lastresult
 
@@ -1,10 +1,14 @@
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import cPickle
+import fcntl
 import hashlib
 import imp
 import logging
 import os
 import time
 
+from django.db import connection
 from django.utils.translation import ugettext_lazy as _
 
 from freenasUI.common.system import send_mail
@@ -13,6 +17,13 @@ from freenasUI.system.models import Alert as mAlert
 
 log = logging.getLogger('system.alert')
 
+# Seconds to wait for a module that does not set its own timeout
+ALERT_TIMEOUT = 30
+# Maximum number of modules running at once
+ALERT_WORKERS = 8
+# Seconds before an alert is e-mailed again when it comes back
+ALERT_NOTIFY_INTERVAL = 3600
+
 
 class BaseAlertMetaclass(type):
 
@@ -29,6 +40,11 @@ class BaseAlert(object):
 
     alert = None
     name = None
+    # Seconds the last result is reused before running the module again,
+    # 0 runs it every time
+    interval = 0
+    # Seconds to wait for run(), the last result is kept past it
+    timeout = ALERT_TIMEOUT
 
     def __init__(self, alert):
         self.alert = alert
@@ -123,53 +139,191 @@ class AlertPlugins:
         instance = klass(self)
         self.mods.append(instance)
 
+    def dismissed(self):
+        """
+        Set of the ids of the dismissed alerts
+        """
+        return set(
+            mAlert.objects.filter(dismiss=True).values_list(
+                'message_id', flat=True
+            )
+        )
+
     def email(self, alerts):
-        dismisseds = [a.message_id
-                      for a in mAlert.objects.filter(dismiss=True)]
+        dismisseds = self.dismissed()
         msgs = []
         for alert in alerts:
             if alert.getId() not in dismisseds:
                 msgs.append(unicode(alert).encode('utf8'))
         if len(msgs) == 0:
-            return
-        send_mail(subject=_("Critical Alerts"),
-                  text='\n'.join(msgs))
+            return False
+        error, errmsg = send_mail(subject=_("Critical Alerts"),
+                                  text='\n'.join(msgs))
+        if error:
+            log.warn("Failed to e-mail critical alerts: %s", errmsg)
+        return not error
+
+    def _notify(self, obj, rvs, now):
+        """
+        E-mail the critical alerts that are new or were escalated since
+        the last run, at most once per ALERT_NOTIFY_INTERVAL each
+
+        Returns:
+            dict(alert id) = dict(first, last, level, notified, pending),
+            first and last seen times of the current alerts and of the ones
+            gone for less than ALERT_NOTIFY_INTERVAL, pending being set for
+            the critical ones not mailed yet
+        """
+        state = obj.get('state', {}) if obj else {}
+        if obj is not None:
+            lastlevels = dict((a.getId(), a.getLevel()) for a in obj['alerts'])
+        else:
+            lastlevels = {}
+
+        crits = []
+        for alert in rvs:
+            id = alert.getId()
+            entry = state.get(id)
+            if entry is None or id not in lastlevels:
+                entry = state[id] = {
+                    'first': now,
+                    'notified': entry['notified'] if entry else None,
+                }
+            entry['last'] = now
+            entry['level'] = alert.getLevel()
+            if alert.getLevel() != Alert.CRIT:
+                entry['pending'] = False
+                continue
+            # New or escalated, mailed right away or once the interval
+            # since the last mail has passed if it is still critical
+            if lastlevels.get(id) != Alert.CRIT:
+                entry['pending'] = True
+            if entry.get('pending') and (
+                entry['notified'] is None or
+                now - entry['notified'] >= ALERT_NOTIFY_INTERVAL
+            ):
+                crits.append(alert)
+
+        if crits and self.email(crits):
+            for alert in crits:
+                entry = state[alert.getId()]
+                entry['notified'] = now
+                entry['pending'] = False
+
+        for id, entry in state.items():
+            if now - entry['last'] >= ALERT_NOTIFY_INTERVAL:
+                del state[id]
+        return state
+
+    def _load(self):
+        if not os.path.exists(self.ALERT_FILE):
+            return None
+        with open(self.ALERT_FILE, 'r') as f:
+            try:
+                return cPickle.load(f)
+            except:
+                return None
+
+    def _dump(self, obj):
+        tmp = self.ALERT_FILE + '.tmp'
+        with open(tmp, 'w') as f:
+            cPickle.dump(obj, f)
+        os.rename(tmp, self.ALERT_FILE)
+
+    def _run_mod(self, instance):
+        try:
+            return filter(None, instance.run() or [])
+        finally:
+            # Worker threads get a database connection of their own
+            connection.close()
+
+    def get_alerts(self):
+        """
+        Alerts of the last run, the modules are only run if they never
+        were (e.g. right after boot)
+        """
+        obj = self._load()
+        if obj is None:
+            return self.run()
+        return obj['alerts']
 
     def run(self):
+        """
+        Run every module that is due, concurrently
 
-        obj = None
-        if os.path.exists(self.ALERT_FILE):
-            with open(self.ALERT_FILE, 'r') as f:
-                try:
-                    obj = cPickle.load(f)
-                except:
-                    pass
-
-        rvs = []
+        A module that fails or does not return within its timeout keeps
+        its last result. Results and the time they were taken are kept
+        per module in ALERT_FILE.
+        """
+        lock = open(self.ALERT_FILE + '.lock', 'a+')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Another run is in progress (e.g. a module hung), do not
+            # pile up behind it
+            lock.close()
+            obj = self._load()
+            return obj['alerts'] if obj else []
+
+        try:
+            return self._run()
+        finally:
+            lock.close()
+
+    def _run(self):
+
+        obj = self._load()
+        lastmods = obj.get('mods', {}) if obj else {}
+
+        now = time.time()
+        mods = {}
+        pending = []
+        pool = None
         for instance in self.mods:
+            last = lastmods.get(instance.name)
+            if last and now - last['last'] < instance.interval:
+                mods[instance.name] = last
+                continue
+            if pool is None:
+                pool = ThreadPool(min(ALERT_WORKERS, len(self.mods)))
+            pending.append(
+                (instance, pool.apply_async(self._run_mod, (instance, )))
+            )
+
+        for instance, result in pending:
             try:
-                rv = instance.run()
-                if rv:
-                    rvs.extend(filter(None, rv))
+                mods[instance.name] = {
+                    'last': time.time(),
+                    'alerts': result.get(
+                        max(now + instance.timeout - time.time(), 0)
+                    ),
+                }
+                continue
+            except TimeoutError:
+                log.error(
+                    "Alert module '%s' timed out after %d seconds",
+                    instance, instance.timeout,
+                )
             except Exception, e:
                 log.error("Alert module '%s' failed: %s", instance, e)
+            if instance.name in lastmods:
+                mods[instance.name] = lastmods[instance.name]
+
+        if pool is not None:
+            # Hung modules are left behind, worker threads are daemonic
+            pool.close()
 
-        crits = sorted([a for a in rvs if a and a.getLevel() == Alert.CRIT])
-        if obj and crits:
-            lastcrits = sorted([
-                a for a in obj['alerts'] if a and a.getLevel() == Alert.CRIT
-            ])
-            if crits == lastcrits:
-                crits = []
-
-        if crits:
-            self.email(crits)
-
-        with open(self.ALERT_FILE, 'w') as f:
-            cPickle.dump({
-                'last': time.time(),
-                'alerts': rvs,
-            }, f)
+        rvs = []
+        for instance in self.mods:
+            if instance.name in mods:
+                rvs.extend(mods[instance.name]['alerts'])
+
+        self._dump({
+            'last': time.time(),
+            'alerts': rvs,
+            'mods': mods,
+            'state': self._notify(obj, rvs, now),
+        })
         return rvs
 
 
@@ -8,6 +8,9 @@ from freenasUI.system.alert import alertPlugins, Alert, BaseAlert
 
 class LSIFirmwareAlert(BaseAlert):
 
+    # Firmware and driver only change across reboots
+    interval = 3600
+
     def run(self):
         alerts = []
         mps = defaultdict(dict)
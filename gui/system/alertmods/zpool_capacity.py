@@ -8,6 +8,8 @@ from freenasUI.storage.models import Volume
 
 class ZpoolCapAlert(BaseAlert):
 
+    interval = 300
+
     def run(self):
         alerts = []
         for vol in Volume.objects.filter(vol_fstype='ZFS'):
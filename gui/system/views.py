@@ -561,10 +561,13 @@ def debug(request):
 
 
 class UnixTransport(xmlrpclib.Transport):
+
+    timeout = 5
+
     def make_connection(self, addr):
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.connect(addr)
-        self.sock.settimeout(5)
+        self.sock.settimeout(self.timeout)
         return self.sock
 
     def single_request(self, host, handler, request_body, verbose=0):
@@ -597,11 +600,13 @@ class UnixTransport(xmlrpclib.Transport):
 
 class MyServer(xmlrpclib.ServerProxy):
 
-    def __init__(self, addr):
+    def __init__(self, addr, timeout=None):
 
         self.__handler = "/"
         self.__host = addr
         self.__transport = UnixTransport()
+        if timeout is not None:
+            self.__transport.timeout = timeout
         self.__encoding = None
         self.__verbose = 0
         self.__allow_none = 0
@@ -640,10 +645,12 @@ def terminal(request):
     jid = request.POST.get("jid", 0)
     shell = request.POST.get("shell", "")
     k = request.POST.get("k")
+    seq = request.POST.get("seq")
+    wait = min(float(request.POST.get("wait", 0)), 30)
     w = int(request.POST.get("w", 80))
     h = int(request.POST.get("h", 24))
 
-    multiplex = MyServer("/var/run/webshell.sock")
+    multiplex = MyServer("/var/run/webshell.sock", timeout=wait + 5)
     alive = False
     for i in range(3):
         try:
@@ -661,6 +668,16 @@ def terminal(request):
                     xmlrpclib.Binary(bytearray(k.encode('utf-8')))
                 )
             time.sleep(0.002)
+            if seq is not None:
+                if wait > 0:
+                    # Long poll, returns as soon as there is new output
+                    rows = multiplex.proc_wait(sid, int(seq or 0), wait)
+                else:
+                    rows = multiplex.proc_dump_rows(sid, int(seq or 0))
+                return HttpResponse(
+                    json.dumps(rows),
+                    content_type='application/json',
+                )
             content_data = '<?xml version="1.0" encoding="UTF-8"?>' + \
                 multiplex.proc_dump(sid)
             response = HttpResponse(content_data, content_type='text/xml')
@@ -25,12 +25,16 @@
 # SUCH DAMAGE.
 #
 
+from collections import defaultdict
 import cPickle
 import datetime
 import logging
 import os
+import re
 import subprocess
 import sys
+import threading
+import time
 
 sys.path.extend([
     '/usr/local/www',
@@ -47,8 +51,13 @@ from freenasUI.freeadmin.apppool import appPool
 from freenasUI.storage.models import Replication, REPL_RESULTFILE
 from freenasUI.common.timesubr import isTimeBetween
 from freenasUI.common.pipesubr import pipeopen, system
-from freenasUI.common.locks import mntlock
+from freenasUI.common.locks import mntlock, FileLock
 from freenasUI.common.system import send_mail
+from freenasUI.middleware.replication import (
+    REMOTE_SNAPSHOTS, REPL_COMPRESSION, ReplicationProgress,
+    ReplicationScheduler, ReplicationStream, remote_key,
+)
+from django.db import connection
 
 # DESIGN NOTES
 #
@@ -79,7 +88,15 @@ appPool.hook_tool_run('autorepl')
 MNTLOCK = mntlock()
 
 mypid = os.getpid()
-templog = '/tmp/repl-%d' % (mypid)
+
+# Held while a dataset is being replicated, '@' never appears in its name
+REPL_LOCKFILE = '/var/run/autorepl-%s.lock'
+# Shared ssh connection of each remote system, user@host:port
+SSH_CONTROLPATH = '/var/run/autorepl-ssh-%r@%h:%p'
+# Seconds a shared ssh connection outlives its last command
+SSH_CONTROLPERSIST = 60
+# Seconds the state of a remote system is shared among its tasks
+REMOTE_STATE_TTL = 60
 
 now = datetime.datetime.now().replace(microsecond=0)
 if now.second < 30 or now.minute == 59:
@@ -115,7 +132,6 @@ MNTLOCK.unlock()
 # At this point, we are sure that only one autorepl instance is running.
 
 log.debug("Autosnap replication started")
-log.debug("temp log file: %s" % (templog, ))
 
 try:
     with open(REPL_RESULTFILE, 'rb') as f:
@@ -124,27 +140,83 @@ try:
 except:
     results = {}
 
-# Traverse all replication tasks
-replication_tasks = Replication.objects.all()
-for replication in replication_tasks:
-    if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
-        continue
+# remote key -> replication tasks of this run
+remote_tasks = {}
+# remote key -> (timestamp, remote_state())
+remote_states = {}
+remote_states_lock = threading.Lock()
+remote_locks = defaultdict(threading.Lock)
 
-    if not replication.repl_enabled:
-        log.warn("%s replication not enabled" % replication)
-        continue
 
-    remote = replication.repl_remote.ssh_remote_hostname.__str__()
-    remote_port = replication.repl_remote.ssh_remote_port
-    dedicateduser = replication.repl_remote.ssh_remote_dedicateduser
-    fast_cipher = replication.repl_remote.ssh_fast_cipher
-    remotefs = replication.repl_zfs.__str__()
-    localfs = replication.repl_filesystem.__str__()
-    last_snapshot = replication.repl_lastsnapshot.__str__()
-    resetonce = replication.repl_resetonce
-    compression = replication.repl_compression.__str__()
+class StateLock(object):
+    """
+    MNTLOCK for the threads of this process
+
+    MNTLOCK excludes the snapshot state changes from autosnap creating
+    and destroying snapshots. Being an flock(2) on a descriptor every
+    thread shares, one thread unlocking it would release it for all of
+    them, so threads take turns first.
+    """
 
-    if fast_cipher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owner = None
+
+    def lock(self):
+        self._lock.acquire()
+        self._owner = threading.current_thread()
+        MNTLOCK.lock()
+
+    def unlock(self):
+        MNTLOCK.unlock()
+        self._owner = None
+        self._lock.release()
+
+    def release(self):
+        """
+        Unlock if held by the calling thread, e.g. after an exception
+        """
+        if self._owner is threading.current_thread():
+            self.unlock()
+
+
+STATELOCK = StateLock()
+
+
+def lag(replication):
+    """
+    Time of the last snapshot sent by a replication task
+    """
+    reg = re.search(r'@auto-(\d{8}\.\d{4})', replication.repl_lastsnapshot)
+    if reg is None:
+        return datetime.datetime.min
+    return datetime.datetime.strptime(reg.group(1), '%Y%m%d.%H%M')
+
+
+def send_size(cmd):
+    """
+    Estimated size in bytes of the stream of a zfs send command line,
+    None if zfs can not tell
+    """
+    proc = pipeopen(' '.join(cmd[:2] + ['-nP'] + cmd[2:]), important=False)
+    output = proc.communicate()[0]
+    if proc.returncode:
+        return None
+    for line in output.split('\n'):
+        if line.startswith('size\t'):
+            try:
+                return int(line.split('\t')[1])
+            except ValueError:
+                return None
+    return None
+
+
+def ssh_command(remote, master='no'):
+    """
+    ssh command line to a ReplRemote, all the commands to the same remote
+    system share the connection started by ssh_master() if it is running
+    """
+    if remote.ssh_fast_cipher:
         sshcmd = ('/usr/bin/ssh -c arcfour256,arcfour128,blowfish-cbc,'
                   'aes128-ctr,aes192-ctr,aes256-ctr -i /data/ssh/replication'
                   ' -o BatchMode=yes -o StrictHostKeyChecking=yes'
@@ -158,12 +230,239 @@ for replication in replication_tasks:
                   ' -o StrictHostKeyChecking=yes'
                   ' -o ConnectTimeout=7')
 
-    if dedicateduser:
+    if remote.ssh_remote_dedicateduser:
         sshcmd = "%s -l %s" % (
             sshcmd,
-            dedicateduser.encode('utf-8'),
+            remote.ssh_remote_dedicateduser.encode('utf-8'),
             )
 
+    return '%s -o ControlMaster=%s -o ControlPath=%s' % (
+        sshcmd,
+        master,
+        SSH_CONTROLPATH,
+    )
+
+
+def ssh_master(remote):
+    """
+    Start the shared connection to a ReplRemote unless it is running
+
+    The master has its stdio on /dev/null, one spawned by a command
+    whose output is captured would keep the pipe open for as long as
+    it persists.
+    """
+    target = '-p %d %s' % (
+        remote.ssh_remote_port,
+        remote.ssh_remote_hostname.__str__(),
+    )
+    with open(os.devnull, 'r+') as devnull:
+        check = subprocess.call(
+            '%s -O check %s' % (ssh_command(remote), target),
+            shell=True,
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+        )
+        if check == 0:
+            return
+        subprocess.call(
+            '%s -M -N -f -o ControlPersist=%d %s' % (
+                ssh_command(remote, master='yes'),
+                SSH_CONTROLPERSIST,
+                target,
+            ),
+            shell=True,
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+        )
+
+
+def remote_target(replication):
+    """
+    Remote dataset a replication task receives into
+    """
+    localfs_split = replication.repl_filesystem.__str__().split('/')
+    if len(localfs_split) > 1:
+        return "%s/%s" % (
+            replication.repl_zfs.__str__(),
+            "/".join(localfs_split[1:]),
+        )
+    return replication.repl_zfs.__str__()
+
+
+def remote_state(sshcmd, remote_port, remote, datasets):
+    """
+    Snapshots and resumable receive tokens of remote datasets, all of
+    them in one round trip
+
+    Returns:
+        None if the remote system could not be queried, otherwise
+        (dict(dataset) = [snapshot names, oldest first],
+         dict(dataset) = receive_resume_token)
+        the latter being empty if the remote system does not support it
+    """
+    datasets = ' '.join(sorted(set(datasets)))
+    rzfscmd = '"/sbin/zfs list -H -o name -t snapshot -s createtxg -d 1 %s 2> /dev/null; /sbin/zfs get -H -o name,value receive_resume_token %s 2> /dev/null; true"' % (datasets, datasets)
+    sshproc = pipeopen('%s -p %d %s %s' % (sshcmd, remote_port, remote, rzfscmd), important=False)
+    output = sshproc.communicate()[0]
+    if sshproc.returncode:
+        return None
+    snapshots, tokens = {}, {}
+    for line in output.split('\n'):
+        if '\t' in line:
+            name, value = line.split('\t', 1)
+            tokens[name] = value
+        elif '@' in line:
+            name, snap = line.split('@', 1)
+            snapshots.setdefault(name, []).append(snap)
+    return snapshots, tokens
+
+
+def get_remote_state(replication):
+    """
+    Remote state of a replication task
+
+    The first task needing it queries the datasets of every task of the
+    same remote system in one go, the others reuse it for as long as
+    REMOTE_STATE_TTL. The shared ssh connection is (re)started here.
+    """
+    remote = replication.repl_remote
+    key = remote_key(remote)
+    with remote_states_lock:
+        lock = remote_locks[key]
+    with lock:
+        ssh_master(remote)
+        fetched, state = remote_states.get(key, (0, None))
+        if state is None or time.time() - fetched > REMOTE_STATE_TTL:
+            datasets = []
+            for repl in remote_tasks.get(key, [replication]):
+                datasets.extend([
+                    repl.repl_zfs.__str__(),
+                    remote_target(repl),
+                ])
+            state = remote_state(
+                ssh_command(remote),
+                remote.ssh_remote_port,
+                remote.ssh_remote_hostname.__str__(),
+                datasets,
+            )
+            remote_states[key] = (time.time(), state)
+    return state
+
+
+def close_remotes():
+    """
+    Tear down the shared ssh connections opened by this run
+    """
+    for key in remote_locks.keys():
+        remote = remote_tasks[key][0].repl_remote
+        pipeopen('%s -O exit -p %d %s' % (
+            ssh_command(remote),
+            remote.ssh_remote_port,
+            remote.ssh_remote_hostname.__str__(),
+        ), important=False).communicate()
+
+
+def resume_token(localfs, state, remotefs, remotefs_final):
+    """
+    Whether both sides support resumable receive, and the token left by
+    an interrupted receive into remotefs_final if any
+    """
+    if state is None:
+        return False, None
+    zfsproc = pipeopen('/sbin/zfs get -H -o value receive_resume_token %s' % (localfs), important=False)
+    zfsproc.communicate()
+    if zfsproc.returncode:
+        return False, None
+
+    tokens = state[1]
+    token = tokens.get(remotefs_final)
+    if token in ('', '-'):
+        token = None
+    return remotefs in tokens, token
+
+
+def send(replication, cmd, replcmd, templog, label):
+    """
+    Pipe a zfs send command line into the receiving command line
+
+    Returns:
+        output of both, "Succeeded" being the last line on success
+    """
+    progress = ReplicationProgress(
+        '/tmp/.repl_progress_%d' % replication.id,
+        label,
+        send_size(cmd),
+    )
+    try:
+        with open(templog, 'w+') as f:
+            sendproc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=f,
+                close_fds=True,
+            )
+            proc = subprocess.Popen(
+                replcmd,
+                shell=True,
+                stdin=subprocess.PIPE,
+                stdout=f,
+                stderr=subprocess.STDOUT,
+                close_fds=True,
+            )
+            stream = ReplicationStream(
+                limit=replication.repl_limit,
+                progress=progress,
+            )
+            try:
+                stream.run(sendproc.stdout.fileno(), proc.stdin.fileno())
+            except (IOError, OSError), e:
+                # Either side went away, their own errors end up in the log
+                log.debug("Replication stream of %s interrupted: %s" % (label, e))
+            finally:
+                sendproc.stdout.close()
+                proc.stdin.close()
+            proc.wait()
+            sendproc.wait()
+            f.seek(0)
+            msg = f.read().strip('\n').strip('\r')
+    finally:
+        # Never leave a progress behind, status would report it forever
+        progress.remove()
+    os.remove(templog)
+    return msg
+
+
+def replicate(replication):
+    localfs = replication.repl_filesystem.__str__()
+    lock = FileLock(REPL_LOCKFILE % localfs.replace('/', '@'))
+    try:
+        lock.lock_try()
+    except IOError:
+        log.debug("Dataset %s is being replicated elsewhere" % (localfs))
+        return
+    try:
+        _replicate(replication, localfs)
+    finally:
+        STATELOCK.release()
+        lock.unlock()
+        connection.close()
+
+
+def _replicate(replication, localfs):
+    templog = '/tmp/repl-%d-%d' % (mypid, replication.id)
+    remote = replication.repl_remote.ssh_remote_hostname.__str__()
+    remote_port = replication.repl_remote.ssh_remote_port
+    remotefs = replication.repl_zfs.__str__()
+    last_snapshot = replication.repl_lastsnapshot.__str__()
+    resetonce = replication.repl_resetonce
+    compression = replication.repl_compression.__str__()
+
+    sshcmd = ssh_command(replication.repl_remote)
+
     if replication.repl_userepl:
         Rflag = '-R '
     else:
@@ -173,20 +472,10 @@ for replication in replication_tasks:
     known_latest_snapshot = ''
     expected_local_snapshot = ''
 
-    localfs_split = localfs.split('/')
-
-    if len(localfs_split) > 1:
-        remotefs_final = "%s/%s" % (remotefs, "/".join(localfs_split[1:]))
-        if len(localfs_split) > 2:
-            remotefs_parent = "%s/%s" % (remotefs, "/".join(localfs_split[1:-1]))
-        else:
-            remotefs_parent = "%s/%s" % (remotefs, localfs_split[1])
-    else:
-        remotefs_final = remotefs
-        remotefs_parent = remotefs
+    remotefs_final = remote_target(replication)
 
     # Test if there is work to do, if so, own them
-    MNTLOCK.lock()
+    STATELOCK.lock()
     log.debug("Checking dataset %s" % (localfs))
     zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state -r -d 1 %s' % (localfs), debug)
     output, error = zfsproc.communicate()
@@ -195,10 +484,14 @@ for replication in replication_tasks:
             localfs,
             error,
             ))
-        MNTLOCK.unlock()
-        continue
+        STATELOCK.unlock()
+        return
+    local_snapshots = []
     if output != '':
         snapshots_list = output.split('\n')
+        local_snapshots = [
+            item.split('\t')[0] for item in snapshots_list if item != ''
+        ]
         snapshots_list.reverse()
         found_latest = False
         for snapshot_item in snapshots_list:
@@ -233,21 +526,24 @@ for replication in replication_tasks:
                         log.debug("Snapshot %s unwanted" % (snapshot))
                     else:
                         # This should be exception but skip for now.
-                        MNTLOCK.unlock()
                         continue
-    MNTLOCK.unlock()
+    STATELOCK.unlock()
 
     # If there is nothing to do, go through next replication entry
     if len(wanted_list) == 0:
-        continue
+        return
+
+    rstate = get_remote_state(replication)
+    if rstate is None:
+        log.warn("Could not query remote system %s for %s" % (remote, localfs))
+        results[replication.id] = 'Failed to connect to the remote system'
+        return
+    remote_snapshots = rstate[0].get(remotefs_final, [])
 
     if known_latest_snapshot != '' and not resetonce:
         # Check if it matches remote snapshot
-        rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | tail -n 1 | cut -d@ -f2"' % (remotefs_final)
-        sshproc = pipeopen('%s -p %d %s %s' % (sshcmd, remote_port, remote, rzfscmd))
-        output = sshproc.communicate()[0]
-        if output != '':
-            expected_local_snapshot = '%s@%s' % (localfs, output.split('\n')[0])
+        if remote_snapshots:
+            expected_local_snapshot = '%s@%s' % (localfs, remote_snapshots[-1])
             if expected_local_snapshot == last_snapshot:
                 # Accept: remote and local snapshots matches
                 log.debug("Found matching latest snapshot %s remotely" % (last_snapshot))
@@ -258,7 +554,7 @@ for replication in replication_tasks:
             else:
                 # Do we have it locally? if yes then mark it immediately
                 log.info("Can not locate expected snapshot %s, looking more carefully" % (expected_local_snapshot))
-                MNTLOCK.lock()
+                STATELOCK.lock()
                 zfsproc = pipeopen('/sbin/zfs list -Ht snapshot -o name,freenas:state %s' % (expected_local_snapshot), debug)
                 output = zfsproc.communicate()[0]
                 if output != '':
@@ -268,7 +564,9 @@ for replication in replication_tasks:
                         system('/sbin/zfs inherit freenas:state %s' % (known_latest_snapshot))
                         system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
                         known_latest_snapshot = last_snapshot
+                    STATELOCK.unlock()
                 else:
+                    STATELOCK.unlock()
                     log.warn("Can not locate a proper local snapshot for %s" % (localfs))
                     # Can NOT proceed any further.  Report this situation.
                     error, errmsg = send_mail(subject="Replication failed!", text=\
@@ -277,14 +575,14 @@ Hello,
     The replication failed for the local ZFS %s because the remote system
     have diverged snapshot with us.
                         """ % (localfs), interval=datetime.timedelta(hours=2), channel='autorepl')
-                    MNTLOCK.unlock()
                     results[replication.id] = 'Remote system have diverged snapshot with us'
-                    continue
-                MNTLOCK.unlock()
+                    return
         else:
             log.log(logging.NOTICE, "Can not locate %s on remote system, starting from there" % (known_latest_snapshot))
             # Reset the "latest" snapshot to a new one.
+            STATELOCK.lock()
             system('/sbin/zfs set freenas:state=NEW %s' % (known_latest_snapshot))
+            STATELOCK.unlock()
             wanted_list.insert(0, known_latest_snapshot)
             last_snapshot = ''
             known_latest_snapshot = ''
@@ -292,17 +590,100 @@ Hello,
         log.log(logging.NOTICE, "Destroying remote %s" % (remotefs_final))
         destroycmd = '%s -p %d %s /sbin/zfs destroy -rRf %s' % (sshcmd, remote_port, remote, remotefs_final)
         system(destroycmd)
+        # Own every snapshot and forget about the reset right away, a
+        # failure from here on resumes from the last snapshot sent rather
+        # than destroying the remote side all over again
+        STATELOCK.lock()
+        system('/sbin/zfs set freenas:state=NEW %s' % (' '.join(wanted_list)))
+        STATELOCK.unlock()
+        replication.repl_resetonce = False
+        replication.save()
         known_latest_snapshot = ''
 
     last_snapshot = known_latest_snapshot
 
+    # Send every snapshot in between on its own rather than whole -I
+    # ranges, each one is a checkpoint a failed run resumes from
+    steps = []
+    previous = last_snapshot
     for snapname in wanted_list:
-        local_fs, local_snap = snapname.split('@')
-        if replication.repl_limit != 0:
-            limit = '/usr/local/bin/throttle -K %d | ' % replication.repl_limit
+        if previous in local_snapshots and snapname in local_snapshots:
+            steps.extend(local_snapshots[
+                local_snapshots.index(previous) + 1:
+                local_snapshots.index(snapname)
+            ])
+        steps.append(snapname)
+        previous = snapname
+
+    if compression in REPL_COMPRESSION:
+        compress, decompress = REPL_COMPRESSION[compression]
+        compress = '%s | ' % compress
+        decompress = '%s | ' % decompress
+    else:
+        compress = ''
+        decompress = ''
+
+    # Resumable receive (-s) does not handle replication streams
+    if replication.repl_userepl:
+        resumable, token = False, None
+    else:
+        resumable, token = resume_token(
+            localfs, rstate, remotefs, remotefs_final
+        )
+    recvflags = '-s -F -d' if resumable else '-F -d'
+    replcmd = '%s%s -p %d %s "%s/sbin/zfs receive %s %s && echo Succeeded"' % (compress, sshcmd, remote_port, remote, decompress, recvflags, remotefs)
+
+    # Whether the remote side got any snapshot
+    sent = False
+
+    if token:
+        log.info("Resuming interrupted receive into %s" % (remotefs_final))
+        msg = send(
+            replication, ['/sbin/zfs', 'send', '-t', token], replcmd,
+            templog, remotefs_final,
+        )
+        log.debug("Replication result: %s" % (msg))
+        rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | tail -n 1 | cut -d@ -f2"' % (remotefs_final)
+        sshproc = pipeopen('%s -p %d %s %s' % (sshcmd, remote_port, remote, rzfscmd))
+        output = sshproc.communicate()[0]
+        snapname = '%s@%s' % (localfs, output.split('\n')[0])
+        if output != '' and snapname in steps:
+            log.info("Resumed up to %s" % (snapname))
+            system('%s -p %d %s "/sbin/zfs inherit freenas:state %s@%s"' % (sshcmd, remote_port, remote, remotefs_final, snapname.split('@')[1]))
+            STATELOCK.lock()
+            if last_snapshot != '':
+                system('/sbin/zfs inherit freenas:state %s' % (last_snapshot))
+            last_snapshot = snapname
+            system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
+            STATELOCK.unlock()
+            replication.repl_lastsnapshot = last_snapshot
+            replication.save()
+            sent = True
+            steps = steps[steps.index(snapname) + 1:]
         else:
-            limit = ''
-        cmd = ['/sbin/zfs', 'send', '-V']
+            if not msg.endswith('Succeeded'):
+                newtoken = resume_token(
+                    localfs,
+                    remote_state(
+                        sshcmd, remote_port, remote,
+                        [remotefs, remotefs_final],
+                    ),
+                    remotefs,
+                    remotefs_final,
+                )[1]
+                if newtoken and newtoken != token:
+                    # Interrupted again but got further, keep going from
+                    # there next time
+                    log.warn("Resumed receive into %s interrupted: %s" % (remotefs_final, msg))
+                    results[replication.id] = msg
+                    return
+            # Start over from the last snapshot the remote side confirms
+            log.warn("Could not resume receive into %s: %s" % (remotefs_final, msg))
+            system('%s -p %d %s "/sbin/zfs receive -A %s"' % (sshcmd, remote_port, remote, remotefs_final))
+
+    for snapname in steps:
+        local_fs, local_snap = snapname.split('@')
+        cmd = ['/sbin/zfs', 'send']
         if replication.repl_userepl:
             cmd.append('-R')
         if last_snapshot == '':
@@ -310,71 +691,28 @@ Hello,
         else:
             cmd.extend(['-I', last_snapshot, snapname])
 
-        progressfile = '/tmp/.repl_progress_%d' % replication.id
-        # subprocess.Popen does not handle large stream of data between
-        # processes very well, do it on our own
-        readfd, writefd = os.pipe()
-        if os.fork() == 0:
-            with open(progressfile, 'w') as f2:
-                f2.write(str(os.getpid()))
-            os.close(readfd)
-            os.dup2(writefd, 1)
-            os.close(writefd)
-            os.execv('/sbin/zfs', cmd)
-        os.close(writefd)
-
-        if compression == 'pigz':
-            compress = '/usr/local/bin/pigz | '
-            decompress = '/usr/local/bin/pigz -d | '
-        elif compression == 'plzip':
-            compress = '/usr/local/bin/plzip | '
-            decompress = '/usr/local/bin/plzip -d | '
-        elif compression == 'lz4':
-            compress = '/usr/local/bin/lz4c | '
-            decompress = '/usr/local/bin/lz4c -d | '
-        else: #off
-            compress = ''
-            decompress = ''
-
-
-        replcmd = '%s%s/bin/dd obs=1m 2> /dev/null | /bin/dd obs=1m 2> /dev/null | %s -p %d %s "%s/sbin/zfs receive -F -d %s && echo Succeeded"' % (compress, limit, sshcmd, remote_port, remote, decompress, remotefs)
-        with open(templog, 'w+') as f:
-            readobj = os.fdopen(readfd, 'r', 0)
-            proc = subprocess.Popen(
-                replcmd,
-                shell=True,
-                stdin=readobj,
-                stdout=f,
-                stderr=subprocess.STDOUT,
-            )
-            proc.wait()
-            readobj.close()
-            os.remove(progressfile)
-            f.seek(0)
-            msg = f.read().strip('\n').strip('\r')
-        os.remove(templog)
+        msg = send(replication, cmd, replcmd, templog, snapname)
         log.debug("Replication result: %s" % (msg))
         results[replication.id] = msg
 
-        # Determine if the remote side have the snapshot we have now.
-        rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | tail -n 1 | cut -d@ -f2"' % (remotefs_final)
+        # Determine if the remote side have the snapshot we have now,
+        # clearing its state along the way if it does
+        rzfscmd = '"zfs inherit freenas:state %s@%s 2> /dev/null; zfs list -Hr -o name -t snapshot -d 1 %s | tail -n 1 | cut -d@ -f2"' % (remotefs_final, local_snap, remotefs_final)
         sshproc = pipeopen('%s -p %d %s %s' % (sshcmd, remote_port, remote, rzfscmd))
         output = sshproc.communicate()[0]
         if output != '':
             remote_snap = output.split('\n')[0]
             if local_snap == remote_snap:
-                system('%s -p %d %s "/sbin/zfs inherit freenas:state %s@%s"' % (sshcmd, remote_port, remote, remotefs_final, remote_snap))
                 # Replication was successful, mark as such
-                MNTLOCK.lock()
+                STATELOCK.lock()
                 if last_snapshot != '':
                     system('/sbin/zfs inherit freenas:state %s' % (last_snapshot))
                 last_snapshot = snapname
                 system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
-                MNTLOCK.unlock()
+                STATELOCK.unlock()
                 replication.repl_lastsnapshot = last_snapshot
-                if resetonce:
-                    replication.repl_resetonce = False
                 replication.save()
+                sent = True
                 continue
             else:
                 log.warn("Remote and local mismatch after replication: %s: local=%s vs remote=%s" % (local_fs, local_snap, remote_snap))
@@ -387,9 +725,10 @@ Hello,
                         log.warn("Snapshot %s already exist on remote, marking as such" % (snapname))
                         system('%s -p %d %s "/sbin/zfs inherit -r freenas:state %s"' % (sshcmd, remote_port, remote, remotefs_final))
                         # Replication was successful, mark as such
-                        MNTLOCK.lock()
+                        STATELOCK.lock()
                         system('/sbin/zfs inherit freenas:state %s' % (snapname))
-                        MNTLOCK.unlock()
+                        STATELOCK.unlock()
+                        sent = True
                         continue
 
         # Something wrong, report.
@@ -403,6 +742,30 @@ Hello,
             """ % (localfs, remote, msg), interval=datetime.timedelta(hours=2), channel='autorepl')
         break
 
+    # Once per task, the snapshot grid would otherwise query the remote
+    # system again after every single snapshot of a long catch up
+    if sent:
+        REMOTE_SNAPSHOTS.invalidate(replication.repl_remote)
+
+
+# Traverse all replication tasks
+replication_tasks = []
+for replication in Replication.objects.select_related('repl_remote'):
+    if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
+        continue
+
+    if not replication.repl_enabled:
+        log.warn("%s replication not enabled" % replication)
+        continue
+
+    replication_tasks.append(replication)
+    remote_tasks.setdefault(
+        remote_key(replication.repl_remote), []
+    ).append(replication)
+
+ReplicationScheduler().run(replication_tasks, replicate, lag)
+close_remotes()
+
 with open(REPL_RESULTFILE, 'w') as f:
     f.write(cPickle.dumps(results))
 os.remove('/var/run/autorepl.pid')
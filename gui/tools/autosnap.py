@@ -61,6 +61,9 @@ MNTLOCK=mntlock()
 # Set to True if verbose log desired
 debug = False
 
+# Maximum number of snapshots (or snapshot ranges) per zfs destroy
+DESTROY_BATCH = 100
+
 def snapinfodict2datetime(snapinfo):
     year = int(snapinfo['year'])
     month = int(snapinfo['month'])
@@ -104,6 +107,73 @@ def isMatchingTime(task, snaptime):
 
     return False
 
+def snapshot_batch(snapshots, flags):
+    """
+    Create snapshots in a single atomic zfs snapshot call, falling back
+    to one call per snapshot if it fails (e.g. one of them exists already)
+    """
+    snapcmd = '/sbin/zfs snapshot%s %s' % (flags, ' '.join(snapshots))
+    proc = pipeopen(snapcmd, logger=log)
+    err = proc.communicate()[1]
+    if proc.returncode == 0:
+        return
+    if len(snapshots) == 1:
+        log.error("Failed to create snapshot '%s': %s", snapshots[0], err)
+        return
+    for snapname in snapshots:
+        snapshot_batch([snapname], flags)
+
+def unreplicated(fs, snapnames):
+    """
+    Snapshots of fs out of snapnames whose freenas:state is still '-',
+    to be called with MNTLOCK held as autorepl may have claimed some
+    since they were listed
+    """
+    retval = set()
+    snapnames = sorted(snapnames)
+    for i in range(0, len(snapnames), DESTROY_BATCH):
+        zfsproc = pipeopen('/sbin/zfs get -H -o name,value freenas:state %s' % (
+            ' '.join(['%s@%s' % (fs, name) for name in snapnames[i:i + DESTROY_BATCH]]),
+        ), debug, logger=log)
+        for line in zfsproc.communicate()[0].split('\n'):
+            if line != '':
+                snapshot_name, snapshot_state = line.split('\t')[:2]
+                if snapshot_state == '-':
+                    retval.add(snapshot_name.split('@', 1)[1])
+    return retval
+
+def destroy_specs(fs, ordered, expired):
+    """
+    zfs destroy snapshot specifications of the expired snapshots of fs
+
+    Consecutive expired snapshots (in the creation order of fs itself)
+    are collapsed into first%last ranges, so a range never spans a
+    snapshot of fs that is kept. Ranges are destroyed without -r, every
+    dataset gets its own.
+    """
+    specs = []
+    run = []
+    for snapname in ordered + [None]:
+        if snapname is not None and snapname in expired:
+            run.append(snapname)
+            continue
+        if len(run) == 1:
+            specs.append(run[0])
+        elif run:
+            specs.append('%s%%%s' % (run[0], run[-1]))
+        run = []
+    return specs
+
+def destroy_batch(fs, specs):
+    #snapshots with clones will have destruction deferred
+    for i in range(0, len(specs), DESTROY_BATCH):
+        snapshot = '%s@%s' % (fs, ','.join(specs[i:i + DESTROY_BATCH]))
+        snapcmd = '/sbin/zfs destroy -d %s' % (snapshot, )
+        proc = pipeopen(snapcmd, logger=log)
+        err = proc.communicate()[1]
+        if proc.returncode != 0:
+            log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
+
 # Detect if another instance is running
 def exit_if_running(pid):
     log.debug("Checking if process %d is still alive", pid)
@@ -170,22 +240,30 @@ for task in TaskObjects:
 # Only proceed further if we are  going to generate any snapshots for this run
 if len(mp_to_task_map) > 0:
 
-    # Grab all existing snapshot and filter out the expiring ones
+    # Grab all existing snapshot and filter out the expiring ones, the
+    # freenas:state of every snapshot comes along so only the expired
+    # unreplicated ones are checked again under MNTLOCK
     snapshots = {}
-    snapshots_pending_delete = set()
-    zfsproc = pipeopen("/sbin/zfs list -t snapshot -H", debug, logger=log)
+    # fs -> snapshot names in creation order
+    snapshots_ordered = {}
+    # fs -> set(snapshot names) to destroy
+    snapshots_pending_delete = {}
+    zfsproc = pipeopen("/sbin/zfs list -t snapshot -H -o name,freenas:state -s createtxg", debug, logger=log)
     lines = zfsproc.communicate()[0].split('\n')
     reg_autosnap = re.compile('^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)(?P<retunit>[hdwmy])$')
     for line in lines:
         if line != '':
-            snapshot_name = line.split('\t')[0]
+            snapshot_name, snapshot_state = line.split('\t')[:2]
             fs, snapname = snapshot_name.split('@')
+            snapshots_ordered.setdefault(fs, []).append(snapname)
             snapname_match = reg_autosnap.match(snapname)
             if snapname_match != None:
                 snap_infodict = snapname_match.groupdict()
                 snap_ret_policy = '%s%s' % (snap_infodict['retcount'], snap_infodict['retunit'])
                 if snap_expired(snap_infodict, snaptime):
-                    snapshots_pending_delete.add(snapshot_name)
+                    # Snapshots pending replication are kept
+                    if snapshot_state == '-':
+                        snapshots_pending_delete.setdefault(fs, set()).add(snapname)
                 else:
                     if mp_to_task_map.has_key((fs, snap_ret_policy)):
                         if snapshots.has_key((fs, snap_ret_policy)):
@@ -210,6 +288,13 @@ if len(mp_to_task_map) > 0:
 
     snaptime_str = snaptime.strftime('%Y%m%d.%H%M')
 
+    replicated = set(Replication.objects.filter(
+        repl_enabled=True
+    ).values_list('repl_filesystem', flat=True))
+
+    # Snapshots are taken atomically in one call per pool and set of
+    # options (recursive, marked for replication)
+    batches = {}
     for mpkey, tasklist in mp_to_task_map.items():
         fs, expire = mpkey
         recursive = False
@@ -221,36 +306,27 @@ if len(mp_to_task_map) > 0:
         else:
             rflag = ''
 
+        # If there is associated replication task, mark the snapshots as 'NEW'.
+        if fs in replicated:
+            rflag += ' -o freenas:state=NEW'
+
         snapname = '%s@auto-%s-%s' % (fs, snaptime_str, expire)
+        batches.setdefault((fs.split('/')[0], rflag), []).append(snapname)
 
-        # If there is associated replication task, mark the snapshots as 'NEW'.
-        if Replication.objects.filter(repl_filesystem=fs, repl_enabled=True).count() > 0:
+    for (pool, flags), snapnames in batches.items():
+        if 'freenas:state' in flags:
             MNTLOCK.lock()
-            snapcmd = '/sbin/zfs snapshot%s -o freenas:state=NEW %s' % (rflag, snapname)
-            proc = pipeopen(snapcmd, logger=log)
-            err = proc.communicate()[1]
-            if proc.returncode != 0:
-                log.error("Failed to create snapshot '%s': %s", snapname, err)
+            snapshot_batch(snapnames, flags)
             MNTLOCK.unlock()
         else:
-            snapcmd = '/sbin/zfs snapshot%s %s' % (rflag, snapname)
-            proc = pipeopen(snapcmd, logger=log)
-            err = proc.communicate()[1]
-            if proc.returncode != 0:
-                log.error("Failed to create snapshot '%s': %s", snapname, err)
+            snapshot_batch(snapnames, flags)
 
     MNTLOCK.lock()
-    for snapshot in snapshots_pending_delete:
-        zfsproc = pipeopen('/sbin/zfs get -H freenas:state %s' % (snapshot, ), logger=log)
-        output = zfsproc.communicate()[0]
-        if output != '':
-            fsname, attrname, value, source = output.split('\n')[0].split('\t')
-            if value == '-':
-                snapcmd = '/sbin/zfs destroy -r -d %s' % (snapshot) #snapshots with clones will have destruction deferred
-                proc = pipeopen(snapcmd, logger=log)
-                err = proc.communicate()[1]
-                if proc.returncode != 0:
-                    log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
+    for fs in sorted(snapshots_pending_delete):
+        expired = unreplicated(fs, snapshots_pending_delete[fs])
+        specs = destroy_specs(fs, snapshots_ordered[fs], expired)
+        if specs:
+            destroy_batch(fs, specs)
     MNTLOCK.unlock()
 
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2013 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Benchmark of recursive permission changes on a generated tree
+
+The previous behaviour, one process per inode (chown and chmod run for
+every file like Base_ACL_Hierarchy used to run getfacl/setfacl), is
+compared with the in-process ACL_Tree walker:
+
+    bench_acl.py -n 20000 -w 4
+
+The tree is created under -d (a temporary directory by default) and
+removed afterwards.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+from freenasUI.common.acltree import ACL_Tree, change_permission
+
+
+def generate_tree(top, nfiles, fanout=8, perdir=64):
+    """
+    Create ``nfiles`` empty files spread over nested directories
+    """
+    created = 0
+    pending = [top]
+    while created < nfiles:
+        parent = pending.pop(0)
+        for i in xrange(fanout):
+            path = os.path.join(parent, 'dir%d' % i)
+            os.mkdir(path)
+            pending.append(path)
+            for j in xrange(min(perdir, nfiles - created)):
+                open(os.path.join(path, 'file%d' % j), 'w').close()
+                created += 1
+            if created >= nfiles:
+                break
+    return created
+
+
+def per_inode(top, mode):
+    uid, gid = os.getuid(), os.getgid()
+    ACL_Tree(top, workers=1).run(lambda path, isdir, windows: (
+        subprocess.call(['chown', '%d:%d' % (uid, gid), path]),
+        subprocess.call(['chmod', mode, path]),
+    ))
+
+
+def in_process(top, mode, workers):
+    change_permission(top, user=os.getuid(), group=os.getgid(), mode=mode,
+        recursive=True, workers=workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark recursive permission changes.')
+    parser.add_argument('-n', '--files', type=int, default=5000)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('-d', '--dir', help='where to create the tree')
+    parser.add_argument('--skip-fork', action='store_true',
+        help='do not run the process per inode variant')
+    args = parser.parse_args()
+
+    top = tempfile.mkdtemp(prefix='bench_acl.', dir=args.dir)
+    try:
+        nfiles = generate_tree(top, args.files)
+        print "%d files under %s" % (nfiles, top)
+
+        if not args.skip_fork:
+            start = time.time()
+            per_inode(top, '0750')
+            forked = time.time() - start
+            print "per inode:  %.3fs" % forked
+
+        start = time.time()
+        in_process(top, '0755', 1)
+        single = time.time() - start
+        print "in process: %.3fs (1 worker)" % single
+
+        start = time.time()
+        in_process(top, '0750', args.workers)
+        parallel = time.time() - start
+        print "in process: %.3fs (%d workers)" % (parallel, args.workers)
+
+        if not args.skip_fork and parallel:
+            print "speedup:    %.1fx" % (forked / parallel)
+    finally:
+        shutil.rmtree(top)
+
+
+if __name__ == '__main__':
+    main()
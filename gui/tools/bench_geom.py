@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2013 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Micro-benchmark of GEOM lookups, XPath scans versus GEOMTopology indexes
+
+A confxml recorded on a real system can be replayed with:
+
+    sysctl -b kern.geom.confxml > confxml.xml
+    bench_geom.py -f confxml.xml
+
+Without -f a synthetic mesh with -n disks (GPT with swap and zfs
+partitions plus gptid labels) is generated.
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+
+from lxml import etree
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+from freenasUI.middleware.geom import GEOMTopology
+
+
+def synthetic_confxml(ndisks):
+    """
+    Build a kern.geom.confxml lookalike with ``ndisks`` disks
+    """
+    ids = iter(xrange(1, 1 << 30))
+    mesh = etree.Element('mesh')
+    classes = {}
+    for name in ('DISK', 'PART', 'LABEL', 'DEV'):
+        cls = etree.SubElement(mesh, 'class', id='0x%x' % next(ids))
+        etree.SubElement(cls, 'name').text = name
+        classes[name] = cls
+
+    def geom(cname, name):
+        node = etree.SubElement(classes[cname], 'geom', id='0x%x' % next(ids))
+        etree.SubElement(node, 'name').text = name
+        return node
+
+    def provider(parent, name, **config):
+        node = etree.SubElement(parent, 'provider', id='0x%x' % next(ids))
+        etree.SubElement(node, 'name').text = name
+        etree.SubElement(node, 'mediasize').text = '4000787030016'
+        conf = etree.SubElement(node, 'config')
+        for key, val in config.items():
+            etree.SubElement(conf, key).text = val
+        return node
+
+    def consumer(parent, prov):
+        node = etree.SubElement(parent, 'consumer', id='0x%x' % next(ids))
+        etree.SubElement(node, 'provider', ref=prov.get('id'))
+
+    for i in xrange(ndisks):
+        disk = 'da%d' % i
+        dprov = provider(geom('DISK', disk), disk)
+        consumer(geom('DEV', disk), dprov)
+        part = geom('PART', disk)
+        consumer(part, dprov)
+        for idx, ptype in enumerate(('freebsd-swap', 'freebsd-zfs'), 1):
+            pname = '%sp%d' % (disk, idx)
+            rawuuid = str(uuid.uuid4())
+            pprov = provider(part, pname, type=ptype, rawuuid=rawuuid)
+            consumer(geom('DEV', pname), pprov)
+            label = geom('LABEL', pname)
+            consumer(label, pprov)
+            provider(label, 'gptid/%s' % rawuuid)
+    return mesh
+
+
+def xpath_lookups(doc, disks):
+    for disk in disks:
+        doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % disk)
+        search = doc.xpath("//class[name = 'PART']/..//*[name = '%s']//config[type = 'freebsd-zfs']/rawuuid" % disk)
+        if search:
+            doc.xpath("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % search[0].text)
+        doc.xpath("//class[name = 'PART']/geom[name = '%s']//config[type = 'freebsd-swap']/../name" % disk)
+        doc.xpath("//class[name = 'PART']/geom[name = '%s']/provider/name" % disk)
+
+
+def topology_lookups(doc, disks):
+    topology = GEOMTopology(doc)
+    for disk in disks:
+        topology.mediasize(disk)
+        parts = topology.partitions(disk, 'freebsd-zfs')
+        if parts:
+            topology.rawuuids.get(parts[0].findtext('config/rawuuid'))
+        topology.partitions(disk, 'freebsd-swap')
+        topology.partitions(disk)
+
+
+def bench(func, doc, disks, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        func(doc, disks)
+    return (time.time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GEOM lookups.')
+    parser.add_argument('-f', '--file', help='recorded kern.geom.confxml')
+    parser.add_argument('-n', '--disks', type=int, default=480,
+        help='number of disks for the synthetic mesh')
+    parser.add_argument('-r', '--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'r') as f:
+            doc = etree.fromstring(f.read())
+    else:
+        doc = synthetic_confxml(args.disks)
+
+    disks = GEOMTopology(doc).geoms['DISK'].keys()
+    print "%d disks, %d rounds" % (len(disks), args.rounds)
+    xpath = bench(xpath_lookups, doc, disks, args.rounds)
+    print "xpath:    %.4fs per sweep" % xpath
+    indexed = bench(topology_lookups, doc, disks, args.rounds)
+    print "topology: %.4fs per sweep (including index build)" % indexed
+    if indexed:
+        print "speedup:  %.1fx" % (xpath / indexed)
+
+
+if __name__ == '__main__':
+    main()
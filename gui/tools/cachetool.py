@@ -71,14 +71,35 @@ def cache_fill(**kwargs):
         pass
 
 
+def cache_refresh(**kwargs):
+    """Merge the users and groups changed in AD (uSNChanged) or LDAP
+       (modifyTimestamp) since the last fill/refresh into the cache.
+       Domains without a complete cache or watermark are filled."""
+    if not (activedirectory_enabled() or ldap_enabled()):
+        return
+
+    flags = FLAGS_DBINIT|FLAGS_CACHE_REFRESH
+    for u in FreeNAS_Users(flags=flags|FLAGS_CACHE_WRITE_USER):
+        pass
+    for g in FreeNAS_Groups(flags=flags|FLAGS_CACHE_WRITE_GROUP):
+        pass
+
+
 def __cache_expire(cachedir):
     """Nuke everything under cachedir, but preserve the root directory
        hierarchy so it doesn't screw up certain services like smbd,
        etc."""
 
+    FREENAS_IDENTITY_STORE.expire()
+
+    store = os.path.basename(FREENAS_IDENTITY_STORE.path)
     for ent in os.listdir(cachedir):
         p = os.path.join(cachedir, ent)
-        if os.path.isdir(p):
+        if ent.startswith(store):
+            # The store (and its WAL) may be open by other processes,
+            # it was emptied above
+            continue
+        elif os.path.isdir(p):
             # Delete all cached information (subdirectories and files)
             # under /var/tmp/.cache/.{ldap,samba,..}.
             for root, dirs, files, in os.walk(p, topdown=False):
@@ -93,6 +114,29 @@ def cache_expire(**kwargs):
         __cache_expire(kwargs['cachedir'])
 
 
+def cache_purge(**kwargs):
+    """Drop the entries whose time to live is over"""
+    FREENAS_IDENTITY_STORE.purge()
+
+
+def cache_lookup(**kwargs):
+    """Look entries up by name=, id= or sid= in every cache"""
+    for arg in kwargs.get('args', []):
+        column, sep, val = arg.partition('=')
+        if not sep:
+            continue
+
+        try:
+            entries = FREENAS_IDENTITY_STORE.lookup(column, val)
+
+        except ValueError, e:
+            print >> sys.stderr, e
+            continue
+
+        for scope, key, entry in entries:
+            print "%s: %s=%s" % (scope, key, entry)
+
+
 def cache_dump(**kwargs):
     print "FreeNAS_Users:"
     for u in FreeNAS_Users(flags=FLAGS_DBINIT|FLAGS_CACHE_READ_USER):
@@ -206,23 +250,23 @@ def _cache_rawdump_ActiveDirectory(**kwargs):
 
         ucache = FreeNAS_UserCache(dir=workgroup)
         if ucache:
-            for key in ucache.keys():
-                print "u: %s=%s" % (key, ucache[key])
+            for key, val in ucache.items():
+                print "u: %s=%s" % (key, val)
 
         gcache = FreeNAS_GroupCache(dir=workgroup)
         if gcache:
-            for key in gcache.keys():
-                print "g: %s=%s" % (key, gcache[key])
+            for key, val in gcache.items():
+                print "g: %s=%s" % (key, val)
 
         ducache = FreeNAS_Directory_UserCache(dir=workgroup)
         if ducache:
-            for key in ducache.keys():
-                print "du: %s=%s" % (key, ducache[key])
+            for key, val in ducache.items():
+                print "du: %s=%s" % (key, val)
 
         dgcache = FreeNAS_Directory_GroupCache(dir=workgroup)
         if dgcache:
-            for key in dgcache.keys():
-                print "dg: %s=%s" % (key, dgcache[key])
+            for key, val in dgcache.items():
+                print "dg: %s=%s" % (key, val)
 
 def _cache_rawdump_NT4(**kwargs):
     nt4 = FreeNAS_NT4()
@@ -234,43 +278,43 @@ def _cache_rawdump_NT4(**kwargs):
 
         ucache = FreeNAS_UserCache(dir=workgroup)
         if ucache:
-            for key in ucache.keys():
-                print "u: %s=%s" % (key, ucache[key])
+            for key, val in ucache.items():
+                print "u: %s=%s" % (key, val)
 
         gcache = FreeNAS_GroupCache(dir=workgroup)
         if gcache:
-            for key in gcache.keys():
-                print "g: %s=%s" % (key, gcache[key])
+            for key, val in gcache.items():
+                print "g: %s=%s" % (key, val)
 
         ducache = FreeNAS_Directory_UserCache(dir=workgroup)
         if ducache:
-            for key in ducache.keys():
-                print "du: %s=%s" % (key, ducache[key])
+            for key, val in ducache.items():
+                print "du: %s=%s" % (key, val)
 
         dgcache = FreeNAS_Directory_GroupCache(dir=workgroup)
         if dgcache:
-            for key in dgcache.keys():
-                print "dg: %s=%s" % (key, dgcache[key])
+            for key, val in dgcache.items():
+                print "dg: %s=%s" % (key, val)
 
 def _cache_rawdump_default(**kwargs):
     ucache = FreeNAS_UserCache()
-    for key in ucache.keys():
-        print "u: %s=%s" % (key, ucache[key])
+    for key, val in ucache.items():
+        print "u: %s=%s" % (key, val)
 
     gcache = FreeNAS_GroupCache()
     if gcache:
-        for key in gcache.keys():
-            print "g: %s=%s" % (key, gcache[key])
+        for key, val in gcache.items():
+            print "g: %s=%s" % (key, val)
 
     ducache = FreeNAS_Directory_UserCache()
     if ducache:
-        for key in ducache.keys():
-            print "du: %s=%s" % (key, ducache[key])
+        for key, val in ducache.items():
+            print "du: %s=%s" % (key, val)
 
     dgcache = FreeNAS_Directory_GroupCache()
     if dgcache:
-        for key in dgcache.keys():
-            print "dg: %s=%s" % (key, dgcache[key])
+        for key, val in dgcache.items():
+            print "dg: %s=%s" % (key, val)
 
 def cache_rawdump(**kwargs):
     if activedirectory_enabled():
@@ -530,12 +574,15 @@ def cache_count(**kwargs):
 def main():
     cache_funcs = {}
     cache_funcs['fill'] = cache_fill
+    cache_funcs['refresh'] = cache_refresh
     cache_funcs['expire'] = cache_expire
     cache_funcs['dump'] = cache_dump
     cache_funcs['keys'] = cache_keys
     cache_funcs['rawdump'] = cache_rawdump
     cache_funcs['check'] = cache_check
     cache_funcs['count'] = cache_count
+    cache_funcs['purge'] = cache_purge
+    cache_funcs['lookup'] = cache_lookup
 
     if len(sys.argv) < 2:
         usage(cache_funcs.keys())
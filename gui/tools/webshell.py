@@ -58,6 +58,13 @@ from freenasUI.settings import LOGGING
 log = logging.getLogger('tools.webshell')
 logging.config.dictConfig(LOGGING)
 
+# Sessions not kept alive for this many seconds are buried
+PROC_TIMEOUT = 60
+# Seconds between checks for timed out sessions when there is no output
+PROC_REAP_INTERVAL = 5
+# Longest a proc_wait call may block, in seconds
+PROC_WAIT_MAX = 30
+
 
 def set_proc_name(newname):
     libc = cdll.LoadLibrary('libc.so.7')
@@ -70,21 +77,25 @@ class XMLRPCHandler(SocketServer.BaseRequestHandler):
 
     def handle(self):
         buff = ''
-        while True:
-            data = self.request.recv(1024)
+        while '</methodCall>' not in buff:
+            data = self.request.recv(65536)
             if not data:
                 break
             buff += data
 
-            fds = select.select([self.request], [], [], 0)
-            if not fds[0]:
-                break
-
-        self.request.send(self.server.dispatcher._marshaled_dispatch(
+        self.request.sendall(self.server.dispatcher._marshaled_dispatch(
             buff
         ))
 
 
+class XMLRPCServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    One thread per request so long polls (proc_wait) do not hold up
+    the other sessions
+    """
+    daemon_threads = True
+
+
 def main_loop():
     set_proc_name('webshelld')
 
@@ -92,7 +103,7 @@ def main_loop():
     SOCKFILE = '/var/run/webshell.sock'
     if os.path.exists(SOCKFILE):
         os.unlink(SOCKFILE)
-    server = SocketServer.UnixStreamServer(SOCKFILE, XMLRPCHandler)
+    server = XMLRPCServer(SOCKFILE, XMLRPCHandler)
     os.chmod(SOCKFILE, 0o700)
     dispatcher.register_instance(
         Multiplex("/usr/local/bin/bash", "xterm-color"))
@@ -290,6 +301,8 @@ class Terminal:
             'k': '\x1b[23~',
             'l': '\x1b[24~',
         }
+        # Version of the rendered screen, bumped whenever a row changes
+        self.seq = 0
         self.reset_hard()
 
     # Reset functions
@@ -317,7 +330,7 @@ class Terminal:
         # Buffers
         self.vt100_out = ""
         # Caches
-        self.dump_cache = ""
+        self.dump_seq = -1
         # Invoke other resets
         self.reset_screen()
         self.reset_soft()
@@ -368,6 +381,14 @@ class Terminal:
         self.cy = 0
         # Tab stops
         self.tab_stops = range(0, self.w, 8)
+        # Rendered rows, the version they last changed in and the rows
+        # written since they were rendered
+        self.rows = [None] * self.h
+        self.rows_seq = array.array('L', [0] * self.h)
+        self.rows_dirty = set(range(self.h))
+        # Clients older than this version need the whole screen
+        self.rows_base = self.seq + 1
+        self.rows_state = None
 
     # UTF-8 functions
     def utf8_decode(self, d):
@@ -417,6 +438,9 @@ class Terminal:
     def poke(self, y, x, s):
         pos = self.w * y + x
         self.screen[pos:pos + len(s)] = s
+        if s:
+            self.rows_dirty.update(
+                xrange(y, (pos + len(s) - 1) // self.w + 1))
 
     def fill(self, y0, x0, y1, x1, char):
         n = self.w * (y1 - y0 - 1) + (x1 - x0)
@@ -611,6 +635,7 @@ class Terminal:
                 if ((state and not self.vt100_mode_alt_screen) or
                         (not state and self.vt100_mode_alt_screen)):
                     self.screen, self.screen2 = self.screen2, self.screen
+                    self.rows_dirty.update(xrange(self.h))
                     self.vt100_saved, self.vt100_saved2 = self.vt100_saved2, \
                         self.vt100_saved
                 self.vt100_mode_alt_screen = state
@@ -1195,64 +1220,120 @@ class Terminal:
                     o += chr(10)
         return o
 
-    def dump(self):
-        dump = u""
+    def dump_row(self, y, cx, cy):
+        dump = []
         attr_ = -1
-        cx, cy = min(self.cx, self.w - 1), self.cy
-        for y in range(0, self.h):
-            wx = 0
-            for x in range(0, self.w):
-                d = self.screen[y * self.w + x]
-                char = d & 0xffff
-                attr = d >> 16
-                # Cursor
-                if cy == y and cx == x and self.vt100_mode_cursor:
-                    attr = attr & 0xfff0 | 0x000c
-                # Attributes
-                if attr != attr_:
-                    if attr_ != -1:
-                        dump += u'</span>'
-                    bg = attr & 0x000f
-                    fg = (attr & 0x00f0) >> 4
-                    # Inverse
-                    inv = attr & 0x0200
-                    inv2 = self.vt100_mode_inverse
-                    if (inv and not inv2) or (inv2 and not inv):
-                        fg, bg = bg, fg
-                    # Concealed
-                    if attr & 0x0400:
-                        fg = 0xc
-                    # Underline
-                    if attr & 0x0100:
-                        ul = ' ul'
-                    else:
-                        ul = ''
-                    dump += u'<span class="shell_f%x shell_b%x%s">' % (
-                        fg,
-                        bg,
-                        ul)
-                    attr_ = attr
-                # Escape HTML characters
-                if char == 38:
-                    dump += '&amp;'
-                elif char == 60:
-                    dump += '&lt;'
-                elif char == 62:
-                    dump += '&gt;'
+        wx = 0
+        pos = y * self.w
+        for x in xrange(0, self.w):
+            d = self.screen[pos + x]
+            char = d & 0xffff
+            attr = d >> 16
+            # Cursor
+            if cy == y and cx == x and self.vt100_mode_cursor:
+                attr = attr & 0xfff0 | 0x000c
+            # Attributes
+            if attr != attr_:
+                if attr_ != -1:
+                    dump.append(u'</span>')
+                bg = attr & 0x000f
+                fg = (attr & 0x00f0) >> 4
+                # Inverse
+                inv = attr & 0x0200
+                inv2 = self.vt100_mode_inverse
+                if (inv and not inv2) or (inv2 and not inv):
+                    fg, bg = bg, fg
+                # Concealed
+                if attr & 0x0400:
+                    fg = 0xc
+                # Underline
+                if attr & 0x0100:
+                    ul = ' ul'
                 else:
-                    wx += self.utf8_charwidth(char)
-                    if wx <= self.w:
-                        dump += unichr(char)
-            dump += "\n"
+                    ul = ''
+                dump.append(u'<span class="shell_f%x shell_b%x%s">' % (
+                    fg,
+                    bg,
+                    ul))
+                attr_ = attr
+            # Escape HTML characters
+            if char == 38:
+                dump.append(u'&amp;')
+            elif char == 60:
+                dump.append(u'&lt;')
+            elif char == 62:
+                dump.append(u'&gt;')
+            else:
+                wx += self.utf8_charwidth(char)
+                if wx <= self.w:
+                    dump.append(unichr(char))
+        dump.append(u'</span>')
         # Encode in UTF-8
-        dump = dump.encode('utf-8')
-        dump += '</span>'
-        # Cache dump
-        if self.dump_cache == dump:
+        return u''.join(dump).encode('utf-8')
+
+    def dump_update(self):
+        """
+        Render the rows written since the last dump, or showing the
+        cursor before or after it moved, bumping the version of those
+        that changed.
+        """
+        cx, cy = min(self.cx, self.w - 1), self.cy
+        state = (cx, cy, self.vt100_mode_cursor, self.vt100_mode_inverse)
+        if state != self.rows_state:
+            if self.rows_state is None or state[3] != self.rows_state[3]:
+                self.rows_dirty.update(xrange(self.h))
+            else:
+                self.rows_dirty.add(self.rows_state[1])
+                self.rows_dirty.add(cy)
+            self.rows_state = state
+
+        changed = []
+        for y in self.rows_dirty:
+            row = self.dump_row(y, cx, cy)
+            if row != self.rows[y]:
+                self.rows[y] = row
+                changed.append(y)
+        self.rows_dirty.clear()
+
+        if changed:
+            self.seq += 1
+            for y in changed:
+                self.rows_seq[y] = self.seq
+        return cy
+
+    def dump(self):
+        cy = self.dump_update()
+        if self.dump_seq == self.seq:
             return ''
+        self.dump_seq = self.seq
+        return '<c cy="%03d" />' % cy + '\n'.join(self.rows) + '\n'
+
+    def dump_rows(self, seq=0):
+        """
+        Rows changed since version ``seq`` of the screen, every row for
+        a client that has none or a version from before a reset/resize.
+
+        Returns:
+            dict - seq, the current version
+                   cy, cursor row
+                   full, whether rows hold the whole screen
+                   rows, list of [row number, html]
+        """
+        cy = self.dump_update()
+        full = seq < self.rows_base or seq > self.seq
+        if full:
+            rows = [[y, row] for y, row in enumerate(self.rows)]
         else:
-            self.dump_cache = dump
-            return '<c cy="%03d" />' % cy + dump
+            rows = [
+                [y, self.rows[y]]
+                for y in xrange(self.h) if self.rows_seq[y] > seq
+            ]
+        return {
+            'seq': self.seq,
+            'cy': cy,
+            'full': full,
+            'rows': rows,
+        }
 
 
 class SynchronizedMethod:
@@ -1280,12 +1361,19 @@ class Multiplex:
         self.env_term = env_term
         # Synchronize methods
         self.lock = threading.RLock()
+        # Notified whenever a terminal gets output or a session dies
+        self.output = threading.Condition(self.lock)
+        # Wakes the supervisor thread up when sessions come and go
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
         for name in [
             'proc_keepalive',
             'proc_buryall',
             'proc_read',
             'proc_write',
             'proc_dump',
+            'proc_dump_rows',
             'proc_getalive'
         ]:
             orig = getattr(self, name)
@@ -1298,8 +1386,16 @@ class Multiplex:
     def stop(self):
         # Stop supervisor thread
         self.signal_stop = 1
+        self.proc_wakeup()
         self.thread.join()
 
+    def proc_wakeup(self):
+        try:
+            os.write(self.wakeup_w, '\0')
+        except (IOError, OSError):
+            # Pipe full, a wake up is pending already
+            pass
+
     def proc_keepalive(self, sid, jid, shell, w, h):
         if not sid in self.session:
             if not shell:
@@ -1399,6 +1495,7 @@ class Multiplex:
                     struct.pack("HHHH", h, w, 0, 0))
             except (IOError, OSError), e:
                 log.error("Unable to issue ioctl for terminal size: %s", e)
+            self.proc_wakeup()
             return True
 
     def proc_waitfordeath(self, sid):
@@ -1418,6 +1515,7 @@ class Multiplex:
             if 'pid' in self.session[sid]:
                 del self.session[sid]['pid']
         self.session[sid]['state'] = 'dead'
+        self.output.notify_all()
         return True
 
     def proc_bury(self, sid):
@@ -1454,6 +1552,7 @@ class Multiplex:
             return False
         term = self.session[sid]['term']
         term.write(d)
+        self.output.notify_all()
         # Read terminal response
         d = term.read()
         if d:
@@ -1485,6 +1584,27 @@ class Multiplex:
             return False
         return self.session[sid]['term'].dump()
 
+    # Dump terminal rows changed since version seq
+    def proc_dump_rows(self, sid, seq):
+        if sid not in self.session:
+            return False
+        return self.session[sid]['term'].dump_rows(seq)
+
+    # Wait up to timeout seconds for rows changed since version seq
+    def proc_wait(self, sid, seq, timeout):
+        deadline = time.time() + min(timeout, PROC_WAIT_MAX)
+        with self.output:
+            while True:
+                if sid not in self.session:
+                    return False
+                rows = self.session[sid]['term'].dump_rows(seq)
+                if rows['rows'] or self.session[sid]['state'] != 'alive':
+                    return rows
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return rows
+                self.output.wait(remaining)
+
     # Get alive sessions, bury timed out ones
     def proc_getalive(self):
         fds = []
@@ -1492,7 +1612,7 @@ class Multiplex:
         now = time.time()
         for sid in self.session.keys():
             then = self.session[sid]['time']
-            if (now - then) > 60:
+            if (now - then) > PROC_TIMEOUT:
                 self.proc_bury(sid)
             else:
                 if self.session[sid]['state'] == 'alive':
@@ -1505,15 +1625,23 @@ class Multiplex:
         while not self.signal_stop:
             # Read fds
             (fds, fd2sid) = self.proc_getalive()
+            # Sleep until there is output, a session is spawned or it is
+            # time to look for timed out sessions
             try:
-                i, o, e = select.select(fds, [], [], 1.0)
-            except (IOError, OSError):
+                i, o, e = select.select(
+                    fds + [self.wakeup_r], [], [], PROC_REAP_INTERVAL
+                )
+            except (IOError, OSError, select.error):
                 i = []
             for fd in i:
+                if fd == self.wakeup_r:
+                    try:
+                        os.read(self.wakeup_r, 512)
+                    except (IOError, OSError):
+                        pass
+                    continue
                 sid = fd2sid[fd]
                 self.proc_read(sid)
-            if len(i):
-                time.sleep(0.002)
         self.proc_buryall()
 
 if __name__ == '__main__':
@@ -34,46 +34,9 @@ cache_func()
 {
 	local cachetype="${1}"
 
-	cachedir="${FREENAS_CACHEDIR}"
-	directory_cachedir=
-
-	case ${cachetype} in
-		AD) directory_cachedir="${cachedir}/.ldap/.activedirectory" ;;
-		LDAP) directory_cachedir="${cachedir}/.ldap/.ldap" ;;
-	esac
-
-	directory_local_users="${directory_cachedir}/.local/.users/.cache.db"
-	directory_local_groups="${directory_cachedir}/.local/.users/.cache.db"
-	directory_users="${directory_cachedir}/.users/.cache.db"
-	directory_groups="${directory_cachedir}/.groups/.cache.db"
-
-	if [ -f "${directory_local_users}" ]
-	then
-		section_header "${directory_local_users}"
-		/usr/local/bin/db_stat-4.6 -d "${directory_local_users}"
-		section_footer
-	fi
-
-	if [ -f "${directory_local_groups}" ]
-	then
-		section_header "${directory_local_groups}"
-		/usr/local/bin/db_stat-4.6 -d "${directory_local_groups}"
-		section_footer
-	fi
-
-	if [ -f "${directory_users}" ]
-	then
-		section_header "${directory_users}"
-		/usr/local/bin/db_stat-4.6 -d "${directory_users}"
-		section_footer
-	fi
-
-	if [ -f "${directory_groups}" ]
-	then
-		section_header "${directory_groups}"
-		/usr/local/bin/db_stat-4.6 -d "${directory_groups}"
-		section_footer
-	fi
+	section_header "User and Group cache counts"
+	/usr/local/www/freenasUI/tools/cachetool.py count
+	section_footer
 
 	section_header "User and Group cache dump"
 	/usr/local/www/freenasUI/tools/cachetool.py dump
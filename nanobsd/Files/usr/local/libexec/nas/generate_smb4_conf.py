@@ -18,8 +18,6 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "freenasUI.settings"
 from django.db.models.loading import cache
 cache.get_apps()
 
-from django.db.models import Q
-
 from freenasUI.account.models import (
     bsdUsers,
     bsdGroups,
@@ -50,34 +48,84 @@ from freenasUI.storage.models import Task
 from freenasUI.system.models import Settings
 
 
-def is_within_zfs(mountpoint):
-    try:
-        st = os.stat(mountpoint)
-    except:
-        return False
-
-    share_dev = st.st_dev
-    p = pipeopen("zfs list -H -o mountpoint")
-    zfsout = p.communicate()
+def get_zfs_mountpoints():
+    """
+    mountpoint -> dataset name of every mounted ZFS dataset
+    """
+    p = pipeopen("zfs list -H -o mountpoint,name")
+    zfsout = p.communicate()[0]
     if p.returncode != 0:
-        return False
-    if zfsout:
-        zfsout = zfsout[0]
+        return {}
 
-    for mp in zfsout.split('\n'):
-        mp = mp.strip()
-        if mp == '-':
+    mountpoints = {}
+    for line in zfsout.split('\n'):
+        try:
+            zfs_mp, zfs_ds = line.split('\t')
+        except ValueError:
             continue
+        if zfs_mp.startswith('/'):
+            mountpoints[zfs_mp] = zfs_ds
+    return mountpoints
+
 
+def get_zfs_devices(mountpoints):
+    """
+    Device numbers of the filesystems of the ZFS datasets
+    """
+    devices = set()
+    for mp in mountpoints:
         try:
-            st = os.stat(mp)
+            devices.add(os.stat(mp).st_dev)
         except:
             continue
+    return devices
 
-        if st.st_dev == share_dev:
-            return True
 
-    return False
+def is_within_zfs(mountpoint, devices=None):
+    try:
+        st = os.stat(mountpoint)
+    except:
+        return False
+
+    if devices is None:
+        devices = get_zfs_devices(get_zfs_mountpoints())
+    return st.st_dev in devices
+
+
+def get_dataset(mountpoints, path):
+    """
+    Longest mountpoint prefix of path
+
+    Returns:
+        (mountpoint, dataset name) or (None, None)
+    """
+    path = os.path.normpath(path)
+    while True:
+        if path in mountpoints:
+            return path, mountpoints[path]
+        if path == '/':
+            return None, None
+        path = os.path.dirname(path)
+
+
+def get_snapshot_task(mountpoints, tasks, recursive_tasks, path):
+    """
+    Periodic snapshot task taking the snapshots seen from path, any task
+    of the dataset mounted on path itself, else a recursive task of the
+    dataset path is in or of one of its parents.
+    """
+    mp, ds = get_dataset(mountpoints, path)
+    if ds is None:
+        return None
+
+    if mp == os.path.normpath(path) and ds in tasks:
+        return tasks[ds]
+
+    while ds:
+        if ds in recursive_tasks:
+            return recursive_tasks[ds]
+        ds = ds.rpartition('/')[0]
+    return None
 
 
 def get_sysctl(name):
@@ -498,27 +546,24 @@ def generate_smb4_shares(smb4_shares):
     if len(shares) == 0:
         return
 
-    p = pipeopen("zfs list -H -o mountpoint,name")
-    zfsout = p.communicate()[0].split('\n')
-    if p.returncode != 0:
-        zfsout = []
+    mountpoints = get_zfs_mountpoints()
+    devices = get_zfs_devices(mountpoints)
+
+    # First task of each dataset, as Task.objects.filter(...)[0] would
+    tasks = {}
+    recursive_tasks = {}
+    for task in Task.objects.all():
+        tasks.setdefault(task.task_filesystem, task)
+        if task.task_recursive:
+            recursive_tasks.setdefault(task.task_filesystem, task)
 
     for share in shares:
         if not os.path.isdir(share.cifs_path):
             continue
 
-        task = False
-        for line in zfsout:
-            try:
-                zfs_mp, zfs_ds = line.split()
-                if share.cifs_path == zfs_mp or share.cifs_path.startswith("%s/" % zfs_mp):
-                    if share.cifs_path == zfs_mp:
-                        task = Task.objects.filter(task_filesystem = zfs_ds)[0]
-                    else:
-                        task = Task.objects.filter(Q(task_filesystem = zfs_ds) & Q(task_recursive=True))[0]
-                    break
-            except:
-                pass
+        task = get_snapshot_task(
+            mountpoints, tasks, recursive_tasks, share.cifs_path
+        )
 
         confset1(smb4_shares, "\n")
         confset2(smb4_shares, "[%s]", share.cifs_name.encode('utf8'), space=0)
@@ -541,7 +586,7 @@ def generate_smb4_shares(smb4_shares):
             vfs_objects.append('recycle')
         if task:
             vfs_objects.append('shadow_copy2')
-        if is_within_zfs(share.cifs_path):
+        if is_within_zfs(share.cifs_path, devices):
             vfs_objects.append('zfsacl')
         vfs_objects.append('streams_xattr')
         vfs_objects.append('aio_pthread')
@@ -734,14 +779,17 @@ def get_groups():
 
     groups = bsdGroups.objects.filter(bsdgrp_builtin=0)
     for g in groups:
-        key = str(g.bsdgrp_group)
-        _groups[key] = []
-        members = bsdGroupMembership.objects.filter(bsdgrpmember_group=g.id)
-        for m in members:
-             u = bsdUsers.objects.filter(bsdusr_username=m.bsdgrpmember_user)
-             if u:
-                 u = u[0]
-                 _groups[key].append(str(u.bsdusr_username))
+        _groups[str(g.bsdgrp_group)] = []
+
+    # Every member of every group in a single join
+    members = bsdGroupMembership.objects.filter(
+        bsdgrpmember_group__bsdgrp_builtin=0
+    ).values_list(
+        'bsdgrpmember_group__bsdgrp_group',
+        'bsdgrpmember_user__bsdusr_username',
+    )
+    for group, username in members:
+        _groups[str(group)].append(str(username))
 
     return _groups
 